@@ -0,0 +1,158 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    In-memory query answer cache
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module implements a process-local cache of query answers,
+    consulted by query.process_query() before the query cache in the
+    queries table of the database.
+
+    Answers are keyed by the normalized question text, the client type,
+    whether the query is a voice query, and the client's location,
+    rounded to a grid of roughly a kilometer, so that location dependent
+    answers are not served to clients far away. An answer is only cached
+    if the query module has set an expiration time for it, and it
+    expires at that time. The query context is cached along with the
+    answer, so that answers served from the cache can be logged with
+    it and follow-up queries work as usual.
+
+"""
+
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+import copy
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+from settings import Settings
+
+
+# Cache key: question, voice, client type, location bucket
+AnswerKey = Tuple[str, bool, str, Optional[Tuple[float, float]]]
+
+# Number of decimals of latitude and longitude in a location bucket
+_LOCATION_DECIMALS = 2
+
+
+class CachedAnswer(NamedTuple):
+
+    """ A cached answer, with its expiration time and query context """
+
+    result: Dict[str, Any]
+    expires: datetime
+    context: Optional[Dict[str, Any]]
+
+
+class AnswerCache:
+
+    """ A process-wide LRU cache of query answers with expiration times """
+
+    _lock = threading.Lock()
+    # key -> (time taken to obtain the answer in ms, cached answer)
+    _lru: "OrderedDict[AnswerKey, Tuple[float, CachedAnswer]]" = OrderedDict()
+    _counters: Dict[str, float] = dict(
+        hits=0, misses=0, expired=0, stores=0, saved_ms=0.0
+    )
+
+    @staticmethod
+    def key(
+        question: str,
+        voice: bool,
+        client_type: Optional[str],
+        location: Optional[Tuple[float, float]],
+    ) -> AnswerKey:
+        """ Return a cache key for a query """
+        bucket = None
+        if location is not None:
+            bucket = (
+                round(location[0], _LOCATION_DECIMALS),
+                round(location[1], _LOCATION_DECIMALS),
+            )
+        return (
+            " ".join(question.lower().split()),
+            voice,
+            client_type or "",
+            bucket,
+        )
+
+    @classmethod
+    def get(cls, key: AnswerKey, now: datetime) -> Optional[CachedAnswer]:
+        """ Return a copy of a cached, unexpired answer, or None """
+        if Settings.ANSWER_CACHE_SIZE <= 0:
+            return None
+        with cls._lock:
+            entry = cls._lru.get(key)
+            if entry is None:
+                cls._counters["misses"] += 1
+                return None
+            elapsed_ms, answer = entry
+            if answer.expires < now:
+                del cls._lru[key]
+                cls._counters["expired"] += 1
+                cls._counters["misses"] += 1
+                return None
+            cls._lru.move_to_end(key)
+            cls._counters["hits"] += 1
+            cls._counters["saved_ms"] += elapsed_ms
+        # The caller may modify the result, so we return a copy
+        return copy.deepcopy(answer)
+
+    @classmethod
+    def put(
+        cls,
+        key: AnswerKey,
+        result: Dict[str, Any],
+        expires: Optional[datetime],
+        elapsed_ms: float,
+        context: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """ Store a result and its query context in the cache, until it
+            expires. Results without an expiration time are not cached.
+            The time taken to obtain the result is recorded, to measure
+            the time saved by cache hits. """
+        if expires is None or Settings.ANSWER_CACHE_SIZE <= 0:
+            return
+        answer = CachedAnswer(copy.deepcopy(result), expires, copy.deepcopy(context))
+        entry = (elapsed_ms, answer)
+        with cls._lock:
+            cls._lru[key] = entry
+            cls._lru.move_to_end(key)
+            cls._counters["stores"] += 1
+            while len(cls._lru) > Settings.ANSWER_CACHE_SIZE:
+                cls._lru.popitem(last=False)
+
+    @classmethod
+    def clear(cls) -> None:
+        """ Clear the cache and the counters """
+        with cls._lock:
+            cls._lru.clear()
+            for k in cls._counters:
+                cls._counters[k] = 0
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        """ Return the cache counters, hit ratio and size """
+        with cls._lock:
+            d: Dict[str, Any] = dict(cls._counters)
+            d["size"] = len(cls._lru)
+        lookups = d["hits"] + d["misses"]
+        d["hit_ratio"] = round(d["hits"] / lookups, 4) if lookups else 0.0
+        d["saved_ms"] = round(d["saved_ms"], 1)
+        return d
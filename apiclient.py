@@ -0,0 +1,237 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    HTTP client for remote APIs
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module implements the HTTP client that the query modules use
+    to call remote APIs (weather, currency, petrol prices, Wikipedia,
+    Google Maps, etc.), via queries.query_json_api() and query_xml_api().
+
+    The client keeps a pool of keep-alive connections, applies a strict
+    timeout to every request, and caches parsed responses by URL, with
+    a time-to-live given by the caller for each endpoint. Once an entry
+    expires, it is still served for a while (the stale period) while it
+    is refreshed in a background thread, so that a slow upstream API
+    only delays the queries that find nothing usable in the cache.
+    Hit, miss and latency statistics are kept for each endpoint.
+
+"""
+
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+import time
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from settings import Settings
+
+
+# Parses a response into a value, or raises an exception
+ParseFunc = Callable[[requests.Response], Any]
+
+
+class ApiClient:
+
+    """ A process-wide HTTP client with a pooled session, timeouts, a
+        TTL cache with stale-while-revalidate refresh, and statistics.
+        Cached values are shared between callers, who must not modify them. """
+
+    _instance: Optional["ApiClient"] = None
+    _instance_lock = threading.Lock()
+
+    # Statistics counters kept for each endpoint
+    _COUNTERS = ("hits", "stale_hits", "misses", "requests", "errors", "refreshes")
+
+    def __init__(
+        self, timeout: Optional[float] = None, cache_size: Optional[int] = None
+    ) -> None:
+        self._timeout = Settings.API_TIMEOUT if timeout is None else timeout
+        self._cache_size = Settings.API_CACHE_SIZE if cache_size is None else cache_size
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=16)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        # URL -> (parsed value, time.monotonic() when fetched)
+        self._cache: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        # URLs being refreshed in the background
+        self._refreshing: Set[str] = set()
+        # Statistics by endpoint; see stats()
+        self._stats: Dict[str, Dict[str, float]] = defaultdict(self._new_stats)
+
+    @classmethod
+    def instance(cls) -> "ApiClient":
+        """ Return the process-wide client instance """
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def _new_stats(cls) -> Dict[str, float]:
+        d: Dict[str, float] = {c: 0 for c in cls._COUNTERS}
+        d["seconds"] = 0.0
+        d["max_seconds"] = 0.0
+        return d
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """ Return the endpoint of a URL, i.e. without the query string,
+            which may contain API keys and should not be logged """
+        s = urlsplit(url)
+        return "{0}://{1}{2}".format(s.scheme, s.netloc, s.path)
+
+    def _count(self, endpoint: str, counter: str) -> None:
+        with self._lock:
+            self._stats[endpoint][counter] += 1
+
+    def _fetch(self, url: str, parse: ParseFunc) -> Optional[Any]:
+        """ Request the URL and parse the response, returning
+            None if the request or the parsing fails """
+        endpoint = self.endpoint(url)
+        t0 = time.monotonic()
+        r = None
+        try:
+            r = self._session.get(url, timeout=self._timeout)
+        except Exception as e:
+            logging.warning("Request to {0} failed: {1}".format(endpoint, e))
+        elapsed = time.monotonic() - t0
+        value = None
+        if r is not None:
+            if r.status_code != 200:
+                logging.warning(
+                    "Received status {0} from {1}".format(r.status_code, endpoint)
+                )
+            else:
+                try:
+                    value = parse(r)
+                except Exception as e:
+                    logging.warning(
+                        "Error parsing response from {0}: {1}".format(endpoint, e)
+                    )
+        with self._lock:
+            st = self._stats[endpoint]
+            st["requests"] += 1
+            if value is None:
+                st["errors"] += 1
+            st["seconds"] += elapsed
+            st["max_seconds"] = max(st["max_seconds"], elapsed)
+        return value
+
+    def _store(self, url: str, value: Any) -> None:
+        """ Add a value to the cache, evicting the least recently used
+            entries if needed """
+        with self._lock:
+            self._cache[url] = (value, time.monotonic())
+            self._cache.move_to_end(url)
+            while len(self._cache) > max(self._cache_size, 0):
+                self._cache.popitem(last=False)
+
+    def _refresh(self, url: str, parse: ParseFunc) -> None:
+        """ Fetch a new value for a cached URL """
+        try:
+            value = self._fetch(url, parse)
+            if value is not None:
+                self._store(url, value)
+        finally:
+            with self._lock:
+                self._refreshing.discard(url)
+
+    def _refresh_async(self, url: str, parse: ParseFunc) -> None:
+        """ Start a background refresh of a cached URL,
+            unless one is already in progress """
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+            self._stats[self.endpoint(url)]["refreshes"] += 1
+        threading.Thread(target=self._refresh, args=(url, parse), daemon=True).start()
+
+    def get(
+        self,
+        url: str,
+        parse: ParseFunc,
+        ttl: float = 0.0,
+        stale: Optional[float] = None,
+    ) -> Optional[Any]:
+        """ Return the parsed response from the URL, or None upon failure.
+            If ttl (seconds) is positive, successful responses are cached for
+            that long, and then served for another stale seconds (by default
+            as long as the ttl) while they are refreshed in the background. """
+        endpoint = self.endpoint(url)
+        if ttl <= 0:
+            return self._fetch(url, parse)
+        if stale is None:
+            stale = ttl
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None:
+                self._cache.move_to_end(url)
+        if entry is not None:
+            value, fetched = entry
+            age = time.monotonic() - fetched
+            if age < ttl:
+                self._count(endpoint, "hits")
+                return value
+            if age < ttl + stale:
+                self._count(endpoint, "stale_hits")
+                self._refresh_async(url, parse)
+                return value
+        self._count(endpoint, "misses")
+        value = self._fetch(url, parse)
+        if value is not None:
+            self._store(url, value)
+        return value
+
+    def clear(self) -> None:
+        """ Clear the cache and the statistics """
+        with self._lock:
+            self._cache.clear()
+            self._stats.clear()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """ Return a snapshot of the statistics, as a dict of endpoint ->
+            dict of counters (hits, stale_hits, misses, requests, errors,
+            refreshes) and request latency (seconds in total, max_seconds) """
+        with self._lock:
+            return {endpoint: dict(st) for endpoint, st in self._stats.items()}
+
+    def log_stats(self) -> None:
+        """ Log the statistics for each endpoint """
+        for endpoint, st in sorted(self.stats().items()):
+            lookups = st["hits"] + st["stale_hits"] + st["misses"]
+            logging.info(
+                "{0}: {1} lookups, {2} hits, {3} stale hits, {4} requests, "
+                "{5} errors, {6:.3f} s average, {7:.3f} s max".format(
+                    endpoint,
+                    int(lookups),
+                    int(st["hits"]),
+                    int(st["stale_hits"]),
+                    int(st["requests"]),
+                    int(st["errors"]),
+                    st["seconds"] / st["requests"] if st["requests"] else 0.0,
+                    st["max_seconds"],
+                )
+            )
@@ -28,18 +28,21 @@ from typing import Optional, List, Dict, Any, Tuple
 
 import json
 import uuid
+import logging
 from datetime import datetime
 from collections import OrderedDict, defaultdict
 
 from settings import NoIndexWords
-from db import SessionContext, DataError, desc
+from db import SessionContext, BulkWriter, DataError, desc
 from db.models import Article as ArticleRow, Word, Root
 from fetcher import Fetcher
 from reynir import TOK
 from reynir.fastparser import Fast_Parser, ParseForestDumper
 from reynir.incparser import IncrementalParser
 from tree import Tree
-from treeutil import TreeUtility
+from treeutil import TreeUtility, WordTuple
+from parsecache import ParseCache
+from treepack import PackedArticle, pack_article, unpack_tokens_json, unpack_tree
 from settings import Settings
 from tokenizer import __version__ as tokenizer_version
 
@@ -108,12 +111,18 @@ class Article:
         self._num_parsed = 0
         self._ambiguity = 1.0
         self._html = None
+        self._etag = None
+        self._last_modified = None
+        self._content_hash = None
+        # True if a re-scrape found the article content to be unchanged
+        self._unchanged = False
         self._tree = None
         self._root_id = None
         self._root_domain = None
         self._helper = None
         self._tokens = None  # JSON string
         self._raw_tokens = None  # The tokens themselves
+        self._packed = None  # Tree and tokens in packed binary format
         self._words = None  # The individual word stems, in a dictionary
 
     @classmethod
@@ -138,25 +147,53 @@ class Article:
         a._num_parsed = ar.num_parsed
         a._ambiguity = ar.ambiguity
         a._html = ar.html
+        a._etag = ar.etag
+        a._last_modified = ar.last_modified
+        a._content_hash = ar.content_hash
         a._tree = ar.tree
         a._tokens = ar.tokens
+        a._packed = ar.packed
         assert a._raw_tokens is None
         a._root_id = ar.root_id
         a._root_domain = ar.root.domain if ar.root else None
         return a
 
     @classmethod
-    def _init_from_scrape(cls, url, enclosing_session=None):
-        """ Scrape an article from its URL """
+    def _init_from_scrape(cls, url, enclosing_session=None, ar=None):
+        """ Scrape an article from its URL. If ar is a previously scraped
+            database row for the article, a conditional fetch is made and
+            the stored article is returned, marked as unchanged, if the
+            content has not changed since the last scrape. """
         if url is None:
             return None
         a = cls(url=url)
         with SessionContext(enclosing_session) as session:
+            known = ar is not None and bool(ar.html)
             # Obtain a helper corresponding to the URL
-            html, metadata, helper = Fetcher.fetch_url_html(url, session)
+            fr = Fetcher.fetch_article_html(
+                url,
+                session,
+                etag=ar.etag if known else None,
+                last_modified=ar.last_modified if known else None,
+            )
+            if known and (
+                fr.not_modified
+                or (fr.content_hash is not None and fr.content_hash == ar.content_hash)
+            ):
+                # Nothing has changed: keep the stored HTML, tokens and trees
+                a = cls._init_from_row(ar)
+                a._scraped = datetime.utcnow()
+                a._etag = fr.etag
+                a._last_modified = fr.last_modified
+                a._unchanged = True
+                return a
+            html, metadata, helper = fr.html, fr.metadata, fr.helper
             if html is None:
                 return a
             a._html = html
+            a._etag = fr.etag
+            a._last_modified = fr.last_modified
+            a._content_hash = fr.content_hash
             if metadata is not None:
                 a._heading = metadata.heading
                 a._author = metadata.author
@@ -186,7 +223,7 @@ class Article:
         """ Force fetch of an article, given its URL """
         with SessionContext(enclosing_session) as session:
             ar = session.query(ArticleRow).filter(ArticleRow.url == url).one_or_none()
-            a = cls._init_from_scrape(url, session)
+            a = cls._init_from_scrape(url, session, ar)
             if a is not None and ar is not None:
                 # This article already existed in the database, so note its UUID
                 a._uuid = ar.id
@@ -207,13 +244,21 @@ class Article:
                 ar = None
             return None if ar is None else cls._init_from_row(ar)
 
+    def _get_raw_tokens(self):
+        """ Return the raw token list, generating it lazily
+            from the JSON or packed representation """
+        if self._raw_tokens is None:
+            if self._tokens:
+                self._raw_tokens = json.loads(self._tokens)
+            elif self._packed is not None:
+                self._raw_tokens = PackedArticle(self._packed).tokens()
+        return self._raw_tokens
+
     def person_names(self):
         """ A generator yielding all person names in an article token stream """
-        if self._raw_tokens is None and self._tokens:
-            # Lazy generation of the raw tokens from the JSON rep
-            self._raw_tokens = json.loads(self._tokens)
-        if self._raw_tokens:
-            for p in self._raw_tokens:
+        raw_tokens = self._get_raw_tokens()
+        if raw_tokens:
+            for p in raw_tokens:
                 for sent in p:
                     for t in sent:
                         if t.get("k") == TOK.PERSON:
@@ -222,11 +267,9 @@ class Article:
 
     def entity_names(self):
         """ A generator for entity names from an article token stream """
-        if self._raw_tokens is None and self._tokens:
-            # Lazy generation of the raw tokens from the JSON rep
-            self._raw_tokens = json.loads(self._tokens)
-        if self._raw_tokens:
-            for p in self._raw_tokens:
+        raw_tokens = self._get_raw_tokens()
+        if raw_tokens:
+            for p in raw_tokens:
                 for sent in p:
                     for t in sent:
                         if t.get("k") == TOK.ENTITY:
@@ -252,7 +295,9 @@ class Article:
         assert session is not None
         # Delete previously stored words for this article
         session.execute(Word.table().delete().where(Word.article_id == self._uuid))
-        # Index the words by storing them in the words table
+        # Index the words by storing them in the words table,
+        # with multi-row inserts
+        writer = BulkWriter(session)
         if self._words:
             for word, cnt in self._words.items():
                 if word.cat not in NoIndexWords.CATEGORIES_TO_INDEX:
@@ -265,8 +310,10 @@ class Article:
                     # Shield the database from too long words
                     continue
                 # Interesting word: let's index it
-                w = Word(article_id=self._uuid, stem=word.stem, cat=word.cat, cnt=cnt)
-                session.add(w)
+                writer.add(
+                    Word, article_id=self._uuid, stem=word.stem, cat=word.cat, cnt=cnt
+                )
+        writer.flush()
 
     def _parse(self, enclosing_session=None, verbose=False):
         """ Parse the article content to yield parse trees and annotated token list """
@@ -277,6 +324,7 @@ class Article:
 
             bp = self.get_parser()
             ip = IncrementalParser(bp, toklist, verbose=verbose)
+            version = "{0}/{1}".format(bp.version, tokenizer_version)
 
             # List of paragraphs containing a list of sentences containing
             # token lists for sentences in string dump format
@@ -290,12 +338,33 @@ class Article:
             # Word stem dictionary, indexed by (stem, cat)
             words: Dict[Tuple[str, str], int] = defaultdict(int)
             num_sent = 0
-
-            for p in ip.paragraphs():
+            # Parse statistics, accumulated here rather than taken from
+            # the IncrementalParser, since sentences found in the
+            # parse cache are not seen by it
+            num_attempted = 0
+            num_article_tokens = 0
+            num_parsed = 0
+            total_ambig = 0.0
+            total_tokens = 0
+
+            # Split the article into sentences up front, so that the parse
+            # cache can be consulted for all of them in one lookup
+            paragraphs = [list(p.sentences()) for p in ip.paragraphs()]
+            keys = {
+                id(sent): ParseCache.key(sent.tokens, version)
+                for p in paragraphs
+                for sent in p
+                if len(sent) <= MAX_SENTENCE_TOKENS
+            }
+            found = ParseCache.get_many(session, keys.values())
+            # Parse results not found in the cache, to be stored there
+            parsed: Dict[str, Any] = dict()
+
+            for p in paragraphs:
 
                 pgs.append([])
 
-                for sent in p.sentences():
+                for sent in p:
 
                     num_sent += 1
                     num_tokens = len(sent)
@@ -305,49 +374,90 @@ class Article:
                     # minutes to process
                     if Settings.DEBUG:
                         print(f"#{num_sent:03} ({num_tokens:3}) {sent.text}")
-                    if num_tokens <= MAX_SENTENCE_TOKENS and sent.parse():
-                        # Obtain a text representation of the parse tree
-                        token_dicts = TreeUtility.dump_tokens(
-                            sent.tokens, sent.tree, words=words
-                        )
-                        # Create a verbose text representation of
-                        # the highest scoring parse tree
-                        tree = ParseForestDumper.dump_forest(
-                            sent.tree, token_dicts=token_dicts
-                        )
-                        # Add information about the sentence tree's score
-                        # and the number of tokens
-                        trees[num_sent] = "\n".join(
-                            ["C{0}".format(sent.score), "L{0}".format(num_tokens), tree]
-                        )
-                    else:
-                        # Error, sentence too long or no parse:
-                        # add an error index entry for this sentence
-                        if num_tokens > MAX_SENTENCE_TOKENS:
-                            # Set the error index at the first
-                            # token outside the maximum limit
-                            eix = MAX_SENTENCE_TOKENS
-                        else:
-                            eix = sent.err_index
+                    if num_tokens > MAX_SENTENCE_TOKENS:
+                        # Error, sentence too long: set the error index
+                        # at the first token outside the maximum limit
+                        eix = MAX_SENTENCE_TOKENS
                         token_dicts = TreeUtility.dump_tokens(
                             sent.tokens, None, error_index=eix
                         )
                         trees[num_sent] = "E{0}".format(eix)
-
-                    pgs[-1].append(token_dicts)
+                        pgs[-1].append(token_dicts)
+                        continue
+
+                    num_attempted += 1
+                    num_article_tokens += num_tokens
+                    key = keys[id(sent)]
+                    cached = found.get(key) or parsed.get(key)
+                    if cached is None:
+                        # Not in the cache: parse the sentence
+                        num_comb = ip.num_combinations
+                        if sent.parse():
+                            # Obtain a text representation of the parse tree
+                            swords: Dict[Tuple[str, str], int] = defaultdict(int)
+                            token_dicts = TreeUtility.dump_tokens(
+                                sent.tokens, sent.tree, words=swords
+                            )
+                            # Create a verbose text representation of
+                            # the highest scoring parse tree
+                            tree = ParseForestDumper.dump_forest(
+                                sent.tree, token_dicts=token_dicts
+                            )
+                            cached = dict(
+                                # Number of parse combinations
+                                n=ip.num_combinations - num_comb,
+                                # Add information about the sentence tree's score
+                                # and the number of tokens
+                                tree="\n".join(
+                                    [
+                                        "C{0}".format(sent.score),
+                                        "L{0}".format(num_tokens),
+                                        tree,
+                                    ]
+                                ),
+                                tokens=token_dicts,
+                                words=[
+                                    [wt.stem, wt.cat, cnt] for wt, cnt in swords.items()
+                                ],
+                            )
+                        else:
+                            # Error, no parse:
+                            # add an error index entry for this sentence
+                            cached = dict(
+                                n=0,
+                                tree="E{0}".format(sent.err_index),
+                                tokens=TreeUtility.dump_tokens(
+                                    sent.tokens, None, error_index=sent.err_index
+                                ),
+                            )
+                        parsed[key] = cached
+
+                    num = cached["n"]
+                    if num > 0:
+                        num_parsed += 1
+                        total_ambig += num ** (1 / num_tokens) * num_tokens
+                        total_tokens += num_tokens
+                        for stem, cat, cnt in cached["words"]:
+                            words[WordTuple(stem=stem, cat=cat)] += cnt
+                    trees[num_sent] = cached["tree"]
+                    pgs[-1].append(cached["tokens"])
+
+            ParseCache.put_many(session, parsed)
 
             # parse_time = ip.parse_time
 
             self._parsed = datetime.utcnow()
-            self._parser_version = "{0}/{1}".format(bp.version, tokenizer_version)
-            self._num_tokens = ip.num_tokens
-            self._num_sentences = ip.num_sentences
-            self._num_parsed = ip.num_parsed
-            self._ambiguity = ip.ambiguity
+            self._parser_version = version
+            self._num_tokens = num_article_tokens
+            self._num_sentences = num_attempted
+            self._num_parsed = num_parsed
+            self._ambiguity = (total_ambig / total_tokens) if total_tokens > 0 else 1.0
 
             # Make one big JSON string for the paragraphs, sentences and tokens
             self._raw_tokens = pgs
             self._tokens = json.dumps(pgs, separators=(",", ":"), ensure_ascii=False)
+            # Any previously packed tree and tokens are now stale
+            self._packed = None
 
             # Keep the bag of words (stem, category, count for each word)
             self._words = words
@@ -358,12 +468,29 @@ class Article:
                 "S{0}\n{1}\n".format(key, val) for key, val in trees.items()
             )
 
+    def _storage_columns(self):
+        """ Return the values of the tree, tokens and packed columns,
+            in the storage format selected by Settings.PACKED_ARTICLES """
+        if not Settings.PACKED_ARTICLES:
+            return self.tree, self.tokens, None
+        if self._packed is None and self._tree is not None and self._tokens:
+            try:
+                self._packed = pack_article(self._tree, self._get_raw_tokens())
+            except ValueError as e:
+                # Unable to pack: fall back to the text format
+                logging.warning("Unable to pack article {0}: {1}".format(self._url, e))
+                return self._tree, self._tokens, None
+        if self._packed is None:
+            return self._tree, self._tokens, None
+        return None, None, self._packed
+
     def store(self, enclosing_session=None):
         """ Store an article in the database, inserting it or updating """
         with SessionContext(enclosing_session, commit=True) as session:
             if self._uuid is None:
                 # Insert a new row
                 self._uuid = str(uuid.uuid1())
+                tree, tokens, packed = self._storage_columns()
                 ar = ArticleRow(
                     id=self._uuid,
                     url=self._url,
@@ -383,9 +510,13 @@ class Article:
                     num_sentences=self._num_sentences,
                     num_parsed=self._num_parsed,
                     ambiguity=self._ambiguity,
+                    etag=self._etag,
+                    last_modified=self._last_modified,
+                    content_hash=self._content_hash,
                     html=self._html,
-                    tree=self._tree,
-                    tokens=self._tokens,
+                    tree=tree,
+                    tokens=tokens,
+                    packed=packed,
                 )
                 # Delete any existing rows with the same URL
                 session.execute(
@@ -409,8 +540,18 @@ class Article:
                 # UUID not found: something is wrong here...
                 return False
 
+            if self._unchanged:
+                # Re-scraped without changes: only note the time of the
+                # scrape and the fresh cache validators
+                ar.scraped = self._scraped
+                ar.etag = self._etag
+                ar.last_modified = self._last_modified
+                session.flush()
+                return True
+
             # Update the columns
             # UUID is immutable
+            tree, tokens, packed = self._storage_columns()
             ar.url = self._url
             ar.root_id = self._root_id
             ar.heading = self._heading
@@ -428,9 +569,13 @@ class Article:
             ar.num_sentences = self._num_sentences
             ar.num_parsed = self._num_parsed
             ar.ambiguity = self._ambiguity
+            ar.etag = self._etag
+            ar.last_modified = self._last_modified
+            ar.content_hash = self._content_hash
             ar.html = self._html
-            ar.tree = self._tree
-            ar.tokens = self._tokens
+            ar.tree = tree
+            ar.tokens = tokens
+            ar.packed = packed
             # If the article has been parsed, update the index of word stems
             # (This may cause all stems for the article to be deleted, if
             # there are no successfully parsed sentences in the article)
@@ -443,7 +588,7 @@ class Article:
         """ Prepare the article for display.
             If it's not already tokenized and parsed, do it now. """
         with SessionContext(enclosing_session, commit=True) as session:
-            if self._tree is None or self._tokens is None:
+            if self._packed is None and (self._tree is None or self._tokens is None):
                 if reload_parser:
                     # We need a parse: Make sure we're using the newest grammar
                     self.reload_parser()
@@ -511,28 +656,50 @@ class Article:
     def html(self):
         return self._html
 
+    @property
+    def unchanged(self):
+        """ True if a re-scrape found the article content unchanged """
+        return self._unchanged
+
     @property
     def tree(self):
+        if self._tree is None and self._packed is not None:
+            self._tree = unpack_tree(self._packed)
         return self._tree
 
     @property
     def tokens(self):
+        if self._tokens is None and self._packed is not None:
+            self._tokens = unpack_tokens_json(self._packed)
         return self._tokens
 
     @property
     def num_tokens(self):
         """ Count the tokens in the article and cache the result """
         if self._num_tokens is None:
-            if self._raw_tokens is None and self._tokens:
-                self._raw_tokens = json.loads(self._tokens)
+            if self._raw_tokens is None and not self._tokens and self._packed:
+                # The packed format knows its token count without decoding
+                self._num_tokens = PackedArticle(self._packed).num_tokens
+                return self._num_tokens
+            raw_tokens = self._get_raw_tokens()
             cnt = 0
-            if self._raw_tokens:
-                for p in self._raw_tokens:
+            if raw_tokens:
+                for p in raw_tokens:
                     for sent in p:
                         cnt += len(sent)
             self._num_tokens = cnt
         return self._num_tokens
 
+    @staticmethod
+    def _row_sentences(a):
+        """ Generate the token lists of the sentences of an article row,
+            which may be stored in either the text or the packed format """
+        if a.tokens:
+            for pg in json.loads(a.tokens):
+                yield from pg
+        elif a.packed is not None:
+            yield from PackedArticle(a.packed).sentence_tokens()
+
     @staticmethod
     def token_stream(limit=None, skip_errors=True):
         """ Generator of a token stream consisting of `limit` sentences
@@ -541,30 +708,33 @@ class Article:
         with SessionContext(commit=True, read_only=True) as session:
 
             q = (
-                session.query(ArticleRow.url, ArticleRow.parsed, ArticleRow.tokens)
-                .filter(ArticleRow.tokens != None)
+                session.query(
+                    ArticleRow.url,
+                    ArticleRow.parsed,
+                    ArticleRow.tokens,
+                    ArticleRow.packed,
+                )
+                .filter(ArticleRow.has_tree)
                 .order_by(desc(ArticleRow.parsed))
                 .yield_per(200)
             )
 
             count = 0
             for a in q:
-                doc = json.loads(a.tokens)
-                for pg in doc:
-                    for sent in pg:
-                        if not sent:
-                            continue
-                        if skip_errors and any("err" in t for t in sent):
-                            # Skip error sentences
-                            continue
-                        for t in sent:
-                            # Yield the tokens
-                            yield t
-                        yield None  # End-of-sentence marker
-                        # Are we done?
-                        count += 1
-                        if limit is not None and count >= limit:
-                            return
+                for sent in Article._row_sentences(a):
+                    if not sent:
+                        continue
+                    if skip_errors and any("err" in t for t in sent):
+                        # Skip error sentences
+                        continue
+                    for t in sent:
+                        # Yield the tokens
+                        yield t
+                    yield None  # End-of-sentence marker
+                    # Are we done?
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
 
     @staticmethod
     def sentence_stream(limit=None, skip=None, skip_errors=True):
@@ -574,8 +744,13 @@ class Article:
         with SessionContext(commit=True, read_only=True) as session:
 
             q = (
-                session.query(ArticleRow.url, ArticleRow.parsed, ArticleRow.tokens)
-                .filter(ArticleRow.tokens != None)
+                session.query(
+                    ArticleRow.url,
+                    ArticleRow.parsed,
+                    ArticleRow.tokens,
+                    ArticleRow.packed,
+                )
+                .filter(ArticleRow.has_tree)
                 .order_by(desc(ArticleRow.parsed))
                 .yield_per(200)
             )
@@ -583,25 +758,23 @@ class Article:
             count = 0
             skipped = 0
             for a in q:
-                doc = json.loads(a.tokens)
-                for pg in doc:
-                    for sent in pg:
-                        if not sent:
-                            continue
-                        if skip_errors and any("err" in t for t in sent):
-                            # Skip error sentences
-                            continue
-                        if skip is not None and skipped < skip:
-                            # If requested, skip sentences from the front
-                            # (useful for test set)
-                            skipped += 1
-                            continue
-                        # Yield the sentence as a fresh token list
-                        yield [t for t in sent]
-                        # Are we done?
-                        count += 1
-                        if limit is not None and count >= limit:
-                            return
+                for sent in Article._row_sentences(a):
+                    if not sent:
+                        continue
+                    if skip_errors and any("err" in t for t in sent):
+                        # Skip error sentences
+                        continue
+                    if skip is not None and skipped < skip:
+                        # If requested, skip sentences from the front
+                        # (useful for test set)
+                        skipped += 1
+                        continue
+                    # Yield the sentence as a fresh token list
+                    yield [t for t in sent]
+                    # Are we done?
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
 
     @classmethod
     def articles(cls, criteria, enclosing_session=None):
@@ -615,7 +788,7 @@ class Article:
         ) as session:
 
             # Only fetch articles that have a parse tree
-            q = session.query(ArticleRow).filter(ArticleRow.tree != None)
+            q = session.query(ArticleRow).filter(ArticleRow.has_tree)
 
             # timestamp is assumed to contain a tuple: (from, to)
             if criteria and "timestamp" in criteria:
@@ -23,9 +23,10 @@
 
 """
 
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from sqlalchemy import create_engine  # type: ignore
+import time
+from sqlalchemy import create_engine, Sequence  # type: ignore
 from sqlalchemy.orm import sessionmaker  # type: ignore
 
 from settings import Settings, ConfigError
@@ -57,9 +58,19 @@ class Scraper_DB:
         )
 
         # Create engine and bind session
-        self._engine = create_engine(conn_str)
+        self._engine = create_engine(conn_str, **self.pool_args())
         self._Session = sessionmaker(bind=self._engine)
 
+    @staticmethod
+    def pool_args() -> Dict[str, int]:
+        """ Return the connection pool arguments for the engine. Each
+            scraper fetch thread holds a session while it scrapes an
+            article, besides the session of the scraping pass itself,
+            so the pool must have room for all of them at once. """
+        return dict(
+            pool_size=max(5, (Settings.FETCH_THREADS or 1) + 1), max_overflow=10
+        )
+
     def create_tables(self):
         """ Create all missing tables in the database """
         Base.metadata.create_all(self._engine)
@@ -68,6 +79,12 @@ class Scraper_DB:
         """ Execute raw SQL directly on the engine """
         return self._engine.execute(sql, **kwargs)
 
+    def dispose(self):
+        """ Close the pooled connections of the engine. This must be done
+            before forking a process that uses the database, since the
+            child would otherwise inherit the connections' sockets. """
+        self._engine.dispose()
+
     @property
     def session(self):
         """ Returns a freshly created Session instance from the sessionmaker """
@@ -101,6 +118,13 @@ class SessionContext:
         """ Clean up the reference to the singleton Scraper_DB instance """
         cls._db = None
 
+    @classmethod
+    def dispose(cls) -> None:
+        """ Close the pooled connections of the singleton Scraper_DB
+            instance, if it has been created """
+        if cls._db is not None:
+            cls._db.dispose()
+
     def __init__(self, session=None, commit: bool=False, read_only: bool=False) -> None:
 
         if session is None:
@@ -113,6 +137,8 @@ class SessionContext:
             if read_only:
                 # Set the transaction as read only, which can save resources
                 self._session.execute("SET TRANSACTION READ ONLY")
+                # Let callers (such as the parse cache) know not to write
+                self._session.info["read_only"] = True
                 self._commit = True
             else:
                 self._commit = commit
@@ -139,3 +165,72 @@ class SessionContext:
             self._session.close()
         # Return False to re-throw exception from the context, if any
         return False
+
+
+class BulkWriter:
+
+    """ Collects rows to be inserted into database tables and writes
+        them with multi-row INSERT ... VALUES statements when flushed,
+        instead of one INSERT per row as session.add() does. The number
+        of rows written and the time spent writing them are accumulated
+        for throughput reporting. """
+
+    # Maximum number of rows in a single INSERT statement
+    MAX_ROWS = 1000
+
+    def __init__(self, session) -> None:
+        self._session = session
+        # Pending rows by table class and column names
+        self._pending: Dict[Tuple[Any, Tuple[str, ...]], List[Dict[str, Any]]] = {}
+        self.rows = 0
+        self.seconds = 0.0
+
+    def add(self, model, **values: Any) -> None:
+        """ Add a row with the given column values to the table
+            of the given model class """
+        key = (model, tuple(sorted(values)))
+        self._pending.setdefault(key, []).append(values)
+
+    def __len__(self) -> int:
+        """ Return the number of rows that have not yet been written """
+        return sum(len(rows) for rows in self._pending.values())
+
+    def flush(self) -> int:
+        """ Write all pending rows to the database, returning their number """
+        if not self._pending:
+            return 0
+        t0 = time.time()
+        # Make sure that pending ORM changes, such as rows that the new
+        # rows refer to, reach the database first
+        self._session.flush()
+        count = 0
+        for (model, columns), rows in self._pending.items():
+            table = model.table()
+            # In a multi-row INSERT, SQLAlchemy only renders the first row's
+            # sequence default inline and fetches the others with a separate
+            # query per row, so the next sequence values are put into each
+            # row as SQL expressions instead
+            sequences = {
+                c.name: c.default.next_value()
+                for c in table.columns
+                if isinstance(c.default, Sequence) and c.name not in columns
+            }
+            for i in range(0, len(rows), self.MAX_ROWS):
+                chunk = rows[i : i + self.MAX_ROWS]
+                if sequences:
+                    chunk = [dict(row, **sequences) for row in chunk]
+                self._session.execute(table.insert().values(chunk))
+                count += len(chunk)
+        self._pending = {}
+        self.rows += count
+        self.seconds += time.time() - t0
+        return count
+
+    def clear(self) -> None:
+        """ Discard all pending rows """
+        self._pending = {}
+
+    @property
+    def rows_per_second(self) -> float:
+        """ Return the write throughput so far """
+        return self.rows / self.seconds if self.seconds > 0.0 else 0.0
@@ -39,7 +39,9 @@ from sqlalchemy import (
     Index,
     ForeignKey,
     PrimaryKeyConstraint,
+    LargeBinary,
     func,
+    or_,
 )
 from sqlalchemy.dialects.postgresql import JSONB, INET  # type: ignore
 from sqlalchemy.dialects.postgresql import UUID as psql_UUID
@@ -94,6 +96,10 @@ class Root(Base):
     visible = Column(Boolean, default=True)
     # Should articles of this root be scraped automatically?
     scrape = Column(Boolean, default=True)
+    # HTTP cache validators and content hashes from the last fetch of the
+    # root page and/or its RSS feeds, as a JSON object keyed by URL:
+    # { url: { "etag": ..., "last_modified": ..., "hash": ... } }
+    validators = Column(JSONB)
 
     # The combination of domain + url must be unique
     __table_args__ = (UniqueConstraint("domain", "url"),)
@@ -160,15 +166,49 @@ class Article(Base):
     num_parsed = Column(Integer)
     ambiguity = Column(Float)
 
+    # HTTP cache validators from the last scrape, if sent by the server
+    etag = Column(String(256))
+    last_modified = Column(String(64))
+    # SHA-256 hash (hex) of the normalized text content of the last scrape
+    content_hash = Column(String(64))
+
     # The HTML obtained in the last scrape
     html = Column(String)
     # The parse tree obtained in the last parse
     tree = Column(String)
     # The tokens of the article in JSON string format
     tokens = Column(String)
-    # The article topic vector as an array of floats in JSON string format
+    # The parse tree and tokens in the compact binary format of treepack.py,
+    # used instead of the tree and tokens columns if PACKED_ARTICLES is set
+    packed = Column(LargeBinary)
+
+    @hybrid_property
+    def has_tree(self):
+        """ True if the article has been parsed, in either storage format """
+        return self.tree is not None or self.packed is not None
+
+    # pylint: disable=no-self-argument
+    @has_tree.expression  # type: ignore
+    def has_tree(cls):
+        return or_(cls.tree != None, cls.packed != None)
+
+    # The article topic vector as an array of floats in JSON string format.
+    # Superseded by topic_vector_bin, but still read if that is NULL.
     topic_vector = Column(String)
 
+    # The article topic vector as an array of little-endian float32 values
+    topic_vector_bin = Column(LargeBinary)
+
+    @hybrid_property
+    def has_topic_vector(self):
+        """ True if the article has a topic vector, in either format """
+        return self.topic_vector_bin is not None or self.topic_vector is not None
+
+    # pylint: disable=no-self-argument
+    @has_topic_vector.expression  # type: ignore
+    def has_topic_vector(cls):
+        return or_(cls.topic_vector_bin != None, cls.topic_vector != None)
+
     # The back-reference to the Root parent of this Article
     root = relationship(
         "Root",
@@ -520,6 +560,46 @@ class Link(Base):
         )
 
 
+class CachedParse(Base):
+    """ Represents a cached parse result for a sentence,
+        keyed by a hash of its tokens and the parser version
+        (see parsecache.py) """
+
+    __tablename__ = "parsecache"
+
+    # SHA-256 hash (hex) of the token sequence, parser version and result kind
+    key = Column(String(64), primary_key=True)
+
+    # The cached result, in JSON format
+    content = Column(String, nullable=False)
+
+    # Time of last use, for least-recently-used eviction
+    timestamp = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "CachedParse(key='{0}', ts='{1}')".format(self.key, self.timestamp)
+
+
+class CachedLocation(Base):
+    """ Represents a cached resolution of a location name,
+        keyed by a hash of the name, kind, placename hints and
+        the version of the geography resources (see locationcache.py) """
+
+    __tablename__ = "locationcache"
+
+    # SHA-256 hash (hex) of the name, kind, hints and resource version
+    key = Column(String(64), primary_key=True)
+
+    # The location info, in JSON format
+    content = Column(String, nullable=False)
+
+    # Time of last use, for least-recently-used eviction
+    timestamp = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "CachedLocation(key='{0}', ts='{1}')".format(self.key, self.timestamp)
+
+
 class BlacklistedLink(Base):
     """ Represents a link blacklisted for a particular key """
 
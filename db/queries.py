@@ -197,11 +197,12 @@ class RelatedWordsQuery(_BaseQuery):
 
 class TermTopicsQuery(_BaseQuery):
     """ A query for topic vectors of documents where a given (stem, cat)
-        tuple appears. We return the newest articles first, in case the
-        query result is limited by a specified limit. """
+        tuple appears, in binary and (for older articles) JSON format.
+        We return the newest articles first, in case the query result
+        is limited by a specified limit. """
 
     _Q = """
-        select topic_vector, q.cnt
+        select topic_vector_bin, topic_vector, q.cnt
             from (
                 select a.id as id, sum(w.cnt) as cnt
                 from articles a, words w
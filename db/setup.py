@@ -209,6 +209,30 @@ ROOTS = [
 ]
 
 
+# Columns that have been added to existing tables after their creation.
+# These are added by init_roots() if missing, since create_tables()
+# only creates tables that don't already exist.
+COLUMN_UPGRADES = [
+    # Table, column, type
+    ("roots", "validators", "jsonb"),
+    ("articles", "etag", "varchar(256)"),
+    ("articles", "last_modified", "varchar(64)"),
+    ("articles", "content_hash", "varchar(64)"),
+    ("articles", "packed", "bytea"),
+    ("articles", "topic_vector_bin", "bytea"),
+]
+
+
+def upgrade_tables(db):
+    """ Add any missing columns to existing tables """
+    for table, column, coltype in COLUMN_UPGRADES:
+        db.execute(
+            "alter table {0} add column if not exists {1} {2};".format(
+                table, column, coltype
+            )
+        )
+
+
 def init_roots(wait=False):
     """ Create tables and initialize the scraping roots, if not already present.
         If wait = True, repeated attempts are made to connect to the database
@@ -226,6 +250,7 @@ def init_roots(wait=False):
             db = SessionContext.db
             # pylint: disable=no-member
             db.create_tables()
+            upgrade_tables(db)
 
             with SessionContext() as session:
                 for (
@@ -23,14 +23,21 @@
 
 """
 
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 from types import ModuleType
 
+import os
 import re
+import time
+import hashlib
 import importlib
 import logging
+import threading
+from collections import defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry  # type: ignore
 import urllib.parse as urlparse
 from urllib.error import HTTPError
 
@@ -40,12 +47,159 @@ from reynir import tokenize
 from nertokenizer import recognize_entities
 from db import SessionContext
 from db.models import Root, Article as ArticleRow
+from settings import Settings
 
 # The HTML parser to use with BeautifulSoup
 # _HTML_PARSER = "html5lib"
 _HTML_PARSER = "html.parser"
 
 
+class HttpPool:
+
+    """ A process-wide pool of keep-alive HTTP(S) connections, shared by
+        all fetching threads within a scraper process. The pool enforces
+        a limit on concurrent requests per domain, applies timeouts and
+        retries, and collects fetch latency statistics per domain. """
+
+    # HTTP status codes that are worth retrying
+    _RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        domain_concurrency: Optional[int] = None,
+        pool_size: Optional[int] = None,
+    ) -> None:
+        self._timeout = Settings.FETCH_TIMEOUT if timeout is None else timeout
+        retries = Settings.FETCH_RETRIES if retries is None else retries
+        self._domain_concurrency = (
+            domain_concurrency or Settings.FETCH_DOMAIN_CONCURRENCY or 1
+        )
+        pool_size = pool_size or Settings.FETCH_THREADS or 1
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            # Number of per-host connection pools to keep
+            pool_connections=64,
+            # Maximum number of keep-alive connections per host
+            pool_maxsize=max(pool_size, self._domain_concurrency),
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=retries,
+                status=retries,
+                backoff_factor=0.5,
+                status_forcelist=self._RETRY_STATUSES,
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        # Semaphores limiting concurrent requests, by domain (netloc)
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = dict()
+        # Fetch latency statistics by domain: [count, errors, total, max]
+        self._stats: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0, 0.0])
+
+    def _semaphore(self, domain: str) -> threading.BoundedSemaphore:
+        """ Return the concurrency-limiting semaphore for a domain """
+        with self._lock:
+            sem = self._semaphores.get(domain)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self._domain_concurrency)
+                self._semaphores[domain] = sem
+            return sem
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None):
+        """ Issue a GET request for the given URL, waiting if the
+            domain already has the maximum number of requests in flight.
+            Returns a requests.Response object or raises an exception. """
+        domain = urlparse.urlsplit(url).netloc
+        ok = False
+        with self._semaphore(domain):
+            t0 = time.time()
+            try:
+                r = self._session.get(url, headers=headers, timeout=self._timeout)
+                ok = True
+                return r
+            finally:
+                elapsed = time.time() - t0
+                with self._lock:
+                    st = self._stats[domain]
+                    st[0] += 1
+                    if not ok:
+                        st[1] += 1
+                    st[2] += elapsed
+                    st[3] = max(st[3], elapsed)
+
+    def stats(self) -> Dict[str, Tuple[int, int, float, float]]:
+        """ Return a snapshot of the fetch statistics, as a dict of
+            domain -> (count, errors, total seconds, max seconds) """
+        with self._lock:
+            return {d: (int(c), int(e), t, m) for d, (c, e, t, m) in self._stats.items()}
+
+    def reset_stats(self) -> None:
+        """ Clear the accumulated fetch statistics """
+        with self._lock:
+            self._stats.clear()
+
+    @staticmethod
+    def merge_stats(
+        total: Dict[str, List[float]], stats: Dict[str, Tuple[int, int, float, float]]
+    ) -> None:
+        """ Merge a statistics snapshot into an accumulating dict,
+            typically when collecting statistics from several processes """
+        for domain, (c, e, t, m) in stats.items():
+            st = total.setdefault(domain, [0, 0, 0.0, 0.0])
+            st[0] += c
+            st[1] += e
+            st[2] += t
+            st[3] = max(st[3], m)
+
+    @staticmethod
+    def log_stats(stats) -> None:
+        """ Log per-domain fetch latency statistics """
+        for domain in sorted(stats.keys()):
+            c, e, t, m = stats[domain]
+            if c:
+                logging.info(
+                    "Fetched {0:4} URLs from {1:28} errors {2:3}, "
+                    "average {3:.3f} sec, max {4:.3f} sec".format(
+                        int(c), domain, int(e), t / c, m
+                    )
+                )
+
+    def close(self) -> None:
+        """ Close all pooled connections """
+        self._session.close()
+
+
+class FetchResult:
+
+    """ The result of a (possibly conditional) article fetch """
+
+    def __init__(
+        self,
+        html=None,
+        metadata=None,
+        helper=None,
+        content_hash=None,
+        etag=None,
+        last_modified=None,
+        not_modified=False,
+    ):
+        self.html = html
+        self.metadata = metadata
+        self.helper = helper
+        # SHA-256 hash of the normalized text content of the page
+        self.content_hash = content_hash
+        # HTTP cache validators returned by the server, if any
+        self.etag = etag
+        self.last_modified = last_modified
+        # True if the server responded with 304 Not Modified
+        self.not_modified = not_modified
+
+
 class Fetcher:
 
     """ The worker class that scrapes the known roots """
@@ -93,6 +247,13 @@ class Fetcher:
     # Cache of instantiated scrape helpers
     _helpers: Dict[str, ModuleType] = dict()
 
+    # The HTTP connection pool used for fetching, created on demand
+    # (separately in each process, since sockets can't be shared
+    # between forked processes)
+    _http_pool: Optional[HttpPool] = None
+    _http_pool_pid = 0
+    _http_pool_lock = threading.Lock()
+
     def __init__(self):
         """ No instances are supposed to be created of this class """
         assert False
@@ -201,24 +362,76 @@ class Fetcher:
         token_stream = tokenize(text)
         return recognize_entities(token_stream, enclosing_session=enclosing_session)
 
+    @classmethod
+    def http_pool(cls) -> HttpPool:
+        """ Return the HTTP connection pool for this process """
+        with cls._http_pool_lock:
+            pid = os.getpid()
+            if cls._http_pool is None or cls._http_pool_pid != pid:
+                # No pool yet, or a pool inherited from a parent process
+                cls._http_pool = HttpPool()
+                cls._http_pool_pid = pid
+            return cls._http_pool
+
+    @classmethod
+    def close_http_pool(cls) -> None:
+        """ Close the HTTP connection pool, if any """
+        with cls._http_pool_lock:
+            if cls._http_pool is not None:
+                cls._http_pool.close()
+                cls._http_pool = None
+
+    @staticmethod
+    def conditional_headers(
+        etag: Optional[str] = None, last_modified: Optional[str] = None
+    ) -> Optional[Dict[str, str]]:
+        """ Return HTTP headers for a conditional request, given the
+            validators from a previous fetch of a URL, or None if
+            there are no validators """
+        headers = dict()
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers or None
+
     @classmethod
     def raw_fetch_url(cls, url):
         """ Low-level fetch of an URL, returning a decoded string """
+        html_doc, _, _, _ = cls.conditional_fetch_url(url)
+        return html_doc
+
+    @classmethod
+    def conditional_fetch_url(cls, url, etag=None, last_modified=None):
+        """ Low-level fetch of an URL, sending If-None-Match and
+            If-Modified-Since headers if validators from a previous fetch
+            are given. Returns a tuple (html, etag, last_modified, not_modified)
+            where html is a decoded string, or None if the document was not
+            modified or an error occurred. """
         html_doc = None
+        headers = cls.conditional_headers(etag, last_modified)
         try:
 
-            # Normal external HTTP/HTTPS fetch
-            r = requests.get(url)
+            # Normal external HTTP/HTTPS fetch, via the connection pool
+            r = cls.http_pool().get(url, headers=headers)
             if r is None:
                 logging.warning("No document returned for URL {0}".format(url))
-                return None
+                return (None, None, None, False)
             # pylint: disable=no-member
+            if r.status_code == requests.codes.not_modified:
+                # The server confirms that our stored copy is still valid
+                return (None, etag, last_modified, True)
             if r.status_code == requests.codes.ok:
                 html_doc = r.text
-            else:
-                logging.warning(
-                    "HTTP status {0} for URL {1}".format(r.status_code, url)
+                return (
+                    html_doc,
+                    r.headers.get("ETag"),
+                    r.headers.get("Last-Modified"),
+                    False,
                 )
+            logging.warning(
+                "HTTP status {0} for URL {1}".format(r.status_code, url)
+            )
 
         except requests.exceptions.ConnectionError as e:
             logging.error("ConnectionError: {0} for URL {1}".format(e, url))
@@ -226,6 +439,12 @@ class Fetcher:
         except requests.exceptions.ChunkedEncodingError as e:
             logging.error("ChunkedEncodingError: {0} for URL {1}".format(e, url))
             html_doc = None
+        except requests.exceptions.Timeout as e:
+            logging.error("Timeout: {0} for URL {1}".format(e, url))
+            html_doc = None
+        except requests.exceptions.RetryError as e:
+            logging.error("RetryError: {0} for URL {1}".format(e, url))
+            html_doc = None
         except HTTPError as e:
             logging.error("HTTPError: {0} for URL {1}".format(e, url))
             html_doc = None
@@ -235,7 +454,18 @@ class Fetcher:
         except UnicodeDecodeError as e:
             logging.error("Exception when decoding HTML of {0}: {1}".format(url, e))
             html_doc = None
-        return html_doc
+        return (html_doc, None, None, False)
+
+    @staticmethod
+    def content_hash(content):
+        """ Return a hash of the normalized text of a content soup,
+            which is unaffected by changes in markup or whitespace """
+        if content is None:
+            return None
+        tlist = Fetcher.TextList()
+        Fetcher.extract_text(content, tlist)
+        text = tlist.result().strip()
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
     @classmethod
     def _get_helper(cls, root):
@@ -439,6 +669,17 @@ class Fetcher:
     def fetch_url_html(cls, url, enclosing_session=None):
         """ Fetch a URL using the scraping mechanism, returning
             a tuple (html, metadata, helper) or None if error """
+        fr = cls.fetch_article_html(url, enclosing_session)
+        return (fr.html, fr.metadata, fr.helper)
+
+    @classmethod
+    def fetch_article_html(
+        cls, url, enclosing_session=None, etag=None, last_modified=None
+    ):
+        """ Fetch a URL using the scraping mechanism, returning a FetchResult.
+            If cache validators from a previous fetch are given, a conditional
+            request is made, and the result has not_modified set if the
+            server reports that the document is unchanged. """
 
         with SessionContext(enclosing_session) as session:
 
@@ -446,20 +687,38 @@ class Fetcher:
 
             if helper is None or not hasattr(helper, "fetch_url"):
                 # Do a straight HTTP fetch
-                html_doc = cls.raw_fetch_url(url)
+                html_doc, etag, last_modified, not_modified = cls.conditional_fetch_url(
+                    url, etag, last_modified
+                )
+                if not_modified:
+                    return FetchResult(
+                        helper=helper,
+                        etag=etag,
+                        last_modified=last_modified,
+                        not_modified=True,
+                    )
             else:
                 # Hand off to the helper
                 html_doc = helper.fetch_url(url)
+                etag = last_modified = None
 
             if not html_doc:
-                return (None, None, None)
+                return FetchResult()
 
             # Parse the HTML
             soup = Fetcher.make_soup(html_doc, helper)
             if soup is None:
-                logging.warning("Fetcher.fetch_url_html({0}): No soup".format(url))
-                return (None, None, None)
+                logging.warning("Fetcher.fetch_article_html({0}): No soup".format(url))
+                return FetchResult()
 
-            # Obtain the metadata from the resulting soup
+            # Obtain the metadata and a hash of the text content from the soup
             metadata = helper.get_metadata(soup) if helper else None
-            return (html_doc, metadata, helper)
+            content = helper.get_content(soup) if helper else soup.html.body
+            return FetchResult(
+                html=html_doc,
+                metadata=metadata,
+                helper=helper,
+                content_hash=cls.content_hash(content),
+                etag=etag,
+                last_modified=last_modified,
+            )
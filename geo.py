@@ -24,13 +24,25 @@
 # corresponding country code, e.g. "Norður-Ítalía" -> "IT"
 # TODO: Most of this stuff should go into its own module, iceloc or something
 
-from typing import Optional, Dict, Union, Tuple, List, Any
+from typing import (
+    Optional,
+    Dict,
+    Union,
+    Tuple,
+    List,
+    Any,
+    Generic,
+    Sequence,
+    TypeVar,
+)
 
 import json
 import re
 import sys
 import os
 import math
+import heapq
+import numpy as np  # type: ignore
 from iceaddr import iceaddr_lookup, placename_lookup  # type: ignore
 from cityloc import city_lookup  # type: ignore
 from country_list import countries_for_language, available_languages  # type: ignore
@@ -833,6 +845,147 @@ def distance(loc1: LatLonTuple, loc2: LatLonTuple) -> float:
     return _EARTH_RADIUS * c
 
 
+def _unit_vectors(lats: Any, lons: Any) -> np.ndarray:
+    """ Convert latitudes and longitudes to an (n, 3) array
+        of points on the unit sphere """
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    clat = np.cos(lat)
+    return np.stack((clat * np.cos(lon), clat * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+T = TypeVar("T")
+
+
+class SpatialIndex(Generic[T]):
+
+    """ A static spatial index of items at given locations, supporting
+        queries for the k nearest items to a location and for the items
+        within a radius of a location. The locations are stored as points
+        on the unit sphere in a k-d tree with bounding boxes, and the
+        straight-line (chord) distance between points is used for the
+        search, since it grows with the great-circle distance. Points in
+        the leaves are examined in batches with NumPy. """
+
+    # Maximum number of points in a leaf of the tree
+    _LEAF_SIZE = 16
+
+    def __init__(
+        self, locations: Sequence[LatLonTuple], items: Optional[Sequence[T]] = None
+    ) -> None:
+        n = len(locations)
+        if items is not None and len(items) != n:
+            raise ValueError("There must be one item for each location")
+        coords = np.asarray(locations, dtype=np.float64).reshape(n, 2)
+        self._items: List[Any] = list(items) if items is not None else list(range(n))
+        points = _unit_vectors(coords[:, 0], coords[:, 1])
+        # The tree nodes are stored in lists: the bounding box of the points
+        # within the node, the index range of those points in the reordered
+        # point array, and the indices of the child nodes (-1 for leaves)
+        self._lo: List[np.ndarray] = []
+        self._hi: List[np.ndarray] = []
+        self._range: List[Tuple[int, int]] = []
+        self._children: List[Tuple[int, int]] = []
+        self._order = np.arange(n)
+        if n:
+            self._build(points, 0, n)
+        self._points = points[self._order]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _build(self, points: np.ndarray, start: int, end: int) -> int:
+        """ Build the subtree for the points at self._order[start:end],
+            returning the index of its root node """
+        ix = self._order[start:end]
+        p = points[ix]
+        node = len(self._range)
+        lo, hi = p.min(axis=0), p.max(axis=0)
+        self._lo.append(lo)
+        self._hi.append(hi)
+        self._range.append((start, end))
+        self._children.append((-1, -1))
+        if end - start > self._LEAF_SIZE:
+            # Split at the median along the axis of greatest extent
+            axis = int(np.argmax(hi - lo))
+            mid = (end - start) // 2
+            self._order[start:end] = ix[np.argpartition(p[:, axis], mid)]
+            left = self._build(points, start, start + mid)
+            right = self._build(points, start + mid, end)
+            self._children[node] = (left, right)
+        return node
+
+    def _box_dist2(self, node: int, q: np.ndarray) -> float:
+        """ Squared distance from a point to the bounding box of a node """
+        d = np.maximum(self._lo[node] - q, 0.0) + np.maximum(q - self._hi[node], 0.0)
+        return float(d @ d)
+
+    @staticmethod
+    def _km(chord2: float) -> float:
+        """ Convert a squared chord length to a great-circle distance in km """
+        return 2 * _EARTH_RADIUS * math.asin(min(math.sqrt(chord2) / 2, 1.0))
+
+    def nearest(self, loc: LatLonTuple, k: int = 1) -> List[Tuple[T, float]]:
+        """ Return the k items nearest to the location, as a list of
+            (item, distance in km) tuples in order of increasing distance """
+        if k < 1 or not self._range:
+            return []
+        q = _unit_vectors(loc[0], loc[1])
+        # Max-heap (by negated distance) of the best candidates found so far
+        best: List[Tuple[float, int]] = []
+        # Min-heap of nodes to visit, by distance to their bounding box
+        todo = [(self._box_dist2(0, q), 0)]
+        while todo:
+            d2, node = heapq.heappop(todo)
+            if len(best) == k and d2 >= -best[0][0]:
+                # No closer points remain
+                break
+            left, right = self._children[node]
+            if left >= 0:
+                heapq.heappush(todo, (self._box_dist2(left, q), left))
+                heapq.heappush(todo, (self._box_dist2(right, q), right))
+                continue
+            start, end = self._range[node]
+            diff = self._points[start:end] - q
+            for i, pd2 in zip(range(start, end), np.einsum("ij,ij->i", diff, diff)):
+                if len(best) < k:
+                    heapq.heappush(best, (-pd2, i))
+                elif pd2 < -best[0][0]:
+                    heapq.heapreplace(best, (-pd2, i))
+        return [
+            (self._items[self._order[i]], self._km(-neg_d2))
+            for neg_d2, i in sorted(best, reverse=True)
+        ]
+
+    def within(self, loc: LatLonTuple, radius_km: float) -> List[Tuple[T, float]]:
+        """ Return the items within the given radius (in km) of the location,
+            as a list of (item, distance in km) tuples in order of
+            increasing distance """
+        if radius_km < 0 or not self._range:
+            return []
+        q = _unit_vectors(loc[0], loc[1])
+        # The chord length corresponding to the radius
+        chord = 2 * math.sin(min(radius_km / _EARTH_RADIUS, math.pi) / 2)
+        r2 = chord * chord
+        found: List[Tuple[float, int]] = []
+        todo = [0]
+        while todo:
+            node = todo.pop()
+            if self._box_dist2(node, q) > r2:
+                continue
+            left, right = self._children[node]
+            if left >= 0:
+                todo.append(left)
+                todo.append(right)
+                continue
+            start, end = self._range[node]
+            diff = self._points[start:end] - q
+            d2 = np.einsum("ij,ij->i", diff, diff)
+            found.extend((float(d2[i]), start + i) for i in np.nonzero(d2 <= r2)[0])
+        found.sort()
+        return [(self._items[self._order[i]], self._km(d2)) for d2, i in found]
+
+
 ICELAND_COORDS = (64.9957538607, -18.5739616708)
 
 
@@ -0,0 +1,177 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Location resolution cache
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module implements a cache of location resolutions, i.e. of the
+    results of geo.location_info(), keyed by the location name and kind,
+    the placename hints (where they matter) and a version signature of
+    the geography resources: geo.py itself, its data files and the
+    gazetteer packages it uses. When any of those change, the keys
+    change, and stale entries are eventually evicted.
+
+    The same few thousand place names occur again and again across the
+    article archive, so the locations processor resolves most of them
+    from the cache. The cache has the same two levels as the parse cache:
+    an in-process LRU dictionary, and a persistent table in the scraper
+    database (locationcache) that is shared between processor workers.
+
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import os
+import glob
+import hashlib
+import threading
+from collections import OrderedDict
+
+from settings import Settings
+from parsecache import ParseCache
+from geo import location_info, ALWAYS_STREET_ADDR
+
+
+# Location kinds whose resolution depends on the placename hints
+_HINTED_KINDS = frozenset(("address", "street"))
+
+# Packages providing the gazetteers used by geo.py
+_GEO_PACKAGES = ("iceaddr", "cityloc", "country-list")
+
+_GEO_VERSION: Optional[str] = None
+
+
+def _package_version(name: str) -> str:
+    """ Return the installed version of a package, or an empty string """
+    try:
+        from importlib.metadata import version  # Python 3.8+
+    except ImportError:
+        from pkg_resources import get_distribution
+
+        def version(name: str) -> str:
+            return get_distribution(name).version
+
+    try:
+        return version(name)
+    except Exception:
+        # Not installed as a distribution, or unable to tell
+        return ""
+
+
+def geo_version() -> str:
+    """ Return a version signature of the geography resources """
+    global _GEO_VERSION
+    if _GEO_VERSION is None:
+        import geo
+
+        h = hashlib.sha256()
+        for name in _GEO_PACKAGES:
+            h.update("{0}={1}\x1f".format(name, _package_version(name)).encode())
+        resources = os.path.join(os.path.dirname(geo.__file__), "resources", "geo")
+        for path in [geo.__file__] + sorted(glob.glob(os.path.join(resources, "*"))):
+            with open(path, "rb") as f:
+                h.update(f.read())
+        _GEO_VERSION = h.hexdigest()[:16]
+    return _GEO_VERSION
+
+
+class LocationCache(ParseCache):
+
+    """ A process-wide, two-level cache of location resolutions,
+        with lookups and stores done in batches, one of each per article """
+
+    _lock = threading.Lock()
+    _lru: "OrderedDict[str, str]" = OrderedDict()
+    _counters: Dict[str, int] = dict(mem_hits=0, db_hits=0, misses=0, stores=0)
+    _puts_since_trim = 0
+    _db_retry_at = 0.0
+    _db_backoff = 0.0
+
+    _NAME = "Location cache"
+
+    _TRIM_SQL = """
+        delete from locationcache where timestamp < (
+            select timestamp from locationcache
+                order by timestamp desc offset :n limit 1
+        );
+        """
+
+    _SELECT_SQL = "select key, content from locationcache where key = any(:keys);"
+
+    _TOUCH_SQL = """
+        update locationcache set timestamp = :ts
+            where key = any(:keys) and timestamp < :ts - interval '1 day';
+        """
+
+    _UPSERT_SQL = """
+        insert into locationcache as lc (key, content, timestamp)
+            values {0}
+            on conflict (key)
+            do update set content = excluded.content, timestamp = excluded.timestamp;
+        """
+
+    @staticmethod
+    def _max_size() -> int:
+        return Settings.LOCATION_CACHE_SIZE
+
+    @staticmethod
+    def _max_db_rows() -> int:
+        return Settings.LOCATION_CACHE_DB_ROWS
+
+    @staticmethod
+    def key(  # type: ignore
+        name: str, kind: Optional[str], placename_hints: Iterable[str] = ()
+    ) -> str:
+        """ Return a cache key for the resolution of a location """
+        if kind in _HINTED_KINDS or name in ALWAYS_STREET_ADDR:
+            # Addresses and streets are disambiguated by the placenames
+            # mentioned along with them; their order doesn't matter
+            hints = "\x1e".join(sorted(set(placename_hints)))
+        else:
+            hints = ""
+        h = hashlib.sha256()
+        h.update(
+            "{0}\x1d{1}\x1d{2}\x1d{3}".format(
+                geo_version(), name, kind or "", hints
+            ).encode("utf-8")
+        )
+        return h.hexdigest()
+
+    @classmethod
+    def resolve_many(
+        cls,
+        session,
+        locations: Iterable[Tuple[str, Optional[str]]],
+        placename_hints: Optional[List[str]] = None,
+    ) -> Dict[Tuple[str, Optional[str]], Dict[str, Any]]:
+        """ Return the location info for each (name, kind) tuple,
+            resolving those not found in the cache with
+            geo.location_info() and storing the results """
+        hints = placename_hints or []
+        keys = {loc: cls.key(loc[0], loc[1], hints) for loc in locations}
+        found = cls.get_many(session, keys.values())
+        result: Dict[Tuple[str, Optional[str]], Dict[str, Any]] = dict()
+        resolved: Dict[str, Any] = dict()
+        for loc, key in keys.items():
+            info = found.get(key)
+            if info is None:
+                info = location_info(name=loc[0], kind=loc[1], placename_hints=hints)
+                resolved[key] = info
+            result[loc] = info
+        cls.put_many(session, resolved)
+        return result
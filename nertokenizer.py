@@ -27,12 +27,21 @@
     and is thus not appropriate for inclusion in reynir.bintokenizer,
     as GreynirPackage does not (and should not) require a database to be present.
 
+    The entity names are looked up in a process-wide, in-memory trie
+    (EntityNames), which is loaded from the entities table on first use
+    (or before forking worker processes, which then share it) and
+    refreshed from the table at intervals.
+
 """
 
-from typing import List, Iterator, Dict, Union, Tuple
+from typing import Any, List, Iterator, Dict, Optional, Sequence, Set, Union, Tuple
 
 from collections import defaultdict
+from datetime import datetime, timedelta
+import os
 import logging
+import threading
+import time
 
 from reynir import Abbreviations, TOK, Tok
 from reynir.bindb import BIN_Db
@@ -41,6 +50,134 @@ from db import SessionContext, OperationalError
 from db.models import Entity
 
 
+# A node in the trie of entity names: a dict of child nodes by word,
+# and a list of the entity names that begin with the words on the path
+# from the root to the node
+_Node = List[Any]
+
+
+class EntityNames:
+
+    """ A process-wide trie of the names in the entities table, indexed
+        by the words in each name. Finding the names that begin with a
+        given word (or words) needs no database access. The trie is
+        refreshed incrementally, with the entities added since the last
+        refresh (by timestamp), and rebuilt from scratch now and then to
+        drop names that have been deleted from the table. A rebuilt trie
+        is loaded and built while lookups continue in the current one,
+        and then swapped in. Processes forked after the trie is loaded
+        (such as the parser workers of the scraper) share it and only
+        refresh it, since a rebuild would replace the shared copy. """
+
+    _lock = threading.Lock()
+    # Held by the thread that is querying the database for a refresh
+    _refresh_lock = threading.Lock()
+    _root: Optional[_Node] = None
+    _names: Set[str] = set()
+    # Latest entity timestamp seen
+    _latest: Optional[datetime] = None
+    # Times (in time.monotonic() seconds) of the next refresh and rebuild
+    _next_refresh = 0.0
+    _next_rebuild = 0.0
+    # Id of the process that built the trie
+    _pid = 0
+
+    REFRESH_INTERVAL = 60.0
+    REBUILD_INTERVAL = 3600.0
+    # Entities are written by processor transactions that may commit
+    # some time after their timestamps; refreshes therefore overlap
+    _OVERLAP = timedelta(minutes=10)
+
+    @staticmethod
+    def _add(root: _Node, name: str) -> None:
+        """ Add an entity name to the trie """
+        node = root
+        for word in name.split(" "):
+            child = node[0].get(word)
+            if child is None:
+                child = node[0][word] = [dict(), []]
+            node = child
+            node[1].append(name)
+
+    @classmethod
+    def refresh(cls, enclosing_session=None, force: bool = False) -> None:
+        """ Load new entity names from the database, if the refresh
+            interval has elapsed or force is True """
+        now = time.monotonic()
+        if not force and now < cls._next_refresh:
+            return
+        if cls._root is None:
+            # No trie to fall back on: wait for any load in progress
+            cls._refresh_lock.acquire()
+        elif not cls._refresh_lock.acquire(blocking=False):
+            # Another thread is refreshing: keep using the current trie
+            return
+        try:
+            if not force and now < cls._next_refresh:
+                # Another thread got here first
+                return
+            forked = cls._root is not None and cls._pid != os.getpid()
+            rebuild = cls._root is None or (now >= cls._next_rebuild and not forked)
+            try:
+                with SessionContext(
+                    session=enclosing_session, commit=True, read_only=True
+                ) as session:
+                    q = session.query(Entity.name, Entity.timestamp).filter(
+                        Entity.name != None
+                    )
+                    if not rebuild and cls._latest is not None:
+                        q = q.filter(Entity.timestamp > cls._latest - cls._OVERLAP)
+                    rows = q.all()
+            except OperationalError as e:
+                logging.warning("SQL error in EntityNames.refresh(): {0}".format(e))
+                rows = []
+                rebuild = cls._root is None
+            if rebuild:
+                # Build a new trie, to be swapped in when complete
+                root: _Node = [dict(), []]
+                names: Set[str] = set()
+                latest = None
+            else:
+                # Add the new names to the current trie in place
+                assert cls._root is not None
+                root, names, latest = cls._root, cls._names, cls._latest
+            for name, ts in rows:
+                if name and name not in names:
+                    names.add(name)
+                    cls._add(root, name)
+                if ts is not None and (latest is None or ts > latest):
+                    latest = ts
+            with cls._lock:
+                cls._root, cls._names, cls._latest = root, names, latest
+                if rebuild:
+                    cls._pid = os.getpid()
+                    cls._next_rebuild = now + cls.REBUILD_INTERVAL
+                cls._next_refresh = now + cls.REFRESH_INTERVAL
+        finally:
+            cls._refresh_lock.release()
+
+    @classmethod
+    def lookup(cls, w: str, enclosing_session=None) -> Sequence[str]:
+        """ Return the entity names that are equal to w or begin
+            with w followed by further words """
+        cls.refresh(enclosing_session)
+        node = cls._root
+        for word in w.split(" "):
+            if node is None:
+                return ()
+            node = node[0].get(word)
+        return node[1] if node is not None else ()
+
+    @classmethod
+    def clear(cls) -> None:
+        """ Drop the trie, so that it is reloaded on next use """
+        with cls._lock:
+            cls._root = None
+            cls._names = set()
+            cls._latest = None
+            cls._next_refresh = cls._next_rebuild = 0.0
+
+
 def recognize_entities(
     token_stream: Iterator[Tok], enclosing_session=None, token_ctor=TOK
 ) -> Iterator[Tok]:
@@ -58,36 +195,15 @@ def recognize_entities(
     # Phrases we're considering. Note that an entry of None
     # indicates that the accumulated phrase so far is a complete
     # and valid known entity name.
-    state = defaultdict(list)  # type: Dict[Union[str, None], List[Tuple[List[str], Entity]]]
-    # Entitiy definition cache
-    ecache = dict()  # type: Dict[str, List[Entity]]
+    state = defaultdict(list)  # type: Dict[Union[str, None], List[Tuple[List[str], str]]]
     # Last name to full name mapping ('Clinton' -> 'Hillary Clinton')
     lastnames = dict()  # type: Dict[str, str]
 
-    with BIN_Db.get_db() as db, SessionContext(
-        session=enclosing_session, commit=True, read_only=True
-    ) as session:
-
-        def fetch_entities(w: str, fuzzy=True) -> List[Entity]:
-            """ Return a list of entities matching the word(s) given,
-                exactly if fuzzy = False, otherwise also as a starting word(s) """
-            try:
-                q = session.query(Entity.name, Entity.verb, Entity.definition)
-                if fuzzy:
-                    q = q.filter(Entity.name.like(w + " %") | (Entity.name == w))
-                else:
-                    q = q.filter(Entity.name == w)
-                return q.all()
-            except OperationalError as e:
-                logging.warning("SQL error in fetch_entities(): {0}".format(e))
-                return []
+    with BIN_Db.get_db() as db:
 
-        def query_entities(w):
-            """ Return a list of entities matching the initial word given """
-            e = ecache.get(w)
-            if e is None:
-                ecache[w] = e = fetch_entities(w)
-            return e
+        def query_entities(w: str) -> Sequence[str]:
+            """ Return the names of entities matching the initial word(s) given """
+            return EntityNames.lookup(w, enclosing_session)
 
         def lookup_lastname(lastname):
             """ Look up a last name in the lastnames registry,
@@ -152,18 +268,18 @@ def recognize_entities(
                 newstate = defaultdict(list)
                 w = token.txt  # Original word
 
-                def add_to_state(slist, entity):
+                def add_to_state(slist, ename):
                     """ Add the list of subsequent words to the new parser state """
                     wrd = slist[0] if slist else None
                     rest = slist[1:]
-                    newstate[wrd].append((rest, entity))
+                    newstate[wrd].append((rest, ename))
 
                 if w in state:
                     # This matches an expected token
                     tq.append(token)  # Add to lookahead token queue
                     # Add the matching tails to the new state
-                    for sl, entity in state[w]:
-                        add_to_state(sl, entity)
+                    for sl, ename in state[w]:
+                        add_to_state(sl, ename)
                     # Update the lastnames mapping
                     fullname = " ".join([t.txt for t in tq])
                     parts = fullname.split()
@@ -230,7 +346,7 @@ def recognize_entities(
                             # were constructed by concatenation (indicated by a hyphen
                             # in the stem)
                             weak = False  # Accept single-word entity references
-                        # elist is a list of Entity instances
+                        # elist is a list of entity names
                         elist = query_entities(w)
                     else:
                         elist = []
@@ -238,15 +354,15 @@ def recognize_entities(
                     if elist:
                         # This word might be a candidate to start an entity reference
                         candidate = False
-                        for e in elist:
+                        for ename in elist:
                             # List of subsequent words in entity name
-                            sl = e.name.split()[cnt:]
+                            sl = ename.split()[cnt:]
                             if sl:
                                 # Here's a candidate for a longer entity reference
                                 # than we already have
                                 candidate = True
                             if sl or not weak:
-                                add_to_state(sl, e)
+                                add_to_state(sl, ename)
                         if weak and not candidate:
                             # Found no potential entity reference longer than this token
                             # already is - and we have a BÍN meaning for it:
@@ -281,7 +397,6 @@ def recognize_entities(
                 yield from tq
             tq = []
 
-    # print("\nEntity cache:\n{0}".format("\n".join("'{0}': {1}".format(k, v) for k, v in ecache.items())))
     # print("\nLast names:\n{0}".format("\n".join("{0}: {1}".format(k, v) for k, v in lastnames.items())))
 
     assert not tq
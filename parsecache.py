@@ -0,0 +1,291 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Sentence parse cache
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module implements a cache of sentence parse results, keyed by
+    a hash of the sentence's token sequence and the parser and tokenizer
+    versions.
+
+    News articles repeat many sentences verbatim (bylines, photo credits,
+    legal footers), and there is no need to parse those more than once.
+    The cache has two levels: an in-process LRU dictionary, and a
+    persistent table in the scraper database (parsecache) that is
+    shared between processes and trimmed to a maximum number of rows,
+    evicting the least recently used entries first.
+
+"""
+
+from typing import Any, Dict, Iterable, List, Optional
+
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from collections import OrderedDict
+
+from reynir import Tok
+
+from settings import Settings
+from db import DatabaseError
+
+
+class ParseCache:
+
+    """ A process-wide, two-level cache of sentence parse results.
+        Lookups and stores are done in batches, typically one of each
+        per article, to save database round trips. """
+
+    _lock = threading.Lock()
+    # In-process LRU cache: key -> JSON string. Values are kept in
+    # serialized form so that callers always get fresh objects that
+    # they may modify, and to keep the memory footprint small.
+    _lru: "OrderedDict[str, str]" = OrderedDict()
+    # Hit/miss counters
+    _counters: Dict[str, int] = dict(mem_hits=0, db_hits=0, misses=0, stores=0)
+    # Number of database inserts since the table was last trimmed
+    _puts_since_trim = 0
+    # Trim the database table after this many inserts (per process)
+    _TRIM_INTERVAL = 1000
+    # After a database failure, the persistent cache is not used until
+    # this time (in time.monotonic() seconds). The wait starts at the
+    # minimum and doubles with each consecutive failure.
+    _db_retry_at = 0.0
+    _db_backoff = 0.0
+    _MIN_BACKOFF = 60.0
+    _MAX_BACKOFF = 3600.0
+
+    # Name of the cache, for log messages
+    _NAME = "Parse cache"
+
+    # Trim the parsecache table down to its maximum size, deleting the
+    # least recently used rows. The cutoff timestamp is found by walking
+    # the timestamp index, so the table is not sorted.
+    _TRIM_SQL = """
+        delete from parsecache where timestamp < (
+            select timestamp from parsecache
+                order by timestamp desc offset :n limit 1
+        );
+        """
+
+    # Look up a batch of cache entries
+    _SELECT_SQL = "select key, content from parsecache where key = any(:keys);"
+
+    # Mark cache entries as recently used. To save writes, this is done
+    # at most once a day per entry, which is plenty for LRU eviction.
+    _TOUCH_SQL = """
+        update parsecache set timestamp = :ts
+            where key = any(:keys) and timestamp < :ts - interval '1 day';
+        """
+
+    # Insert or refresh a batch of cache entries; {0} is replaced
+    # by a list of value tuples
+    _UPSERT_SQL = """
+        insert into parsecache as pc (key, content, timestamp)
+            values {0}
+            on conflict (key)
+            do update set content = excluded.content, timestamp = excluded.timestamp;
+        """
+
+    @staticmethod
+    def _max_size() -> int:
+        """ The maximum number of entries in the in-process cache """
+        return Settings.PARSE_CACHE_SIZE
+
+    @staticmethod
+    def _max_db_rows() -> int:
+        """ The maximum number of rows in the persistent cache table """
+        return Settings.PARSE_CACHE_DB_ROWS
+
+    @staticmethod
+    def key(tokens: Iterable[Tok], version: str, kind: str = "article") -> str:
+        """ Return a cache key for a sentence, given its tokens,
+            the parser version and the kind of result being cached """
+        h = hashlib.sha256()
+        h.update("{0}\x1d{1}\x1d".format(kind, version).encode("utf-8"))
+        for t in tokens:
+            h.update(
+                "{0}\x1e{1}\x1e{2!r}\x1f".format(t.kind, t.txt, t.val).encode("utf-8")
+            )
+        return h.hexdigest()
+
+    @classmethod
+    def _remember(cls, key: str, content: str) -> None:
+        """ Add an entry to the in-process LRU cache, evicting if needed """
+        # Assumes that the lock is held
+        cls._lru[key] = content
+        cls._lru.move_to_end(key)
+        while len(cls._lru) > max(cls._max_size(), 0):
+            cls._lru.popitem(last=False)
+
+    @classmethod
+    def _db_op(cls, session, func, write: bool = False) -> Any:
+        """ Run an operation on the persistent cache within a savepoint,
+            so that a failure (for instance a missing table) doesn't abort
+            the caller's transaction. Upon failure, the persistent cache
+            is not used for a while, backing off exponentially. Writes are
+            skipped for sessions marked as read-only by SessionContext. """
+        if session is None or cls._max_db_rows() <= 0:
+            return None
+        if write and session.info.get("read_only"):
+            return None
+        if cls._db_retry_at and time.monotonic() < cls._db_retry_at:
+            return None
+        try:
+            with session.begin_nested():
+                result = func()
+        except DatabaseError as e:
+            with cls._lock:
+                cls._db_backoff = min(
+                    max(2 * cls._db_backoff, cls._MIN_BACKOFF), cls._MAX_BACKOFF
+                )
+                cls._db_retry_at = time.monotonic() + cls._db_backoff
+            logging.warning(
+                "Persistent {0} disabled for {1:.0f} seconds: {2}".format(
+                    cls._NAME.lower(), cls._db_backoff, e
+                )
+            )
+            return None
+        if cls._db_backoff:
+            with cls._lock:
+                cls._db_backoff = cls._db_retry_at = 0.0
+        return result
+
+    @classmethod
+    def get_many(cls, session, keys: Iterable[str]) -> Dict[str, Any]:
+        """ Look up a batch of cached parse results, returning
+            a dict of those found, keyed by cache key """
+        found: Dict[str, str] = dict()
+        missing: List[str] = []
+        with cls._lock:
+            for key in keys:
+                content = cls._lru.get(key)
+                if content is not None:
+                    cls._lru.move_to_end(key)
+                    found[key] = content
+                elif key not in found:
+                    missing.append(key)
+            cls._counters["mem_hits"] += len(found)
+        if missing:
+            missing = list(set(missing))
+
+            def lookup():
+                rows = session.execute(cls._SELECT_SQL, dict(keys=missing)).fetchall()
+                if rows:
+                    # Mark the entries as recently used
+                    session.execute(
+                        cls._TOUCH_SQL,
+                        dict(keys=[r[0] for r in rows], ts=datetime.utcnow()),
+                    )
+                return rows
+
+            rows = cls._db_op(session, lookup) or []
+            with cls._lock:
+                for key, content in rows:
+                    cls._remember(key, content)
+                    found[key] = content
+                cls._counters["db_hits"] += len(rows)
+                cls._counters["misses"] += len(missing) - len(rows)
+        return {key: json.loads(content) for key, content in found.items()}
+
+    @classmethod
+    def get(cls, session, key: str) -> Optional[Any]:
+        """ Look up a cached parse result, returning None if not found """
+        return cls.get_many(session, [key]).get(key)
+
+    @classmethod
+    def put_many(cls, session, values: Dict[str, Any]) -> None:
+        """ Store a batch of parse results, keyed by cache key """
+        if not values:
+            return
+        trim = False
+        contents = {
+            key: json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+            for key, value in values.items()
+        }
+        with cls._lock:
+            for key, content in contents.items():
+                cls._remember(key, content)
+            cls._counters["stores"] += len(contents)
+            cls._puts_since_trim += len(contents)
+            if cls._puts_since_trim >= cls._TRIM_INTERVAL:
+                cls._puts_since_trim = 0
+                trim = True
+        params: Dict[str, Any] = dict(ts=datetime.utcnow())
+        tuples: List[str] = []
+        for ix, (key, content) in enumerate(contents.items()):
+            params["k{0}".format(ix)] = key
+            params["c{0}".format(ix)] = content
+            tuples.append("(:k{0}, :c{0}, :ts)".format(ix))
+        sql = cls._UPSERT_SQL.format(", ".join(tuples))
+        cls._db_op(session, lambda: session.execute(sql, params), write=True)
+        if trim:
+            cls.trim(session)
+
+    @classmethod
+    def put(cls, session, key: str, value: Any) -> None:
+        """ Store a parse result in the cache """
+        cls.put_many(session, {key: value})
+
+    @classmethod
+    def trim(cls, session) -> None:
+        """ Trim the persistent cache to its maximum number of rows """
+        cls._db_op(
+            session,
+            lambda: session.execute(
+                cls._TRIM_SQL, dict(n=cls._max_db_rows())
+            ),
+            write=True,
+        )
+
+    @classmethod
+    def clear(cls) -> None:
+        """ Clear the in-process cache and the counters """
+        with cls._lock:
+            cls._lru.clear()
+            for k in cls._counters:
+                cls._counters[k] = 0
+            cls._db_backoff = cls._db_retry_at = 0.0
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        """ Return the hit/miss counters and the in-process cache size """
+        with cls._lock:
+            d = dict(cls._counters)
+            d["size"] = len(cls._lru)
+        return d
+
+    @classmethod
+    def log_stats(cls) -> None:
+        """ Log the cache statistics """
+        st = cls.stats()
+        total = st["mem_hits"] + st["db_hits"] + st["misses"]
+        if total:
+            logging.info(
+                "{0}: {1} lookups, {2} memory hits, {3} database hits, "
+                "hit ratio {4:.1f}%".format(
+                    cls._NAME,
+                    total,
+                    st["mem_hits"],
+                    st["db_hits"],
+                    100.0 * (st["mem_hits"] + st["db_hits"]) / total,
+                )
+            )
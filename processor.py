@@ -31,7 +31,7 @@
 
 """
 
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from types import ModuleType
 
 import getopt
@@ -47,9 +47,11 @@ from contextlib import closing
 from datetime import datetime
 
 from settings import Settings, ConfigError
-from db import Scraper_DB
+from db import Scraper_DB, BulkWriter
+from locationcache import LocationCache
 from db.models import Article, Person
 from tree import Tree
+from treepack import PackedArticle
 
 
 _PROFILING = False
@@ -73,8 +75,10 @@ class TokenContainer:
 
     """ Class wrapper around tokens """
 
-    def __init__(self, tokens_json, url, authority) -> None:
-        self.tokens = json.loads(tokens_json)
+    def __init__(self, tokens, url, authority) -> None:
+        # The tokens may be given as a JSON string or as an already
+        # decoded list of paragraphs
+        self.tokens = json.loads(tokens) if isinstance(tokens, str) else tokens
         self.url = url
         self.authority = authority
 
@@ -122,6 +126,14 @@ class TokenContainer:
             "authority": self.authority,
             "processor": processor,
         }
+        # Add state parameters passed via keyword arguments, if any
+        state.update(kwargs)
+        # Rows added by the processor are written in bulk, at the end
+        # of the article unless the caller passes in its own writer
+        writer = state.get("writer")
+        own_writer = writer is None
+        if own_writer:
+            writer = state["writer"] = BulkWriter(session)
 
         if article_begin:
             article_begin(state)
@@ -150,6 +162,9 @@ class TokenContainer:
         if article_end:
             article_end(state)
 
+        if own_writer:
+            writer.flush()
+
 
 class Processor:
 
@@ -217,9 +232,51 @@ class Processor:
                     "No processors found in directory {0}".format(processor_directory)
                 )
 
-    def go_single(self, url: str) -> None:
+    def _import_modules(self) -> None:
+        """ Import the processor modules, if not already done
+            within this process """
+        if self.pmodules is None:
+            self.pmodules = [
+                importlib.import_module(modname) for modname in self.processors
+            ]
+
+    def _process_tree(
+        self, session, writer: BulkWriter, url: str, tree_text, tokens, packed, authority
+    ) -> None:
+        """ Run the processors on the tree and tokens of a single article """
+        if packed is not None and not (tree_text and tokens):
+            # Stored in the compact binary format
+            packed = PackedArticle(packed)
+            tree_text, tokens = packed.tree(), packed.tokens()
+        if not (tree_text and tokens):
+            return
+        tree = Tree(url, authority)
+        tree.load(tree_text)
+
+        token_container = TokenContainer(tokens, url, authority)
+
+        # Run the tree processors together in a single
+        # traversal of the tree, and the token processors in turn
+        assert self.pmodules is not None
+        tree_processors = []
+        for p in self.pmodules:
+            ptype = getattr(p, "PROCESSOR_TYPE")  # type: str
+            if ptype == "tree":
+                tree_processors.append(p)
+            elif ptype == "token":
+                token_container.process(session, p, writer=writer)
+            else:
+                assert False, (
+                    "Unknown processor type '{0}'; should be 'tree' or 'token'"
+                    .format(ptype)
+                )
+        if tree_processors:
+            tree.process_all(session, tree_processors, writer=writer)
+
+    def go_single(self, url: str) -> Tuple[int, float]:
         """ Single article processor that will be called by a process within a
-            multiprocessing pool """
+            multiprocessing pool. Returns the number of database rows written
+            by the processors and the time spent writing them. """
 
         assert self._db is not None
 
@@ -227,40 +284,29 @@ class Processor:
         sys.stdout.flush()
 
         # If first article within a new process, import the processor modules
-        if self.pmodules is None:
-            self.pmodules = [
-                importlib.import_module(modname) for modname in self.processors
-            ]
+        self._import_modules()
 
         # Load the article
         with closing(self._db.session) as session:
 
+            # Rows added by all processors are written in bulk
+            writer = BulkWriter(session)
             try:
                 article = session.query(Article).filter_by(url=url).one_or_none()
 
                 if article is None:
                     print("Article not found in scraper database")
                 else:
-                    if article.tree and article.tokens:
-                        tree = Tree(url, article.authority)
-                        tree.load(article.tree)
-
-                        token_container = TokenContainer(
-                            article.tokens, url, article.authority
-                        )
-
-                        # Run all processors in turn
-                        for p in self.pmodules:
-                            ptype = getattr(p, "PROCESSOR_TYPE")  # type: str
-                            if ptype == "tree":
-                                tree.process(session, p)
-                            elif ptype == "token":
-                                token_container.process(session, p)
-                            else:
-                                assert False, (
-                                    "Unknown processor type '{0}'; should be 'tree' or 'token'"
-                                    .format(ptype)
-                                )
+                    self._process_tree(
+                        session,
+                        writer,
+                        url,
+                        article.tree,
+                        article.tokens,
+                        article.packed,
+                        article.authority,
+                    )
+                    writer.flush()
 
                     # Mark the article as being processed
                     article.processed = datetime.utcnow()
@@ -278,65 +324,178 @@ class Processor:
                 raise
 
         sys.stdout.flush()
+        return writer.rows, writer.seconds
 
-    def go(
-        self, from_date=None, limit=0, force=False, update=False, title=None
-    ) -> None:
-        """ Process already parsed articles from the database """
+    def go_batches(self, args) -> Tuple[int, int, float]:
+        """ Claim batches of articles that are due for processing and process
+            them, committing once per batch, until there are no more articles
+            or the limit is reached. The claimed articles are locked with
+            SELECT ... FOR UPDATE SKIP LOCKED, so several workers, also in
+            other processes or on other machines, can share the backlog.
+            Returns the number of articles processed, the number of database
+            rows written by the processors and the time spent writing them. """
 
-        # noinspection PyComparisonWithNone,PyShadowingNames
-        def iter_parsed_articles():
+        from_date, limit, force, update, started, batch_size = args
 
-            assert self._db is not None
+        assert self._db is not None
+
+        self._import_modules()
 
+        count = 0
+        rows = 0
+        seconds = 0.0
+        while not limit or count < limit:
+            n = batch_size if not limit else min(batch_size, limit - count)
             with closing(self._db.session) as session:
-                """ Go through parsed articles and process them """
-                if title is not None:
-                    # Use a title query on Person to find the URLs to process
-                    qtitle = title.lower()
-                    if "%" not in qtitle:
-                        # Match start of title by default
-                        qtitle += "%"
-                    q = session.query(Person.article_url).filter(
-                        Person.title_lc.like(qtitle)
-                    )
-                    field = lambda x: x.article_url
-                else:
-                    q = session.query(Article.url).filter(Article.tree != None)
-                    field = lambda x: x.url
-                    if not force:
-                        # If force = True, re-process articles even if
-                        # they have been processed before
-                        if update:
-                            # If update, we re-process articles that have been parsed
-                            # again in the meantime
-                            q = q.filter(Article.processed < Article.parsed).order_by(
-                                Article.processed
-                            )
-                        else:
-                            q = q.filter(Article.processed == None)
+                writer = BulkWriter(session)
+                try:
+                    q = session.query(
+                        Article.id,
+                        Article.url,
+                        Article.tree,
+                        Article.tokens,
+                        Article.packed,
+                        Article.authority,
+                    ).filter(Article.has_tree)
+                    if force:
+                        # Re-process articles even if they have been processed
+                        # before, but only once during this run
+                        q = q.filter(
+                            (Article.processed == None) | (Article.processed < started)
+                        )
+                    elif update:
+                        # Re-process articles that have been parsed again
+                        # in the meantime
+                        q = q.filter(Article.processed < Article.parsed).order_by(
+                            Article.processed
+                        )
+                    else:
+                        q = q.filter(Article.processed == None)
                     if from_date is not None:
                         # Only go through articles parsed since the given date
                         q = q.filter(Article.parsed >= from_date).order_by(
                             Article.parsed
                         )
+                    batch = q.limit(n).with_for_update(skip_locked=True).all()
+                    if not batch:
+                        break
+                    for a in batch:
+                        print("Processing article {0}".format(a.url))
+                        self._process_tree(
+                            session, writer, a.url, a.tree, a.tokens, a.packed, a.authority
+                        )
+                    writer.flush()
+                    # Mark the articles as being processed
+                    session.execute(
+                        Article.table()
+                        .update()
+                        .where(Article.id.in_([a.id for a in batch]))
+                        .values(processed=datetime.utcnow())
+                    )
+                    # Commit the batch, releasing the locks on the articles
+                    session.commit()
+                except Exception as e:
+                    # If an exception occurred, roll back the whole batch
+                    session.rollback()
+                    print(
+                        "Exception in a batch of articles, transaction rolled back\n"
+                        "Exception: {0}".format(e)
+                    )
+                    raise
+            count += len(batch)
+            rows += writer.rows
+            seconds += writer.seconds
+            sys.stdout.flush()
+        LocationCache.log_stats()
+        return count, rows, seconds
+
+    def go(
+        self,
+        from_date=None,
+        limit=0,
+        force=False,
+        update=False,
+        title=None,
+        batch_size=20,
+    ) -> None:
+        """ Process already parsed articles from the database """
+
+        # noinspection PyComparisonWithNone,PyShadowingNames
+        def iter_title_articles():
+
+            assert self._db is not None
+
+            with closing(self._db.session) as session:
+                """ Use a title query on Person to find the URLs to process """
+                qtitle = title.lower()
+                if "%" not in qtitle:
+                    # Match start of title by default
+                    qtitle += "%"
+                q = session.query(Person.article_url).filter(
+                    Person.title_lc.like(qtitle)
+                )
                 if limit > 0:
                     q = q.limit(limit)
                 for a in q.yield_per(200):
-                    yield field(a)
+                    yield a.article_url
+
+        if title is not None:
+            # Process the articles one at a time
+            func = self.go_single
+            work = iter_title_articles()
+            num_workers = self.num_workers
+        else:
+            # Each worker claims batches of articles until none are left
+            func = self.go_batches
+            started = datetime.utcnow()
+            num_workers = 1 if _PROFILING else self.num_workers or os.cpu_count() or 1
+            work = []
+            for ix in range(num_workers):
+                # Split the limit, if any, between the workers
+                worker_limit = 0
+                if limit > 0:
+                    worker_limit = limit // num_workers + (ix < limit % num_workers)
+                    if not worker_limit:
+                        break
+                work.append(
+                    (from_date, worker_limit, force, update, started, batch_size)
+                )
+            num_workers = len(work)
+
+        count = 0
+        rows = 0
+        seconds = 0.0
+
+        def add(result):
+            nonlocal count, rows, seconds
+            if title is not None:
+                # go_single() returns the rows and seconds of one article
+                result = (1,) + result
+            count += result[0]
+            rows += result[1]
+            seconds += result[2]
 
         if _PROFILING:
             # If profiling, just do a simple map within a single thread and process
-            for url in iter_parsed_articles():
-                self.go_single(url)
+            for result in map(func, work):
+                add(result)
         else:
             # Use a multiprocessing pool to process the articles
             # Defaults to using as many processes as there are CPUs
-            with Pool(self.num_workers) as pool:
-                for _ in pool.imap_unordered(self.go_single, iter_parsed_articles()):
-                    pass
+            assert self._db is not None
+            # Don't share pooled database connections with the workers
+            self._db.dispose()
+            with Pool(num_workers) as pool:
+                for result in pool.imap_unordered(func, work):
+                    add(result)
                 pool.close()
                 pool.join()
+        print("{0} articles processed".format(count))
+        print(
+            "{0} rows written in {1:.2f} seconds ({2:.0f} rows/sec)".format(
+                rows, seconds, rows / seconds if seconds > 0.0 else 0.0
+            )
+        )
 
 
 def process_articles(
@@ -347,6 +506,7 @@ def process_articles(
     title=None,
     processor=None,
     num_workers=None,
+    batch_size=20,
 ) -> None:
     """ Process multiple articles according to the given parameters """
     print("------ Greynir starting processing -------")
@@ -364,6 +524,8 @@ def process_articles(
         print("Invoke single processor: {0}".format(processor))
     if num_workers:
         print("Number of workers: {0}".format(num_workers))
+    if title is None:
+        print("Batch size: {0}".format(batch_size))
     ts = "{0}".format(datetime.utcnow())[0:19]
     print("Time: {0}\n".format(ts))
 
@@ -376,7 +538,14 @@ def process_articles(
             single_processor=processor,
             num_workers=num_workers,
         )
-        proc.go(from_date, limit=limit, force=force, update=update, title=title)
+        proc.go(
+            from_date,
+            limit=limit,
+            force=force,
+            update=update,
+            title=title,
+            batch_size=batch_size,
+        )
     finally:
         del proc
         Processor.cleanup()
@@ -431,6 +600,9 @@ __doc__ = """
         -p P, --processor=P: Specify a single processor to invoke
         -t T, --title=T: Specify a title pattern in the persons table
                             to select articles to reprocess
+        -w N, --workers=N: Number of worker processes (default: one per CPU)
+        -b N, --batch=N: Number of articles that each worker claims
+                            and commits at a time (default 20)
         --update: Process files that have been reparsed but not reprocessed
 
 """
@@ -444,7 +616,7 @@ def _main(argv=None) -> int:
         try:
             opts, _ = getopt.getopt(
                 argv[1:],
-                "hifl:u:p:t:w:",
+                "hifl:u:p:t:w:b:",
                 [
                     "help",
                     "init",
@@ -455,6 +627,7 @@ def _main(argv=None) -> int:
                     "processor=",
                     "title=",
                     "workers=",
+                    "batch=",
                 ],
             )
         except getopt.error as msg:
@@ -467,6 +640,7 @@ def _main(argv=None) -> int:
         title = None  # Title pattern
         proc = None  # Single processor to invoke
         num_workers = None  # Number of workers to run simultaneously
+        batch_size = 20  # Number of articles claimed by a worker at a time
         # Process options
         for o, a in opts:
             if o in ("-h", "--help"):
@@ -499,6 +673,12 @@ def _main(argv=None) -> int:
             elif o in ("-w", "--workers"):
                 # Limit the number of workers
                 num_workers = int(a) if int(a) else None
+            elif o in ("-b", "--batch"):
+                # Number of articles per transaction
+                try:
+                    batch_size = max(1, int(a))
+                except ValueError:
+                    raise Usage("Batch size must be a number")
 
         if init:
             # Initialize the scraper database
@@ -536,6 +716,7 @@ def _main(argv=None) -> int:
                     title=title,
                     processor=proc,
                     num_workers=num_workers,
+                    batch_size=batch_size,
                 )
                 # process_articles(limit = limit)
 
@@ -136,7 +136,7 @@ def sentence(state, result):
         # Nothing to do
         return
 
-    session = state["session"]  # Database session
+    writer = state["writer"]  # Bulk writer for database rows
     url = state["url"]  # URL of the article being processed
     authority = state["authority"]  # Authority of the article being processed
     names = state["names"]  # Mapping of last names to full names
@@ -244,7 +244,8 @@ def sentence(state, result):
 
             print("Entity '{0}' {1} '{2}'".format(entity, verb, definition))
 
-            e = Entity(
+            writer.add(
+                Entity,
                 article_url=url,
                 name=entity,
                 verb=verb,
@@ -252,7 +253,6 @@ def sentence(state, result):
                 authority=authority,
                 timestamp=datetime.utcnow(),
             )
-            session.add(e)
 
 
 def visit(state, node):
@@ -26,7 +26,7 @@ from datetime import datetime
 
 from db.models import Location
 from tokenizer import TOK
-from geo import location_info
+from locationcache import LocationCache
 
 
 MODULE_NAME = __name__
@@ -174,6 +174,7 @@ def article_end(state):
 
     url = state["url"]
     session = state["session"]
+    writer = state["writer"]
 
     # Find all placenames mentioned in article
     # We can use them to disambiguate addresses and street names
@@ -181,17 +182,18 @@ def article_end(state):
     # sentence or paragraph level.
     placenames = [p.name for p in locs if p.kind == "placename"]
 
-    # Get info about each location and save to database
+    # Get info about each location, mostly from the location cache,
+    # and save to database
+    infos = LocationCache.resolve_many(session, locs, placename_hints=placenames)
     for name, kind in locs:
-        loc = location_info(name=name, kind=kind, placename_hints=placenames)
+        loc = infos[(name, kind)]
 
         loc["article_url"] = url
         loc["timestamp"] = datetime.utcnow()
 
         print("Location '{0}' is a {1}".format(loc["name"], loc["kind"]))
 
-        locmodel = Location(**loc)
-        session.add(locmodel)
+        writer.add(Location, **loc)
 
 
 # def paragraph_begin(state, paragraph):
@@ -198,7 +198,7 @@ def article_end(state):
 def sentence(state, result):
     """ Called at the end of sentence processing """
 
-    session = state["session"]  # Database session
+    writer = state["writer"]  # Bulk writer for database rows
     url = state["url"]  # URL of the article being processed
     authority = state.get("authority", 1.0)  # Authority of the source
 
@@ -206,7 +206,8 @@ def sentence(state, result):
         # Nöfn og titlar fundust í málsgreininni
         for nafn, titill, kyn in result.nöfn:
             print("Nafn: '{0}' Kyn: '{2}' Titill: '{1}'".format(nafn, titill, kyn))
-            person = Person(
+            writer.add(
+                Person,
                 article_url=url,
                 name=nafn,
                 title=titill,
@@ -215,7 +216,6 @@ def sentence(state, result):
                 authority=authority,
                 timestamp=datetime.utcnow(),
             )
-            session.add(person)
 
 
 def _add_name(result, mannsnafn, titill, kyn):
@@ -24,7 +24,7 @@
 
 """
 
-from typing import Optional, List, Dict, Tuple, Union
+from typing import Any, Optional, List, Dict, Tuple, Union
 
 import logging
 import requests
@@ -43,6 +43,7 @@ from geo import country_name_for_isocode, iceprep_for_cc
 from reynir import NounPhrase
 from settings import changedlocale
 from util import google_api_key
+from apiclient import ApiClient
 
 
 # Type definitions
@@ -396,55 +397,38 @@ def gen_answer(a: str) -> AnswerTuple:
     return dict(answer=a), a, a
 
 
-def query_json_api(url: str) -> Optional[Dict]:
-    """ Request the URL, expecting a JSON response which is
-        parsed and returned as a Python data structure. """
+def _parse_json(r: requests.Response) -> Any:
+    """ Parse a JSON API response """
+    return json.loads(r.text)
 
-    # Send request
-    try:
-        r = requests.get(url)
-    except Exception as e:
-        logging.warning(str(e))
-        return None
 
-    # Verify that status is OK
-    if r.status_code != 200:
-        logging.warning("Received status {0} from API server".format(r.status_code))
-        return None
+def _parse_xml(r: requests.Response) -> Any:
+    """ Parse an XML response into an XML document object """
+    return minidom.parseString(r.text)
 
-    # Parse json API response
-    try:
-        res = json.loads(r.text)
-        return res
-    except Exception as e:
-        logging.warning("Error parsing JSON API response: {0}".format(e))
-    return None
 
+def query_json_api(
+    url: str, ttl: float = 0.0, stale: Optional[float] = None
+) -> Optional[Dict]:
+    """ Request the URL, expecting a JSON response which is
+        parsed and returned as a Python data structure.
+        If ttl (seconds) is given, the response is cached for that
+        long (see apiclient.py); it must then not be modified. """
+    return ApiClient.instance().get(url, _parse_json, ttl=ttl, stale=stale)
 
-def query_xml_api(url: str):
-    """ Request the URL, expecting an XML response which is
-        parsed and returned as an XML document object. """
 
-    # Send request
-    try:
-        r = requests.get(url)
-    except Exception as e:
-        logging.warning(str(e))
-        return None
+def query_xml_api(url: str, ttl: float = 0.0, stale: Optional[float] = None):
+    """ Request the URL, expecting an XML response which is
+        parsed and returned as an XML document object.
+        If ttl (seconds) is given, the response is cached for that
+        long (see apiclient.py); it must then not be modified. """
+    return ApiClient.instance().get(url, _parse_xml, ttl=ttl, stale=stale)
 
-    # Verify that status is OK
-    if r.status_code != 200:
-        logging.warning(
-            "Received status {0} from remote URL {1}".format(r.status_code, url)
-        )
-        return None
 
-    # Parse XML response text
-    try:
-        xmldoc = minidom.parseString(r.text)
-        return xmldoc
-    except Exception as e:
-        logging.warning("Error parsing XML response from {0}: {1}".format(url, e))
+# Time-to-live (seconds) of cached responses from the Google Maps APIs
+_GEOCODE_CACHE_TTL = 24 * 3600
+_TRAVELTIME_CACHE_TTL = 600
+_PLACES_CACHE_TTL = 3600
 
 
 _MAPS_API_COORDS_URL = (
@@ -463,7 +447,9 @@ def query_geocode_api_coords(lat: float, lon: float) -> Optional[Dict]:
         return None
 
     # Send API request
-    res = query_json_api(_MAPS_API_COORDS_URL.format(lat, lon, key))
+    res = query_json_api(
+        _MAPS_API_COORDS_URL.format(lat, lon, key), ttl=_GEOCODE_CACHE_TTL
+    )
 
     return res
 
@@ -485,7 +471,7 @@ def query_geocode_api_addr(addr: str) -> Optional[Dict]:
 
     # Send API request
     url = _MAPS_API_ADDR_URL.format(addr, key)
-    res = query_json_api(url)
+    res = query_json_api(url, ttl=_GEOCODE_CACHE_TTL)
 
     return res
 
@@ -523,7 +509,7 @@ def query_traveltime_api(
 
     # Send API request
     url = _MAPS_API_TRAVELTIME_URL.format(p1, p2, mode, key)
-    res = query_json_api(url)
+    res = query_json_api(url, ttl=_TRAVELTIME_CACHE_TTL)
 
     return res
 
@@ -572,7 +558,7 @@ def query_places_api(
 
     # Send API request
     url = _PLACES_API_URL.format(qstr)
-    res = query_json_api(url)
+    res = query_json_api(url, ttl=_PLACES_CACHE_TTL)
 
     return res
 
@@ -580,7 +566,6 @@ def query_places_api(
 _PLACEDETAILS_API_URL = "https://maps.googleapis.com/maps/api/place/details/json?{0}"
 
 
-@lru_cache(maxsize=32)
 def query_place_details(place_id: str, fields: Optional[str] = None) -> Optional[Dict]:
     """ Look up place details by ID in Google's Place Details API. If "fields"
         parameter is omitted, *all* fields are returned. For details, see
@@ -601,7 +586,7 @@ def query_place_details(place_id: str, fields: Optional[str] = None) -> Optional
 
     # Send API request
     url = _PLACEDETAILS_API_URL.format(qstr)
-    res = query_json_api(url)
+    res = query_json_api(url, ttl=_PLACES_CACHE_TTL)
 
     return res
 
@@ -43,13 +43,14 @@ from threading import Lock
 from functools import lru_cache
 from datetime import datetime
 import random
+import sys
 
 import query
 from query import Query
 from queries import natlang_seq, numbers_to_neutral, cap_first, gen_answer
 from settings import Settings
 from reynir import correct_spaces
-from geo import in_iceland
+from geo import in_iceland, LatLonTuple, SpatialIndex, ICELAND_COORDS
 
 import straeto  # type: ignore  # TODO
 
@@ -58,6 +59,9 @@ import straeto  # type: ignore  # TODO
 SCHEDULE_TODAY: Optional[straeto.BusSchedule] = None
 SCHEDULE_LOCK = Lock()
 
+# Spatial index of all bus stops, built on first use
+_STOP_INDEX: Optional[SpatialIndex] = None
+
 
 # Indicate that this module wants to handle parse trees for queries,
 # as opposed to simple literal text strings
@@ -655,6 +659,38 @@ def hms_diff(hms1: Tuple, hms2: Tuple) -> int:
     return (hms1[0] - hms2[0]) * 60 + (hms1[1] - hms2[1])
 
 
+def _stop_index(rebuild: bool = False) -> SpatialIndex:
+    """ Return a spatial index of all bus stops, building it if
+        it hasn't been built yet or if a rebuild is requested """
+    global _STOP_INDEX
+    if _STOP_INDEX is None or rebuild:
+        # The straeto package has no accessor for all of its stops,
+        # but the stops closest to any location, without a limit on
+        # their number, are all of them
+        stops = straeto.BusStop.closest_to_list(ICELAND_COORDS, n=sys.maxsize)
+        _STOP_INDEX = SpatialIndex([stop.location for stop in stops], stops)
+    return _STOP_INDEX
+
+
+def _closest_stops(
+    location: LatLonTuple, n: int = 1, within_radius: Optional[float] = None
+) -> List[straeto.BusStop]:
+    """ Return the n bus stops closest to the location, optionally
+        only those within the given radius (in kilometers) """
+    for rebuild in (False, True):
+        index = _stop_index(rebuild)
+        if within_radius is None:
+            closest = index.nearest(location, n)
+        else:
+            closest = index.within(location, within_radius)[:n]
+        stops = [stop for stop, _ in closest]
+        # When straeto reloads its data, it creates new stop objects, so
+        # stops that it no longer looks up by their id mean a stale index
+        if all(straeto.BusStop.lookup(stop.stop_id) is stop for stop in stops):
+            break
+    return stops
+
+
 def query_nearest_stop(query: Query, session, result):
     """ A query for the stop closest to the user """
     # Retrieve the client location
@@ -670,7 +706,7 @@ def query_nearest_stop(query: Query, session, result):
         return gen_answer("Ég þekki ekki strætósamgöngur utan Íslands.")
 
     # Get the stop closest to the user
-    stop = straeto.BusStop.closest_to(location)
+    stop = _closest_stops(location)[0]
     answer = stop.name
     # Use the same word for the bus stop as in the query
     stop_word = result.stop_word if "stop_word" in result else "stoppistöð"
@@ -740,10 +776,10 @@ def query_arrival_time(query: Query, session, result):
             straeto.BusStop.sort_by_proximity(stops, query.location)
     else:
         # Obtain the closest stops (at least within 400 meters radius)
-        stops = straeto.BusStop.closest_to(location, n=2, within_radius=0.4)
+        stops = _closest_stops(location, n=2, within_radius=0.4)
         if not stops:
             # This will fetch the single closest stop, regardless of distance
-            stops = [straeto.BusStop.closest_to(location)]
+            stops = _closest_stops(location)
 
     # Handle the case where no bus number was specified (i.e. is 'Any')
     if result.bus_number == "Any" and stops:
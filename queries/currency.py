@@ -29,7 +29,6 @@
 from typing import Dict, Optional
 
 import re
-import cachetools  # type: ignore
 import random
 import logging
 
@@ -440,10 +439,9 @@ _CURR_API_URL = "https://apis.is/currency/lb"
 _CURR_CACHE_TTL = 3600  # seconds
 
 
-@cachetools.cached(cachetools.TTLCache(1, _CURR_CACHE_TTL))
 def _fetch_exchange_rates() -> Optional[Dict]:
-    """ Fetch exchange rate data from apis.is and cache it. """
-    res = query_json_api(_CURR_API_URL)
+    """ Fetch exchange rate data from apis.is, cached by the API client. """
+    res = query_json_api(_CURR_API_URL, ttl=_CURR_CACHE_TTL)
     if not res or "results" not in res:
         logging.warning(
             "Unable to fetch exchange rate data from {0}".format(_CURR_API_URL)
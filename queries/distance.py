@@ -52,6 +52,9 @@ from geo import distance, capitalize_placename
 
 _DISTANCE_QTYPE = "Distance"
 
+# Keywords, one of which occurs in every query handled by this module
+PLAIN_TEXT_TRIGGERS = ("langt", "langan", "lengi", "metr")
+
 
 _QDISTANCE_REGEXES = (
     r"^hvað er ég langt frá (.+)$",
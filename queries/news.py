@@ -30,7 +30,6 @@
 from typing import List, Optional, Dict
 
 import logging
-import cachetools  # type: ignore
 import random
 
 from query import Query
@@ -109,10 +108,9 @@ _NEWS_API = "https://ruv.is/json/frettir/hladbord"
 _NEWS_CACHE_TTL = 300  # seconds, ttl = 5 mins
 
 
-@cachetools.cached(cachetools.TTLCache(1, _NEWS_CACHE_TTL))
 def _get_news_data(max_items: int = 8) -> Optional[List[Dict]]:
     """ Fetch news headline data from RÚV, preprocess it. """
-    res = query_json_api(_NEWS_API)
+    res = query_json_api(_NEWS_API, ttl=_NEWS_CACHE_TTL)
     if not res or "nodes" not in res or not len(res["nodes"]):
         return None
 
@@ -29,10 +29,9 @@
 from typing import List, Dict, Tuple, Optional
 
 import logging
-import cachetools  # type: ignore
 import random
 
-from geo import distance
+from geo import SpatialIndex
 from query import Query
 from queries import query_json_api, gen_answer, distance_desc, krona_desc
 
@@ -219,14 +218,15 @@ _PETROL_API = "https://apis.is/petrol"
 _PETROL_CACHE_TTL = 3600  # seconds, ttl 1 hour
 
 
-@cachetools.cached(cachetools.TTLCache(1, _PETROL_CACHE_TTL))
 def _get_petrol_station_data() -> Optional[List]:
-    """ Fetch list of petrol stations w. prices from apis.is (Gasvaktin) """
-    pd = query_json_api(_PETROL_API)
+    """ Fetch list of petrol stations w. prices from apis.is (Gasvaktin).
+        The list is cached by the API client, and the same list object is
+        returned until it is refreshed. """
+    pd = query_json_api(_PETROL_API, ttl=_PETROL_CACHE_TTL)
     if not pd or "results" not in pd:
         return None
 
-    # Fix company names
+    # Fix company names (in place, which is harmless if already done)
     for s in pd["results"]:
         name = s.get("company", "")
         s["company"] = _COMPANY_NAME_FIXES.get(name, name)
@@ -234,29 +234,36 @@ def _get_petrol_station_data() -> Optional[List]:
     return pd["results"]
 
 
-def _stations_with_distance(loc: Optional[LatLonTuple]) -> Optional[List]:
-    """ Return list of petrol stations w. added distance data. """
+# The spatial index of the petrol stations most recently fetched,
+# as a (stations, index) tuple
+_STATION_INDEX: Optional[Tuple[List, SpatialIndex]] = None
+
+
+def _station_index() -> Optional[SpatialIndex]:
+    """ Return a spatial index of the petrol stations, rebuilding
+        it when the station data has been fetched anew """
+    global _STATION_INDEX
     pd = _get_petrol_station_data()
     if not pd:
         return None
-
-    if loc:
-        # Calculate distance of all stations
-        for s in pd:
-            s["distance"] = distance(loc, (s["geo"]["lat"], s["geo"]["lon"]))
-
-    return pd
+    si = _STATION_INDEX
+    if si is None or si[0] is not pd:
+        index = SpatialIndex([(s["geo"]["lat"], s["geo"]["lon"]) for s in pd], pd)
+        si = _STATION_INDEX = (pd, index)
+    return si[1]
 
 
 def _closest_petrol_station(loc: LatLonTuple) -> Optional[Dict]:
     """ Find petrol station closest to the given location. """
-    stations = _stations_with_distance(loc)
-    if not stations:
+    index = _station_index()
+    if not index:
         return None
 
-    # Sort by distance
-    dist_sorted = sorted(stations, key=lambda s: s["distance"])
-    return dist_sorted[0] if dist_sorted else None
+    closest = index.nearest(loc, 1)
+    if not closest:
+        return None
+    station, dist = closest[0]
+    return dict(station, distance=dist)
 
 
 def _cheapest_petrol_station() -> Optional[Dict]:
@@ -274,16 +281,18 @@ _CLOSE_DISTANCE = 5.0  # km
 
 
 def _closest_cheapest_petrol_station(loc: LatLonTuple) -> Optional[Dict]:
-    stations = _stations_with_distance(loc)
-    if not stations:
+    index = _station_index()
+    if not index:
         return None
 
-    # Filter out all stations that are not close by
-    filtered = filter(lambda x: x["distance"] <= _CLOSE_DISTANCE, stations)
+    # Only consider stations that are close by
+    close = index.within(loc, _CLOSE_DISTANCE)
+    if not close:
+        return None
 
-    # Sort by price
-    price_sorted = sorted(filtered, key=lambda s: s["bensin95"])
-    return price_sorted[0] if price_sorted else None
+    # Pick the cheapest one
+    station, dist = min(close, key=lambda t: t[0]["bensin95"])
+    return dict(station, distance=dist)
 
 
 _ERRMSG = "Ekki tókst að sækja upplýsingar um bensínstöðvar."
@@ -54,6 +54,9 @@ _REPEAT_PREFIXES = tuple(
     )
 )
 
+# Only queries containing one of the prefixes can be handled by this module
+PLAIN_TEXT_TRIGGERS = _REPEAT_PREFIXES
+
 # _PREFIX_BLACKLIST = frozenset(
 #     ("segðu mér", "segðu okkur", "segðu eitthvað", "segðu frá")
 # )
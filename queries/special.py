@@ -1899,5 +1899,6 @@ def handle_plain_text(q: Query) -> bool:
     # Caching for non-dynamic answers
     if fixed or response.get("can_cache", False):
         q.set_expires(datetime.utcnow() + timedelta(hours=24))
+        q.set_cacheable()
 
     return True
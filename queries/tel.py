@@ -37,6 +37,9 @@ from query import Query
 
 _TELEPHONE_QTYPE = "Telephone"
 
+# Keywords, one of which occurs in every query handled by this module
+PLAIN_TEXT_TRIGGERS = ("hring",)
+
 
 TOPIC_LEMMAS = ["hringja", "símanúmer", "sími"]
 
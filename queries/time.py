@@ -43,6 +43,9 @@ from queries import timezone4loc
 
 _TIME_QTYPE = "Time"
 
+# Keywords, one of which occurs in every query handled by this module
+PLAIN_TEXT_TRIGGERS = ("klukkan", "tím")
+
 
 _TIME_QUERIES = frozenset(
     (
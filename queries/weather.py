@@ -325,6 +325,8 @@ def _postprocess_owm_data(d):
     return d
 
 
+_OWM_CACHE_TTL = 600  # seconds, ttl 10 mins
+
 _OWM_API_URL_BYNAME = (
     "https://api.openweathermap.org/data/2.5/weather?q={0},{1}&appid={2}&units=metric"
 )
@@ -332,7 +334,8 @@ _OWM_API_URL_BYNAME = (
 
 def _query_owm_by_name(city: str, country_code: Optional[str] = None):
     d = query_json_api(
-        _OWM_API_URL_BYNAME.format(city, country_code or "", _get_OWM_API_key())
+        _OWM_API_URL_BYNAME.format(city, country_code or "", _get_OWM_API_key()),
+        ttl=_OWM_CACHE_TTL,
     )
     return _postprocess_owm_data(d)
 
@@ -344,7 +347,9 @@ _OWM_API_URL_BYLOC = (
 
 
 def _query_owm_by_coords(lat: float, lon: float):
-    d = query_json_api(_OWM_API_URL_BYLOC.format(lat, lon, _get_OWM_API_key()))
+    d = query_json_api(
+        _OWM_API_URL_BYLOC.format(lat, lon, _get_OWM_API_key()), ttl=_OWM_CACHE_TTL
+    )
     return _postprocess_owm_data(d)
 
 
@@ -250,10 +250,13 @@ _WIKI_API_URL = (
 )
 
 
+_WIKI_CACHE_TTL = 24 * 3600  # seconds, ttl 1 day
+
+
 def _query_wiki_api(subject: str):
     """ Fetch JSON from Wikipedia API """
     url = _WIKI_API_URL.format(subject)
-    return query_json_api(url)
+    return query_json_api(url, ttl=_WIKI_CACHE_TTL)
 
 
 def get_wiki_summary(subject_nom: str) -> str:
@@ -87,6 +87,9 @@ _WORDTYPE_RX_NOM = "(?:orðið|nafnið|nafnorðið)"
 _WORDTYPE_RX_GEN = "(?:orðsins|nafnsins|nafnorðsins)"
 _WORDTYPE_RX_DAT = "(?:orðinu|nafninu|nafnorðinu)"
 
+# Keywords, one of which occurs in every query handled by this module
+PLAIN_TEXT_TRIGGERS = ("hvernig", "beyging")
+
 _SPELLING_RX = (
     r"^hvernig stafsetur maður {0}?\s?(.+)$".format(_WORDTYPE_RX_NOM),
     r"^hvernig stafset ég {0}?\s?(.+)$".format(_WORDTYPE_RX_NOM),
@@ -273,6 +276,7 @@ def handle_plain_text(q: Query) -> bool:
     if answ is not None:
         q.set_answer(*answ)
         q.set_expires(datetime.utcnow() + timedelta(hours=24))
+        q.set_cacheable()
         # Beautify query by placing word being asked about within Icelandic quotation marks
         # TODO: This needs to be fixed, mangles the query if asking about "maður", "orð", etc.
         # bq = re.sub(r"\s({0})".format(matching_word), r" „\1“", q.beautified_query)
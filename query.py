@@ -30,6 +30,9 @@ from typing import (
     Tuple,
     List,
     Dict,
+    Set,
+    FrozenSet,
+    Pattern,
     Callable,
     Iterator,
     Iterable,
@@ -43,6 +46,7 @@ from types import ModuleType
 
 import importlib
 import logging
+import time
 from datetime import datetime, timedelta
 import json
 import re
@@ -64,6 +68,7 @@ from reynir.bindb import BIN_Db, BIN_Meaning
 
 # from nertokenizer import recognize_entities
 from images import get_image_url
+from answercache import AnswerCache
 from processor import modules_in_dir
 
 
@@ -122,6 +127,40 @@ _IGNORED_PREFIX_RE = r"^({0})\s*".format("|".join(_IGNORED_QUERY_PREFIXES))
 _CAPITALIZATION_REPLACEMENTS = (("í Dag", "í dag"),)
 
 
+def _query_alternatives(fragment: str) -> Optional[Set[str]]:
+    """ Return the set of nonterminals that begin the alternatives of the
+        'Query' rule(s) in a grammar fragment, or None if an alternative
+        doesn't begin with a nonterminal, in which case the fragment
+        can't be indexed """
+    rhs: List[str] = []
+    in_rule = False
+    for line in fragment.split("\n"):
+        code = line.split("#", maxsplit=1)[0]
+        if not code.strip():
+            continue
+        if not code[0].isspace():
+            # Start of a new rule or pragma
+            lhs, arrow, rest = code.partition("→")
+            in_rule = bool(arrow) and lhs.strip() == "Query"
+            if in_rule:
+                rhs.append(rest)
+        elif in_rule:
+            rhs.append(code)
+    result: Set[str] = set()
+    for alt in re.split(r"[|>]", " ".join(rhs)):
+        symbols = alt.split()
+        if not symbols:
+            continue
+        first = symbols[0]
+        if not first[0].isupper():
+            # Starts with a terminal, a literal or a group
+            return None
+        # The tree contains the base name of the nonterminal,
+        # possibly with a repeat suffix
+        result.add(first.split("_")[0].rstrip("?*+"))
+    return result
+
+
 def beautify_query(query: str) -> str:
     """ Return a minimally beautified version of the given query string """
     # Make sure the query starts with an uppercase letter
@@ -232,8 +271,21 @@ class Query:
 
     # Processors that handle parse trees
     _tree_processors: List[ModuleType] = []
+    # Index of tree processors by the nonterminals that begin
+    # the alternatives of the Query rule in their grammar fragments
+    _tree_processor_index: Dict[str, List[ModuleType]] = dict()
+    # Tree processors whose grammar can't be indexed, and are always invoked
+    _unindexed_tree_processors: List[ModuleType] = []
+    # Cumulative per-processor statistics: calls, answers and seconds
+    _processor_stats: Dict[str, List[float]] = defaultdict(lambda: [0, 0, 0.0])
     # Handler functions within processors that handle plain text
     _text_processors: List[Callable[["Query"], bool]] = []
+    # Combined matcher for the trigger keywords of the text processors,
+    # and the handlers owning each keyword (including those owning its prefixes)
+    _text_trigger_rx: Optional[Pattern[str]] = None
+    _text_trigger_owners: Dict[str, FrozenSet[Callable[["Query"], bool]]] = dict()
+    # Text processors without trigger keywords, which are always invoked
+    _untriggered_text_processors: FrozenSet[Callable[["Query"], bool]] = frozenset()
     # Singleton instance of the query parser
     _parser: Optional[QueryParser] = None
     # Help texts associated with lemmas
@@ -275,6 +327,8 @@ class Query:
         self._toklist: Optional[List[Tok]] = None
         # Expiration timestamp, if any
         self._expires: Optional[datetime] = None
+        # True if the full (non-voice) response can be cached until it expires
+        self._cacheable = False
         # URL assocated with query, can be set by query response handler
         # and subsequently provided to the remote client
         self._url: Optional[str] = None
@@ -289,6 +343,12 @@ class Query:
         # Query context, which is None until fetched via self.fetch_context()
         # This should be a dict that can be represented in JSON
         self._context: Optional[ContextDict] = None
+        # The parse forest of the query, kept for debugging output
+        self._forest: Any = None
+        # Time spent in each stage of query processing, in seconds
+        self._timing: Dict[str, float] = defaultdict(float)
+        # Time spent in each tree processor invoked, in seconds
+        self._processor_timing: Dict[str, float] = dict()
 
     def _preprocess_query_string(self, q: str) -> str:
         """ Preprocess the query string prior to further analysis """
@@ -311,6 +371,8 @@ class Query:
         all_procs = []
         tree_procs = []
         text_procs = []
+        triggers: Dict[str, Set[Callable[["Query"], bool]]] = defaultdict(set)
+        untriggered: Set[Callable[["Query"], bool]] = set()
         # Load the query processor modules found in the
         # queries directory. The modules can be tree and/or text processors,
         # and we sort them into two lists, accordingly.
@@ -327,21 +389,44 @@ class Query:
                     # This is a text processor:
                     # store a reference to its handler function
                     text_procs.append(handle_plain_text)
+                    # Modules can declare keywords, one of which must
+                    # occur in the lowercase query for the handler to match
+                    keywords = getattr(m, "PLAIN_TEXT_TRIGGERS", None)
+                    if keywords:
+                        for kw in keywords:
+                            triggers[kw].add(handle_plain_text)
+                    else:
+                        untriggered.add(handle_plain_text)
             except ImportError as e:
                 logging.error(
                     "Error importing query processor module {0}: {1}".format(modname, e)
                 )
         cls._tree_processors = tree_procs
         cls._text_processors = text_procs
+        cls._untriggered_text_processors = frozenset(untriggered)
+        cls._init_text_triggers(triggers)
 
-        # Obtain query grammar fragments from the tree processors
+        # Obtain query grammar fragments from the tree processors,
+        # and index the processors by the top level alternatives
+        # of the Query nonterminal in their fragments
         grammar_fragments = []
+        index: Dict[str, List[ModuleType]] = defaultdict(list)
+        unindexed: List[ModuleType] = []
         for processor in tree_procs:
             # Check whether this tree processor supplies a query grammar fragment
             fragment = getattr(processor, "GRAMMAR", None)
+            alternatives = None
             if fragment and isinstance(fragment, str):
                 # Looks legit: add it to our list
                 grammar_fragments.append(fragment)
+                alternatives = _query_alternatives(fragment)
+            if alternatives:
+                for nt in alternatives:
+                    index[nt].append(processor)
+            else:
+                unindexed.append(processor)
+        cls._tree_processor_index = dict(index)
+        cls._unindexed_tree_processors = unindexed
 
         # Collect topic lemmas that can be used to provide
         # context-sensitive help texts when queries cannot be parsed
@@ -366,15 +451,20 @@ class Query:
         cls._parser = QueryParser(grammar_additions)
 
     @staticmethod
-    def _parse(toklist: Iterable[Tok]) -> Tuple[ResponseDict, Dict[int, str]]:
-        """ Parse a token list as a query """
+    def _parse(
+        toklist: Iterable[Tok], timing: Optional[Dict[str, float]] = None
+    ) -> Tuple[ResponseDict, Dict[int, Any]]:
+        """ Parse a token list as a query, returning the (reduced)
+            parse forests of the successfully parsed sentences """
         bp = Query._parser
         assert bp is not None
         num_sent = 0
         num_parsed_sent = 0
         rdc = Reducer(bp.grammar)
-        trees: Dict[int, str] = dict()
+        forests: Dict[int, Any] = dict()
         sent: List[Tok] = []
+        if timing is None:
+            timing = defaultdict(float)
 
         for t in toklist:
             if t[0] == TOK.S_BEGIN:
@@ -388,19 +478,22 @@ class Query:
                 num = 0
                 try:
                     # Parse the sentence
+                    t0 = time.perf_counter()
                     forest = bp.go(sent)
+                    t1 = time.perf_counter()
+                    timing["parse"] += t1 - t0
                     if forest is not None:
                         num = Fast_Parser.num_combinations(forest)
                         if num > 1:
                             # Reduce the resulting forest
                             forest = rdc.go(forest)
+                            timing["reduce"] += time.perf_counter() - t1
                 except ParseError:
                     forest = None
                     num = 0
                 if num > 0:
                     num_parsed_sent += 1
-                    # Obtain a text representation of the parse tree
-                    trees[num_sent] = ParseForestDumper.dump_forest(forest)
+                    forests[num_sent] = forest
 
             elif t[0] == TOK.P_BEGIN:
                 pass
@@ -410,7 +503,7 @@ class Query:
                 sent.append(t)
 
         result: ResponseDict = dict(num_sent=num_sent, num_parsed_sent=num_parsed_sent)
-        return result, trees
+        return result, forests
 
     @staticmethod
     def _query_string_from_toklist(toklist: Iterable[Tok]) -> str:
@@ -432,6 +525,7 @@ class Query:
     def parse(self, result: ResponseDict) -> bool:
         """ Parse the query from its string, returning True if valid """
         self._tree = None  # Erase previous tree, if any
+        self._forest = None
         self._error = None  # Erase previous error, if any
         self._qtype = None  # Erase previous query type, if any
         self._key = None
@@ -443,7 +537,9 @@ class Query:
             return False
 
         # Tokenize and auto-capitalize the query string
+        t0 = time.perf_counter()
         toklist = list(tokenize(q, auto_uppercase=self._auto_uppercase and q.islower()))
+        self._timing["tokenize"] += time.perf_counter() - t0
 
         actual_q = self._query_string_from_toklist(toklist)
 
@@ -459,9 +555,9 @@ class Query:
             # Log the query string as seen by the parser
             print("Query is: '{0}'".format(actual_q))
 
-        parse_result, trees = Query._parse(toklist)
+        parse_result, forests = Query._parse(toklist, self._timing)
 
-        if not trees:
+        if not forests:
             # No parse at all
             self.set_error("E_NO_PARSE_TREES")
             return False
@@ -476,30 +572,106 @@ class Query:
             # Unable to parse the single sentence
             self.set_error("E_NO_PARSE")
             return False
-        if 1 not in trees:
+        if 1 not in forests:
             # No sentence number 1
             self.set_error("E_NO_FIRST_SENTENCE")
             return False
         # Looks good
-        # Store the resulting parsed query as a tree
-        tree_string = "S1\n" + trees[1]
+        # Store the resulting parsed query as a tree, built directly
+        # from the parse forest without a round trip through text
+        self._forest = forests[1]
         if Settings.DEBUG:
-            print(tree_string)
+            print(self.tree_text())
+        t0 = time.perf_counter()
         self._tree = Tree()
-        self._tree.load(tree_string)
+        self._tree.load_forest(1, self._forest)
+        self._timing["tree"] += time.perf_counter() - t0
         # Store the token list
         self._toklist = toklist
         return True
 
+    def tree_text(self) -> Optional[str]:
+        """ Return the parse tree of the query in the text format
+            of the scraper database, or None if not parsed """
+        if self._forest is None:
+            return None
+        return "S1\n" + ParseForestDumper.dump_forest(self._forest)
+
+    @classmethod
+    def _init_text_triggers(
+        cls, triggers: Dict[str, Set[Callable[["Query"], bool]]]
+    ) -> None:
+        """ Compile the trigger keywords of the text processors
+            into a single matcher """
+        if not triggers:
+            cls._text_trigger_rx = None
+            cls._text_trigger_owners = dict()
+            return
+        # The lookahead finds the longest keyword starting at each position
+        # in the query. Any shorter keywords that are prefixes of it also
+        # occur there, so their handlers are included in its owners.
+        keywords = sorted(triggers, key=len, reverse=True)
+        cls._text_trigger_rx = re.compile(
+            "(?=(" + "|".join(re.escape(kw) for kw in keywords) + "))"
+        )
+        owners: Dict[str, FrozenSet[Callable[["Query"], bool]]] = dict()
+        for kw in keywords:
+            handlers: Set[Callable[["Query"], bool]] = set()
+            for prefix, prefix_handlers in triggers.items():
+                if kw.startswith(prefix):
+                    handlers |= prefix_handlers
+            owners[kw] = frozenset(handlers)
+        cls._text_trigger_owners = owners
+
+    def _candidate_text_processors(self) -> List[Callable[["Query"], bool]]:
+        """ Return the text processors whose trigger keywords occur in
+            the query, along with those that have no trigger keywords """
+        candidates = set(self._untriggered_text_processors)
+        rx = self._text_trigger_rx
+        if rx is not None:
+            owners = self._text_trigger_owners
+            for m in rx.finditer(self.query_lower):
+                candidates.update(owners[m.group(1)])
+        # Keep the original order of the processors
+        return [h for h in self._text_processors if h in candidates]
+
     def execute_from_plain_text(self) -> bool:
         """ Attempt to execute a plain text query, without having to parse it """
         if not self._query:
             return False
-        # Call the handle_plain_text() function in each text processor,
-        # until we find one that returns True, or return False otherwise
-        return any(
-            handle_plain_text(self) for handle_plain_text in self._text_processors
-        )
+        # Call the handle_plain_text() function in each text processor
+        # that may match the query, until we find one that returns True,
+        # or return False otherwise
+        t0 = time.perf_counter()
+        try:
+            return any(
+                handle_plain_text(self)
+                for handle_plain_text in self._candidate_text_processors()
+            )
+        finally:
+            self._timing["plain_text"] += time.perf_counter() - t0
+
+    def _candidate_tree_processors(self) -> List[ModuleType]:
+        """ Return the tree processors that may handle the parsed query,
+            found via the nonterminals below the Query node in the tree """
+        assert self._tree is not None
+        root = self._tree[1]
+        # The tree is QueryRoot -> Query -> (alternative)
+        query_node = root.child if root is not None else None
+        owners: Set[ModuleType] = set()
+        if query_node is not None:
+            for child in query_node.children():
+                nt_base = getattr(child, "nt_base", None)
+                if nt_base is not None:
+                    owners.update(
+                        self._tree_processor_index.get(nt_base.rstrip("?*+"), [])
+                    )
+        if not owners:
+            # Not found in the index: fall back to trying all processors
+            return self._tree_processors
+        unindexed = self._unindexed_tree_processors
+        # Keep the original order of the processors
+        return [p for p in self._tree_processors if p in owners or p in unindexed]
 
     def execute_from_tree(self) -> bool:
         """ Execute the query contained in the previously parsed tree;
@@ -507,22 +679,50 @@ class Query:
         if self._tree is None:
             self.set_error("E_QUERY_NOT_PARSED")
             return False
-        for processor in self._tree_processors:
-            self._error = None
-            self._qtype = None
-            # Process the tree, which has only one sentence
-            try:
-                self._tree.process(self._session, processor, query=self)
-                if self._answer and self._error is None:
+        t0 = time.perf_counter()
+        try:
+            for processor in self._candidate_tree_processors():
+                self._error = None
+                self._qtype = None
+                # Process the tree, which has only one sentence
+                t1 = time.perf_counter()
+                answered = False
+                try:
+                    self._tree.process(self._session, processor, query=self)
+                    answered = bool(self._answer and self._error is None)
+                except Exception as e:
+                    logging.error(
+                        f"Exception in execute_from_tree('{processor.__name__}') "
+                        f"for query '{self._query}': {e}"
+                    )
+                finally:
+                    elapsed = time.perf_counter() - t1
+                    self._processor_timing[processor.__name__] = elapsed
+                    st = self._processor_stats[processor.__name__]
+                    st[0] += 1
+                    st[1] += int(answered)
+                    st[2] += elapsed
+                if answered:
                     # The processor successfully answered the query
                     return True
-            except Exception as e:
-                logging.error(
-                    f"Exception in execute_from_tree('{processor.__name__}') "
-                    f"for query '{self._query}': {e}"
-                )
-        # No processor was able to answer the query
-        return False
+            # No processor was able to answer the query
+            return False
+        finally:
+            self._timing["dispatch"] += time.perf_counter() - t0
+
+    @classmethod
+    def processor_stats(cls) -> Dict[str, Dict[str, float]]:
+        """ Return cumulative statistics on the tree processors invoked
+            in this process: number of calls and answers, and the average
+            time per call in milliseconds """
+        return {
+            name: dict(
+                calls=calls,
+                answers=answers,
+                avg_ms=round(1000.0 * total / calls, 3) if calls else 0.0,
+            )
+            for name, (calls, answers, total) in cls._processor_stats.items()
+        }
 
     def last_answer(self, *, within_minutes: int = 5) -> Optional[Tuple[str, str]]:
         """ Return the last answer given to this client, by default
@@ -612,6 +812,16 @@ class Query:
         """ Set an expiration time stamp for this query answer """
         self._expires = ts
 
+    @property
+    def cacheable(self) -> bool:
+        """ True if the detailed response to this query, and not only
+            the voice answer, can be cached until it expires """
+        return self._cacheable
+
+    def set_cacheable(self, cacheable: bool = True) -> None:
+        """ Mark the detailed response to this query as cacheable """
+        self._cacheable = cacheable
+
     @property
     def url(self) -> Optional[str]:
         """ URL answer associated with this query """
@@ -812,10 +1022,31 @@ class Query:
             result["answer"] = result["voice"] = help_text_func(lemma)
             result["valid"] = True
 
+    def timing(self) -> Dict[str, float]:
+        """ Return the time spent in each stage of query processing,
+            in milliseconds """
+        return {stage: round(1000.0 * t, 3) for stage, t in self._timing.items()}
+
+    def processor_timing(self) -> Dict[str, float]:
+        """ Return the time spent in each tree processor that was
+            invoked for this query, in milliseconds """
+        return {
+            name: round(1000.0 * t, 3) for name, t in self._processor_timing.items()
+        }
+
     def execute(self) -> ResponseDict:
         """ Check whether the parse tree is describes a query, and if so,
             execute the query, store the query answer in the result dictionary
             and return True """
+        result = self._execute()
+        if Settings.DEBUG:
+            # Include per-stage and per-processor timing information in the result
+            result["timing"] = self.timing()
+            result["processor_timing"] = self.processor_timing()
+        return result
+
+    def _execute(self) -> ResponseDict:
+        """ Execute the query, returning a result dictionary """
         if Query._parser is None:
             Query.init_class()
         # By default, the result object contains the 'raw' query
@@ -1010,6 +1241,46 @@ def process_query(
             # in decreasing priority order
             it = q
 
+        def log_result(
+            clean_q: str,
+            result: ResponseDict,
+            expires: Optional[datetime],
+            context: Optional[Dict[str, Any]],
+        ) -> None:
+            """ Log a successfully answered query """
+            try:
+                # Standard query logging
+                qrow = QueryRow(
+                    timestamp=now,
+                    interpretations=it,
+                    question=clean_q,
+                    # bquestion is the beautified query string
+                    bquestion=result["q"],
+                    answer=result["answer"],
+                    voice=result.get("voice"),
+                    # Only put an expiration on voice queries
+                    expires=expires,
+                    qtype=result.get("qtype"),
+                    key=result.get("key"),
+                    latitude=location[0] if location else None,
+                    longitude=location[1] if location else None,
+                    # Client identifier
+                    client_id=client_id,
+                    client_type=client_type or None,
+                    client_version=client_version or None,
+                    # IP address
+                    remote_addr=remote_addr or None,
+                    # Context dict, stored as JSON, if present
+                    # (set during query execution)
+                    context=context,
+                    # All other fields are set to NULL
+                )
+                session.add(qrow)
+                # Also log anonymised query
+                session.add(QueryLog.from_Query(qrow))
+            except Exception as e:
+                logging.error("Error logging query: {0}".format(e))
+
         # Iterate through the submitted query strings,
         # assuming that they are in decreasing order of probability,
         # attempting to execute them in turn until we find
@@ -1027,8 +1298,28 @@ def process_query(
                 first_clean_q = clean_q
                 first_qtext = qtext
 
-            # First, look in the query cache for the same question
+            # First, look in the in-memory answer cache
+            cache_key = None
+            if not bypass_cache:
+                cache_key = AnswerCache.key(clean_q, voice, client_type, location)
+                cached = AnswerCache.get(cache_key, now)
+                if cached is not None:
+                    result = cached.result
+                    result["q_raw"] = qtext
+                    if not private:
+                        # Log the answer as if the query had been processed,
+                        # so that follow-up queries see its context
+                        log_result(
+                            clean_q,
+                            result,
+                            cached.expires if voice else None,
+                            cached.context,
+                        )
+                    return result
+
+            # Then, look in the query cache for the same question
             # (in lower case), having a not-expired answer
+            t0 = time.perf_counter()
             cached_answer = None
             if voice and not bypass_cache:
                 # Only use the cache for voice queries
@@ -1057,6 +1348,14 @@ def process_query(
                     qtype=a.qtype,
                     key=a.key,
                 )
+                if cache_key is not None:
+                    AnswerCache.put(
+                        cache_key,
+                        result,
+                        a.expires,
+                        1000.0 * (time.perf_counter() - t0),
+                        a.context,
+                    )
                 # !!! TBD: Log the cached answer as well?
                 return result
 
@@ -1067,40 +1366,22 @@ def process_query(
             result = query.execute()
             if result["valid"] and "error" not in result:
                 # Successful: our job is done
+                if cache_key is not None and (voice or query.cacheable):
+                    # Cache the answer in memory until it expires, if the query
+                    # module set an expiration time. Detailed (non-voice)
+                    # responses are only cached if the module allows it.
+                    AnswerCache.put(
+                        cache_key,
+                        result,
+                        query.expires,
+                        1000.0 * (time.perf_counter() - t0),
+                        query.context,
+                    )
                 if not private:
                     # If not in private mode, log the result
-                    try:
-                        # Standard query logging
-                        qrow = QueryRow(
-                            timestamp=now,
-                            interpretations=it,
-                            question=clean_q,
-                            # bquestion is the beautified query string
-                            bquestion=result["q"],
-                            answer=result["answer"],
-                            voice=result.get("voice"),
-                            # Only put an expiration on voice queries
-                            expires=query.expires if voice else None,
-                            qtype=result.get("qtype"),
-                            key=result.get("key"),
-                            latitude=location[0] if location else None,
-                            longitude=location[1] if location else None,
-                            # Client identifier
-                            client_id=client_id,
-                            client_type=client_type or None,
-                            client_version=client_version or None,
-                            # IP address
-                            remote_addr=remote_addr or None,
-                            # Context dict, stored as JSON, if present
-                            # (set during query execution)
-                            context=query.context,
-                            # All other fields are set to NULL
-                        )
-                        session.add(qrow)
-                        # Also log anonymised query
-                        session.add(QueryLog.from_Query(qrow))
-                    except Exception as e:
-                        logging.error("Error logging query: {0}".format(e))
+                    log_result(
+                        clean_q, result, query.expires if voice else None, query.context
+                    )
                 return result
 
         # Failed to answer the query, i.e. no query processor
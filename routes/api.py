@@ -40,6 +40,7 @@ from reynir.binparser import canonicalize_token
 from article import Article as ArticleProxy
 from query import process_query
 from query import Query as QueryObject
+from answercache import AnswerCache
 from doc import SUPPORTED_DOC_MIMETYPES, MIMETYPE_TO_DOC_CLASS
 from speech import get_synthesized_text_url
 from util import greynir_api_key
@@ -463,6 +464,13 @@ def query_api(version=1):
     return better_jsonify(**result)
 
 
+@routes.route("/query_cache.api", methods=["GET", "POST"])
+def query_cache_api():
+    """ Return the counters of the in-memory query answer cache
+        of this server process """
+    return better_jsonify(valid=True, **AnswerCache.stats())
+
+
 @routes.route("/query_history.api", methods=["GET", "POST"])
 @routes.route("/query_history.api/v<int:version>", methods=["GET", "POST"])
 def query_history_api(version=1):
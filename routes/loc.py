@@ -127,7 +127,7 @@ def icemap_markers(days=_TOP_LOC_PERIOD):
         q = (
             session.query(Location.name, Location.latitude, Location.longitude)
             .join(Article)
-            .filter(Article.tree != None)
+            .filter(Article.has_tree)
             .filter(Article.timestamp != None)
             .filter(Article.timestamp <= datetime.utcnow())
             .filter(Article.heading > "")
@@ -152,7 +152,7 @@ def world_map_data(days=_TOP_LOC_PERIOD):
             session.query(Location.country, dbfunc.count(Location.id))
             .filter(Location.country != None)
             .join(Article)
-            .filter(Article.tree != None)
+            .filter(Article.has_tree)
             .filter(Article.timestamp != None)
             .filter(Article.timestamp <= datetime.utcnow())
             .filter(Article.heading > "")
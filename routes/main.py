@@ -42,6 +42,7 @@ from settings import Settings
 from article import Article as ArticleProxy
 from search import Search
 from treeutil import TreeUtility
+from treepack import unpack_tokens
 from images import get_image_url, update_broken_image_url, blacklist_image_url
 from doc import SUPPORTED_DOC_MIMETYPES
 
@@ -305,8 +306,8 @@ def parsefail():
 
     with SessionContext(read_only=True) as session:
         q = (
-            session.query(Article.id, Article.timestamp, Article.tokens)
-            .filter(Article.tree != None)
+            session.query(Article.id, Article.timestamp, Article.tokens, Article.packed)
+            .filter(Article.has_tree)
             .filter(Article.timestamp != None)
             .filter(Article.timestamp <= datetime.utcnow())
             .filter(Article.heading > "")
@@ -320,7 +321,7 @@ def parsefail():
 
         for a in q.all():
             try:
-                tokens = json.loads(a.tokens)
+                tokens = json.loads(a.tokens) if a.tokens else unpack_tokens(a.packed)
             except Exception:
                 continue
             # Paragraphs
@@ -56,7 +56,7 @@ def fetch_articles(
     with SessionContext(read_only=True, session=enclosing_session) as session:
         q = (
             session.query(Article)
-            .filter(Article.tree != None)
+            .filter(Article.has_tree)
             .filter(Article.timestamp != None)
             .filter(Article.timestamp <= datetime.utcnow())
             .filter(Article.heading > "")
@@ -35,7 +35,9 @@ import os
 import gc
 import getopt
 import time
+import hashlib
 import logging
+from datetime import datetime, timedelta
 
 import traceback
 
@@ -43,10 +45,16 @@ import traceback
 # for instance for debugging
 # from multiprocessing.dummy import Pool
 # cpu_count = lambda: 1
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, Process, Pipe, cpu_count
+from multiprocessing.connection import wait
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import resource
 
 from settings import Settings, ConfigError
-from fetcher import Fetcher
+from fetcher import Fetcher, HttpPool
+from parsecache import ParseCache
+from nertokenizer import EntityNames
 from article import Article
 
 from db import SessionContext, IntegrityError
@@ -66,6 +74,176 @@ class ArticleDescr:
         self.url = url
 
 
+def current_rss_mb():
+    """ Return the resident set size of the current process, in megabytes """
+    try:
+        # Linux: the second field of /proc/self/statm is the RSS in pages
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # Fall back to the peak RSS, which is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ParserPool:
+
+    """ A long-lived pool of parser worker processes. The workers are
+        forked from the parent after it has loaded the grammar and parser,
+        so they share those data structures copy-on-write. Articles are
+        streamed to the workers as they become free, and a worker retires
+        (and is replaced by a fresh fork) when its resident memory exceeds
+        a threshold. A worker that dies while parsing an article is
+        replaced, and the article is given to another worker. """
+
+    # Worker message types
+    _DONE = 0
+    _RETIRE = 1
+
+    # Number of times an article is retried after its worker died
+    _MAX_RETRIES = 1
+
+    def __init__(self, scraper, numprocs, max_rss_mb=0):
+        self._scraper = scraper
+        self._numprocs = max(1, numprocs)
+        self._max_rss_mb = max_rss_mb
+        # Worker processes and the parent's end of their pipes, by pid
+        self._workers = dict()
+        # The article being processed by each worker, if any
+        self._busy = dict()
+        # Articles to be retried, and the number of retries of each
+        self._retry = deque()
+        self._retries = dict()
+
+    @staticmethod
+    def _worker(scraper, conn, max_rss_mb):
+        """ The main loop of a worker process """
+        # Start with a fresh connection pool in the child. Connections
+        # that the parent had checked out when it forked, such as the one
+        # streaming the articles, are never used or closed by the child.
+        SessionContext.dispose()
+        while True:
+            d = conn.recv()
+            if d is None:
+                # Sentinel: no more work
+                break
+            scraper._parse_single_article(d)
+            if max_rss_mb and current_rss_mb() > max_rss_mb:
+                # Grown too large: retire and let the parent fork a fresh worker
+                conn.send(ParserPool._RETIRE)
+                break
+            conn.send(ParserPool._DONE)
+        ParseCache.log_stats()
+
+    def _start_worker(self):
+        """ Fork a new worker process, returning its pid """
+        # Close the idle pooled database connections of the parent, so
+        # that the child doesn't inherit them when it disposes of its
+        # copy of the pool (closing them there would end them for the
+        # parent as well)
+        SessionContext.dispose()
+        conn, child_conn = Pipe()
+        p = Process(
+            target=self._worker, args=(self._scraper, child_conn, self._max_rss_mb)
+        )
+        p.daemon = True
+        p.start()
+        child_conn.close()
+        self._workers[p.pid] = (p, conn)
+        return p.pid
+
+    def _assign(self, pid, it):
+        """ Give the next article, if any, to the given worker """
+        d = self._retry.popleft() if self._retry else next(it, None)
+        if d is not None:
+            self._workers[pid][1].send(d)
+            self._busy[pid] = d
+
+    def _reap(self, pid):
+        """ Remove a finished worker """
+        p, conn = self._workers.pop(pid)
+        p.join()
+        conn.close()
+
+    def _died(self, pid):
+        """ Handle a worker that died without reporting back, for instance
+            because of a MemoryError. Its article is queued for a retry,
+            unless it has already been retried. Returns True if the
+            article is abandoned. """
+        p, _ = self._workers[pid]
+        self._reap(pid)
+        d = self._busy.pop(pid, None)
+        logging.warning(
+            "Parser worker {0} died with exit code {1}".format(pid, p.exitcode)
+        )
+        if d is None:
+            return False
+        retries = self._retries.get(d.seq, 0)
+        if retries >= self._MAX_RETRIES:
+            logging.warning("Giving up on parsing article {0}".format(d.url))
+            return True
+        self._retries[d.seq] = retries + 1
+        self._retry.append(d)
+        return False
+
+    def run(self, descriptors):
+        """ Parse the articles described by the descriptors iterable,
+            returning the number of articles processed """
+        it = iter(descriptors)
+        cnt = 0
+        try:
+            for _ in range(self._numprocs):
+                self._assign(self._start_worker(), it)
+            while self._busy:
+                # Wait for a message from a worker, or for a worker to exit
+                waitables = dict()
+                for pid, (p, conn) in self._workers.items():
+                    waitables[conn] = pid
+                    waitables[p.sentinel] = pid
+                for pid in set(waitables[w] for w in wait(list(waitables))):
+                    p, conn = self._workers[pid]
+                    try:
+                        kind = conn.recv() if conn.poll() else None
+                    except EOFError:
+                        # The worker closed its end of the pipe: let it exit
+                        p.join()
+                        kind = None
+                    if kind is None:
+                        if p.is_alive():
+                            # Spurious wakeup
+                            continue
+                        if self._died(pid):
+                            cnt += 1
+                        pid = self._start_worker()
+                        self._assign(pid, it)
+                        continue
+                    cnt += 1
+                    d = self._busy.pop(pid, None)
+                    if kind == self._RETIRE:
+                        logging.info(
+                            "Parser worker {0} retiring after article {1}, "
+                            "exceeding {2} MB".format(pid, d.seq, self._max_rss_mb)
+                        )
+                        self._reap(pid)
+                        pid = self._start_worker()
+                    self._assign(pid, it)
+                    if cnt % 100 == 0:
+                        logging.info("Parser pool: {0} articles parsed".format(cnt))
+        finally:
+            # Tell the workers to finish, and wait for them
+            for p, conn in self._workers.values():
+                try:
+                    conn.send(None)
+                except OSError:
+                    # The worker has already exited
+                    pass
+            for p, conn in self._workers.values():
+                p.join()
+                conn.close()
+            self._workers.clear()
+        return cnt
+
+
 class Scraper:
 
     """ The worker class that scrapes the known roots """
@@ -74,20 +252,53 @@ class Scraper:
 
         logging.info("Initializing scraper instance")
 
-    def urls2fetch(self, root, helper):
+    def urls2fetch(self, root, helper, validators=None):
         """ Returns a set of URLs to fetch. If the scraper helper class has
             associated RSS feed URLs, these are used to acquire article URLs.
             Otherwise, the URLs are found by scraping the root website and
-            searching for links to subpages. """
+            searching for links to subpages.
+            If a validators dict is given, it is used to make conditional
+            requests, and is updated with fresh validators and content hashes
+            (keyed by URL). Documents that have not changed since the
+            last fetch are skipped. """
         fetch_set = set()
         feeds = None if helper is None else helper.feeds
+        if validators is None:
+            validators = dict()
 
         if feeds:
 
             for feed_url in feeds:
                 logging.info("Fetching feed {0}".format(feed_url))
+                v = validators.get(feed_url) or dict()
                 try:
-                    d = feedparser.parse(feed_url)
+                    # Fetch the feed via the connection pool and hand
+                    # the raw bytes to feedparser, which takes care of
+                    # the character encoding
+                    headers = Fetcher.conditional_headers(
+                        v.get("etag"), v.get("last_modified")
+                    )
+                    r = Fetcher.http_pool().get(feed_url, headers=headers)
+                    if r.status_code == 304:
+                        logging.info("Feed {0} not modified".format(feed_url))
+                        continue
+                    if r.status_code != 200:
+                        logging.warning(
+                            "HTTP status {0} for feed {1}".format(
+                                r.status_code, feed_url
+                            )
+                        )
+                        continue
+                    h = hashlib.sha256(r.content).hexdigest()
+                    validators[feed_url] = dict(
+                        etag=r.headers.get("ETag"),
+                        last_modified=r.headers.get("Last-Modified"),
+                        hash=h,
+                    )
+                    if h == v.get("hash"):
+                        logging.info("Feed {0} unchanged".format(feed_url))
+                        continue
+                    d = feedparser.parse(r.content)
                 except Exception as e:
                     logging.warning(
                         "Error fetching/parsing feed {0}: {1}".format(feed_url, str(e))
@@ -104,13 +315,30 @@ class Scraper:
             logging.info("Fetching root {0}".format(root.url))
 
             # Read the HTML document at the root URL
-            html_doc = Fetcher.raw_fetch_url(root.url)
+            v = validators.get(root.url) or dict()
+            html_doc, etag, last_modified, not_modified = Fetcher.conditional_fetch_url(
+                root.url, v.get("etag"), v.get("last_modified")
+            )
+            if not_modified:
+                logging.info("Root {0} not modified".format(root.url))
+                return fetch_set
             if not html_doc:
                 logging.warning("Unable to fetch root {0}".format(root.url))
-                return
+                return fetch_set
 
             # Parse the HTML document
             soup = Fetcher.make_soup(html_doc)
+            if soup is None:
+                logging.warning("Unable to parse root {0}".format(root.url))
+                return fetch_set
+
+            # Hash the normalized text of the page, so that changes in
+            # markup, whitespace or embedded scripts don't count as changes
+            h = Fetcher.content_hash(soup.html.body or soup.html)
+            validators[root.url] = dict(etag=etag, last_modified=last_modified, hash=h)
+            if h == v.get("hash"):
+                logging.info("Root {0} unchanged".format(root.url))
+                return fetch_set
 
             # Obtain the set of child URLs to fetch
             fetch_set = Fetcher.children(root, soup)
@@ -122,12 +350,16 @@ class Scraper:
 
         t0 = time.time()
 
-        fetch_set = self.urls2fetch(root, helper)
+        validators = dict(root.validators or {})
+        fetch_set = self.urls2fetch(root, helper, validators)
 
         # Add the children whose URLs we don't already have
         # stored in the scraper articles table
         with SessionContext() as session:
 
+            # Set if any child URL could not be stored
+            failed = False
+
             for url in fetch_set:
 
                 if helper and helper.skip_url(url):
@@ -155,6 +387,18 @@ class Scraper:
                         )
                     )
                     session.rollback()
+                    failed = True
+
+            # Store the cache validators for the next scrape of this root,
+            # unless some child URLs were lost, in which case the root must
+            # be fetched again in full next time
+            values = {Root.scraped: datetime.utcnow()}
+            if not failed:
+                values[Root.validators] = validators
+            session.query(Root).filter(Root.id == root.id).update(
+                values, synchronize_session=False
+            )
+            session.commit()
 
         t1 = time.time()
 
@@ -176,6 +420,8 @@ class Scraper:
 
             a = Article.scrape_from_url(url, session)
             if a is not None:
+                if a.unchanged:
+                    logging.info("Article {0} is unchanged".format(url))
                 a.store(session)
 
         t1 = time.time()
@@ -238,6 +484,18 @@ class Scraper:
             if Settings.DEBUG:
                 traceback.print_stack()
 
+    def _scrape_article_batch(self, batch):
+        """ Scrape a batch of articles within a single process of a
+            multiprocessing pool, using a pool of threads so that many
+            fetches can be in flight at the same time. Returns the
+            fetch statistics of the process for the batch. """
+        pool = Fetcher.http_pool()
+        pool.reset_stats()
+        with ThreadPool(min(Settings.FETCH_THREADS or 1, len(batch))) as tpool:
+            for _ in tpool.imap_unordered(self._scrape_single_article, batch):
+                pass
+        return pool.stats()
+
     def _parse_single_article(self, d):
         """ Single article parser that will be called by a process within a
             multiprocessing pool """
@@ -267,33 +525,34 @@ class Scraper:
 
         with SessionContext(commit=True) as session:
 
-            # Use a multiprocessing pool to parse the articles.
-            # Let the pool work on chunks of articles, recycling the
-            # processes after each chunk to contain memory creep.
+            # Use multiprocessing pools to scrape and parse the articles.
             # Default to using as many processes as there are CPUs
             CPU_COUNT = numprocs or cpu_count() or 1
 
             if urls is None and uuid is None and not reparse:
 
                 # Go through the roots and scrape them, inserting into the articles table
+                t_pass = datetime.utcnow()
 
                 def iter_roots():
                     """ Iterate the roots to be scraped """
                     for r in session.query(Root).filter(Root.scrape == True).all():
                         yield r
 
-                # Use a multiprocessing pool to scrape the roots
+                # Use a thread pool to scrape the roots, since the work is
+                # mostly waiting for the network
 
-                with Pool(CPU_COUNT) as pool:
+                with ThreadPool(Settings.FETCH_THREADS or 1) as tpool:
                     try:
-                        for _ in pool.imap_unordered(
+                        for _ in tpool.imap_unordered(
                             self._scrape_single_root, iter_roots()
                         ):
                             pass
                     except Exception as e:
                         logging.warning("Caught exception: {0}".format(e))
-                    pool.close()
-                    pool.join()
+                    tpool.close()
+                    tpool.join()
+                HttpPool.log_stats(Fetcher.http_pool().stats())
 
                 # noinspection PyComparisonWithNone
                 def iter_unscraped_articles():
@@ -310,19 +569,50 @@ class Scraper:
                     ):
                         yield ArticleDescr(seq, a.root, a.url)
                         seq += 1
+                    if Settings.RESCRAPE_DAYS <= 0:
+                        return
+                    # Re-fetch recently published articles. Their stored
+                    # cache validators and content hashes are used to skip
+                    # those that haven't changed since they were scraped
+                    since = t_pass - timedelta(days=Settings.RESCRAPE_DAYS)
+                    for a in (
+                        session.query(ArticleRow)
+                        .filter(ArticleRow.scraped != None)
+                        .filter(ArticleRow.scraped < t_pass)
+                        .filter(ArticleRow.timestamp >= since)
+                        .filter(ArticleRow.root_id != None)
+                        .yield_per(100)
+                    ):
+                        yield ArticleDescr(seq, a.root, a.url)
+                        seq += 1
 
-                # Use a multiprocessing pool to scrape the articles
-
+                def iter_batches(batch_size):
+                    """ Group the unscraped articles into batches """
+                    batch = []
+                    for ad in iter_unscraped_articles():
+                        batch.append(ad)
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+                    if batch:
+                        yield batch
+
+                # Use a multiprocessing pool to scrape the articles, where
+                # each process runs a number of fetch threads
+
+                fetch_stats = dict()
                 with Pool(CPU_COUNT) as pool:
                     try:
-                        for _ in pool.imap_unordered(
-                            self._scrape_single_article, iter_unscraped_articles()
+                        for stats in pool.imap_unordered(
+                            self._scrape_article_batch,
+                            iter_batches(4 * (Settings.FETCH_THREADS or 1)),
                         ):
-                            pass
+                            HttpPool.merge_stats(fetch_stats, stats)
                     except Exception as e:
                         logging.warning("Caught exception: {0}".format(e))
                     pool.close()
                     pool.join()
+                HttpPool.log_stats(fetch_stats)
 
             # noinspection PyComparisonWithNone
             def iter_unparsed_articles(reparse, limit):
@@ -340,7 +630,7 @@ class Scraper:
                     )
                 else:
                     # Only parse articles that have no parse tree
-                    q = q.filter(ArticleRow.tree == None)
+                    q = q.filter(~ArticleRow.has_tree)
                 q = q.filter(ArticleRow.root_id != None).yield_per(100)
                 if limit > 0:
                     # Impose a limit on the query, if given
@@ -376,50 +666,36 @@ class Scraper:
                     # Found the article: yield it
                     yield ArticleDescr(0, a.root, a.url)
 
-            # Distribute the load between the CPUs, although never exceeding
-            # 100 articles per CPU per process cycle
-            if limit > 0:
-                CHUNK_SIZE = min(100 * CPU_COUNT, limit)
-            else:
-                CHUNK_SIZE = 100 * CPU_COUNT
             if uuid is not None:
                 g = iter_uuid(uuid)
-                limit = 0
             elif urls is not None:
                 g = iter_urls(urls)
-                limit = 0
             else:
                 g = iter_unparsed_articles(reparse, limit)
+
+            # Load the grammar and parser, and the entity names used for
+            # named entity recognition, before forking the workers,
+            # so that they share them copy-on-write
+            Article.get_parser()
+            EntityNames.refresh()
+            # Run garbage collection to minimize common memory footprint,
+            # and move the surviving objects out of the collector's reach
+            # so that collections in the workers don't touch (and thereby
+            # copy) their pages
+            gc.collect()
+            if hasattr(gc, "freeze"):
+                gc.freeze()
+            logging.info("Parser processes forking")
+            pool = ParserPool(self, CPU_COUNT, Settings.PARSER_MAX_RSS)
             cnt = 0
-            while True:
-                adlist = []
-                lcnt = 0
-                for ad in g:
-                    adlist.append(ad)
-                    lcnt += 1
-                    if lcnt == CHUNK_SIZE or (0 < limit <= cnt + lcnt):
-                        break
-                if lcnt:
-                    # Run garbage collection to minimize common memory footprint
-                    gc.collect()
-                    logging.info(
-                        "Parser processes forking, chunk of {0} articles".format(lcnt)
-                    )
-                    with Pool(CPU_COUNT) as pool:
-                        try:
-                            for _ in pool.imap_unordered(self._parse_single_article, adlist):
-                                pass
-                        except Exception as e:
-                            logging.warning("Caught exception: {0}".format(e))
-                        pool.close()
-                        pool.join()
-                    cnt += lcnt
-                    logging.info(
-                        "Parser processes joined, chunk of {0} articles parsed, "
-                        "total {1}".format(lcnt, cnt)
-                    )
-                if lcnt < CHUNK_SIZE:
-                    break
+            try:
+                cnt = pool.run(g)
+            except Exception as e:
+                logging.warning("Caught exception: {0}".format(e))
+            finally:
+                if hasattr(gc, "unfreeze"):
+                    gc.unfreeze()
+            logging.info("Parser processes joined, {0} articles parsed".format(cnt))
             # Return the total number of articles parsed
             return cnt
 
@@ -538,7 +814,8 @@ __doc__ = """
         -l N, --limit=N: Limit parsing session to N articles (default 10)
 
     If --reparse is not specified, the scraper will read all previously
-    unseen articles from the root domains and then proceed to parse any
+    unseen articles from the root domains, re-fetch recent articles if the
+    rescrape_days setting is nonzero, and then proceed to parse any
     unparsed articles (up to a limit, if given).
 
 """
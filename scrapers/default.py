@@ -29,7 +29,6 @@
 import re
 import logging
 import urllib.parse as urlparse
-import requests
 from datetime import datetime
 from bs4 import BeautifulSoup, NavigableString, Tag  # type: ignore
 
@@ -1488,7 +1487,9 @@ class HagstofanScraper(ScrapeHelper):
     def fetch_url(self, url):
         # Requests defaults to ISO-8859-1 because content-type
         # does not declare encoding. In fact, charset is UTF-8.
-        r = requests.get(url)
+        from fetcher import Fetcher
+
+        r = Fetcher.http_pool().get(url)
         r.encoding = r.apparent_encoding
         return r.text
 
@@ -167,6 +167,50 @@ class Settings:
             )
         )
 
+    # Scraper HTTP fetch settings
+    # Timeout in seconds for connecting to and reading from a web server
+    FETCH_TIMEOUT = 15.0
+    # Number of retries for failed connections and transient HTTP errors
+    FETCH_RETRIES = 2
+    # Number of concurrent fetch threads within each scraper process
+    FETCH_THREADS = 32
+    # Maximum number of concurrent requests to a single domain
+    FETCH_DOMAIN_CONCURRENCY = 4
+
+    # Articles published within this many days are re-fetched on each
+    # scrape pass, with conditional requests, to pick up later edits
+    # (0 = articles are only fetched once)
+    RESCRAPE_DAYS = 0
+
+    # Resident memory limit (MB) of a parser worker process, above which
+    # the worker is retired and replaced by a fresh one (0 = no limit)
+    PARSER_MAX_RSS = 4096
+
+    # Sentence parse cache: maximum number of entries held in memory
+    # by each process, and maximum number of rows in the persistent
+    # parsecache table (0 = no persistent cache)
+    PARSE_CACHE_SIZE = 20000
+    PARSE_CACHE_DB_ROWS = 1000000
+
+    # Location resolution cache: maximum number of entries held in memory
+    # by each process, and maximum number of rows in the persistent
+    # locationcache table (0 = no persistent cache)
+    LOCATION_CACHE_SIZE = 10000
+    LOCATION_CACHE_DB_ROWS = 100000
+
+    # Store article parse trees and tokens in the compact binary format
+    # of treepack.py (the articles.packed column) instead of as text
+    PACKED_ARTICLES = False
+
+    # Maximum number of query answers held in the in-memory
+    # answer cache of each web server process (0 = no cache)
+    ANSWER_CACHE_SIZE = 10000
+
+    # Timeout (seconds) of requests to remote APIs from query modules,
+    # and maximum number of API responses cached by each process
+    API_TIMEOUT = 5.0
+    API_CACHE_SIZE = 1000
+
     # Configuration settings from the Greynir.conf file
 
     @staticmethod
@@ -203,6 +247,34 @@ class Settings:
                 Settings.SIMSERVER_PORT = int(val or 0)
             elif par == "debug":
                 Settings.DEBUG = bool(val)
+            elif par == "fetch_timeout":
+                Settings.FETCH_TIMEOUT = float(val or 0)
+            elif par == "fetch_retries":
+                Settings.FETCH_RETRIES = int(val or 0)
+            elif par == "fetch_threads":
+                Settings.FETCH_THREADS = int(val or 0)
+            elif par == "fetch_domain_concurrency":
+                Settings.FETCH_DOMAIN_CONCURRENCY = int(val or 0)
+            elif par == "rescrape_days":
+                Settings.RESCRAPE_DAYS = int(val or 0)
+            elif par == "parser_max_rss":
+                Settings.PARSER_MAX_RSS = int(val or 0)
+            elif par == "parse_cache_size":
+                Settings.PARSE_CACHE_SIZE = int(val or 0)
+            elif par == "parse_cache_db_rows":
+                Settings.PARSE_CACHE_DB_ROWS = int(val or 0)
+            elif par == "location_cache_size":
+                Settings.LOCATION_CACHE_SIZE = int(val or 0)
+            elif par == "location_cache_db_rows":
+                Settings.LOCATION_CACHE_DB_ROWS = int(val or 0)
+            elif par == "answer_cache_size":
+                Settings.ANSWER_CACHE_SIZE = int(val or 0)
+            elif par == "api_timeout":
+                Settings.API_TIMEOUT = float(val or 0)
+            elif par == "api_cache_size":
+                Settings.API_CACHE_SIZE = int(val or 0)
+            elif par == "packed_articles":
+                Settings.PACKED_ARTICLES = bool(val)
             else:
                 raise ConfigError("Unknown configuration parameter '{0}'".format(par))
         except ValueError:
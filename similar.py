@@ -167,6 +167,12 @@ class SimilarityClient:
         """ Returns a dict containing a list of (article_id, similarity) tuples """
         return self._retry_list(cmd="similar", topic=topic_vector, n=n)
 
+    def list_similar_to_topics(self, topic_vectors, n=10):
+        """ Returns a dict where the articles key contains a list
+            with a list of (article_id, similarity) tuples for each
+            of the given topic vectors """
+        return self._retry_list(cmd="similar", topics=topic_vectors, n=n)
+
     def list_similar_to_terms(self, terms, n=10):
         """ The terms are a list of (stem, category) tuples.
             Returns a dict where the articles key contains a
@@ -26,6 +26,8 @@ import os
 import json
 from urllib.parse import urlencode
 import sys
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
 
 # Shenanigans to enable Pytest to discover modules in the
 # main workspace directory (the parent of /tests)
@@ -250,6 +252,111 @@ def test_nertokenizer():
     assert recognize_entities
 
 
+def test_entity_names():
+    """ Test the in-memory trie of entity names and entity recognition
+        with it, using a stand-in for a database session """
+    import threading
+    from datetime import datetime
+    from reynir import tokenize, TOK
+    from nertokenizer import EntityNames, recognize_entities
+
+    rows = [
+        ("Bygma", datetime(2020, 1, 1)),
+        ("Bygma Gruppen", datetime(2020, 1, 2)),
+        ("Bygma Gruppen", datetime(2020, 1, 3)),
+        ("Rio Tinto Alcan", datetime(2020, 1, 4)),
+    ]
+
+    # Set to make queries wait for the release event
+    slow = threading.Event()
+    started, release = threading.Event(), threading.Event()
+
+    class Query:
+        def __init__(self):
+            self.filters = 0
+
+        def filter(self, *args):
+            self.filters += 1
+            return self
+
+        def all(self):
+            if slow.is_set():
+                started.set()
+                release.wait(5.0)
+            # A second filter is on the timestamp, for an incremental refresh
+            return rows if self.filters == 1 else rows[-1:]
+
+    class Session:
+        def __init__(self):
+            self.info = dict()
+            self.queries = 0
+            self.last = None
+
+        def query(self, *args):
+            self.queries += 1
+            self.last = Query()
+            return self.last
+
+    session = Session()
+    EntityNames.clear()
+    try:
+        EntityNames.refresh(session, force=True)
+        assert session.queries == 1
+        assert sorted(EntityNames.lookup("Bygma")) == ["Bygma", "Bygma Gruppen"]
+        assert list(EntityNames.lookup("Bygma Gruppen")) == ["Bygma Gruppen"]
+        assert list(EntityNames.lookup("Rio Tinto")) == ["Rio Tinto Alcan"]
+        assert not EntityNames.lookup("Tinto")
+        assert not EntityNames.lookup("Rio Tinto Alcan Inc")
+        # Lookups within the refresh interval don't touch the database
+        assert session.queries == 1
+        # Incremental refresh
+        rows.append(("Bygma Danmark", datetime(2020, 2, 1)))
+        EntityNames.refresh(session, force=True)
+        assert session.queries == 2
+        assert sorted(EntityNames.lookup("Bygma")) == [
+            "Bygma",
+            "Bygma Danmark",
+            "Bygma Gruppen",
+        ]
+
+        toks = list(
+            recognize_entities(
+                tokenize("Rio Tinto Alcan keypti hlut í Bygma Gruppen."),
+                enclosing_session=session,
+            )
+        )
+        entities = [t.txt for t in toks if t.kind == TOK.ENTITY]
+        assert entities == ["Rio Tinto Alcan", "Bygma Gruppen"]
+        assert session.queries == 2
+
+        # While a rebuild loads the names, lookups in other threads
+        # don't wait for it but use the current trie
+        EntityNames._next_rebuild = 0.0
+        slow.set()
+        t = threading.Thread(target=EntityNames.refresh, args=(session, True))
+        t.start()
+        assert started.wait(5.0)
+        rows.append(("Norðurál", datetime(2020, 3, 1)))
+        EntityNames._next_refresh = 0.0
+        assert list(EntityNames.lookup("Bygma Danmark", session)) == ["Bygma Danmark"]
+        assert not EntityNames.lookup("Norðurál", session)
+        release.set()
+        t.join(5.0)
+        slow.clear()
+        assert session.queries == 3 and session.last.filters == 1
+        assert list(EntityNames.lookup("Norðurál", session)) == ["Norðurál"]
+
+        # A forked process refreshes the trie it shares but doesn't rebuild it
+        EntityNames._pid = -1
+        EntityNames._next_refresh = EntityNames._next_rebuild = 0.0
+        rows.append(("Alcoa", datetime(2020, 4, 1)))
+        assert list(EntityNames.lookup("Alcoa", session)) == ["Alcoa"]
+        assert session.queries == 4 and session.last.filters == 2
+    finally:
+        release.set()
+        EntityNames.clear()
+
+
 def test_postagger():
     from postagger import NgramTagger
 
@@ -274,6 +381,793 @@ def test_scraper():
     assert Scraper
 
 
+def test_parser_pool(tmp_path, monkeypatch):
+    """ Test the recycling of parser worker processes that exceed their
+        memory limit, and the retrying of articles whose worker died """
+    from scraper import ArticleDescr, ParserPool, SessionContext
+
+    def dispose(cls):
+        # Record the processes that dispose of their connection pool
+        (tmp_path / "dispose-{0}".format(os.getpid())).touch()
+
+    monkeypatch.setattr(SessionContext, "dispose", classmethod(dispose))
+
+    class FakeScraper:
+        """ Records the pid of the worker that parses each article in a
+            file, and optionally kills the worker on a given article """
+
+        def __init__(self, crash_seq=None):
+            self.crash_seq = crash_seq
+
+        def _parse_single_article(self, d):
+            path = tmp_path / str(d.seq)
+            crashed = path.exists()
+            with open(path, "a") as f:
+                f.write("{0}\n".format(os.getpid()))
+            if d.seq == self.crash_seq and not crashed:
+                os._exit(1)
+
+    def pids(seq):
+        return (tmp_path / str(seq)).read_text().split()
+
+    articles = [ArticleDescr(seq, None, "url{0}".format(seq)) for seq in range(10)]
+
+    # A worker that exceeds the memory limit retires after each article
+    pool = ParserPool(FakeScraper(), 2, max_rss_mb=1)
+    assert pool.run(articles) == 10
+    assert len(set(pids(seq)[0] for seq in range(10))) == 10
+    # Each worker disposes of the connection pool that it inherited
+    for seq in range(10):
+        assert (tmp_path / "dispose-{0}".format(pids(seq)[0])).exists()
+
+    # Without a limit, the workers are kept
+    for path in tmp_path.iterdir():
+        path.unlink()
+    pool = ParserPool(FakeScraper(), 2)
+    assert pool.run(articles) == 10
+    assert len(set(pids(seq)[0] for seq in range(10))) <= 2
+
+    # A worker that dies is replaced, and its article is parsed again
+    for path in tmp_path.iterdir():
+        path.unlink()
+    pool = ParserPool(FakeScraper(crash_seq=3), 2)
+    assert pool.run(articles) == 10
+    assert all(len(pids(seq)) == 1 for seq in range(10) if seq != 3)
+    first, second = pids(3)
+    assert first != second
+
+
+def test_parsecache():
+    """ Test the two-level sentence parse cache, using a stand-in
+        for a database session """
+    from contextlib import contextmanager
+    from reynir import tokenize
+    from db import DatabaseError
+    from parsecache import ParseCache
+
+    class Session:
+        """ Keeps the parsecache table in a dict """
+
+        def __init__(self):
+            self.rows = dict()
+            self.info = dict()
+            self.fail = False
+            self.calls = 0
+
+        @contextmanager
+        def begin_nested(self):
+            yield
+
+        def execute(self, sql, params):
+            self.calls += 1
+            if self.fail:
+                raise DatabaseError(sql, params, Exception("No such table"))
+            sql = sql.strip()
+            if sql.startswith("select"):
+                rows = [(k, self.rows[k]) for k in params["keys"] if k in self.rows]
+                return type("Result", (), dict(fetchall=lambda self: rows))()
+            if sql.startswith("insert"):
+                for name, key in params.items():
+                    if name.startswith("k"):
+                        self.rows[key] = params["c" + name[1:]]
+            return None
+
+    tokens = list(tokenize("Hún hló."))
+    key = ParseCache.key(tokens, "1.0/2.0")
+    # The key depends on the parser and tokenizer versions and the kind
+    assert key != ParseCache.key(tokens, "1.0/2.1")
+    assert key != ParseCache.key(tokens, "1.0/2.0", "tag")
+    assert key == ParseCache.key(list(tokenize("Hún hló.")), "1.0/2.0")
+
+    ParseCache.clear()
+    session = Session()
+    value = dict(n=1, tree="S1", tokens=[dict(x="Hún")])
+    assert ParseCache.get_many(session, [key]) == dict()
+    ParseCache.put_many(session, {key: value})
+    assert session.rows
+    # Memory hit: the database is not consulted
+    calls = session.calls
+    assert ParseCache.get(session, key) == value
+    assert session.calls == calls
+    # The caller gets a fresh copy that it may modify
+    ParseCache.get(session, key)["tokens"].clear()
+    assert ParseCache.get(session, key) == value
+    # Database hit, as in another process
+    ParseCache.clear()
+    assert ParseCache.get_many(session, [key, "x"]) == {key: value}
+    st = ParseCache.stats()
+    assert st["db_hits"] == 1 and st["misses"] == 1 and st["size"] == 1
+    # A new version doesn't find the old entry
+    assert ParseCache.get(session, ParseCache.key(tokens, "1.0/2.1")) is None
+
+    # Read-only sessions are not written to
+    readonly = Session()
+    readonly.info["read_only"] = True
+    ParseCache.put(readonly, key, value)
+    assert not readonly.rows
+
+    # A database failure falls back to the memory cache,
+    # and the database is left alone for a while
+    ParseCache.clear()
+    session.fail = True
+    ParseCache.put(session, key, value)
+    assert ParseCache.get(session, key) == value
+    calls = session.calls
+    other = ParseCache.key(tokens, "1.0/2.0", "tag")
+    assert ParseCache.get(session, other) is None
+    ParseCache.put(session, other, value)
+    assert session.calls == calls
+    assert other not in session.rows
+    # Once the wait is over, the database is used again
+    session.fail = False
+    ParseCache._db_retry_at = 1.0
+    ParseCache.put(session, other, value)
+    assert other in session.rows
+    ParseCache.clear()
+
+
+def test_locationcache():
+    """ Test the location resolution cache, using a stand-in
+        for a database session """
+    from contextlib import contextmanager
+    import locationcache
+    from locationcache import LocationCache
+    from parsecache import ParseCache
+
+    class Session:
+        """ Keeps the locationcache table in a dict """
+
+        def __init__(self):
+            self.rows = dict()
+            self.info = dict()
+
+        @contextmanager
+        def begin_nested(self):
+            yield
+
+        def execute(self, sql, params):
+            sql = sql.strip()
+            assert "locationcache" in sql
+            if sql.startswith("select"):
+                rows = [(k, self.rows[k]) for k in params["keys"] if k in self.rows]
+                return type("Result", (), dict(fetchall=lambda self: rows))()
+            if sql.startswith("insert"):
+                for name, key in params.items():
+                    if name.startswith("k"):
+                        self.rows[key] = params["c" + name[1:]]
+            return None
+
+    key = LocationCache.key
+    # Placename hints only matter for addresses and streets,
+    # and their order doesn't
+    assert key("Japan", "country", ["Akureyri"]) == key("Japan", "country")
+    assert key("Laugavegur", "street", ["Akureyri"]) != key("Laugavegur", "street")
+    assert key("Laugavegur 1", "address", ["Vík", "Selfoss"]) == key(
+        "Laugavegur 1", "address", ["Selfoss", "Vík", "Vík"]
+    )
+    assert key("Skeifan", "placename", ["Vík"]) != key("Skeifan", "placename")
+    assert key("Georgía", "country") != key("Georgía", "placename")
+    # The key depends on the version of the geography resources
+    saved = locationcache.geo_version()
+    japan = key("Japan", "country")
+    locationcache._GEO_VERSION = "other"
+    assert key("Japan", "country") != japan
+    locationcache._GEO_VERSION = saved
+
+    resolved = []
+
+    def location_info(name, kind, placename_hints=None):
+        resolved.append(name)
+        return dict(name=name, kind=kind, country="JP")
+
+    real_location_info = locationcache.location_info
+    locationcache.location_info = location_info
+    try:
+        LocationCache.clear()
+        ParseCache.clear()
+        session = Session()
+        locs = [("Japan", "country"), ("Tókýó", "placename")]
+        infos = LocationCache.resolve_many(session, locs, ["Tókýó"])
+        assert infos[("Japan", "country")]["country"] == "JP"
+        assert sorted(resolved) == ["Japan", "Tókýó"]
+        assert len(session.rows) == 2
+        # Memory hits; the caller gets fresh copies that it may modify
+        infos[("Japan", "country")]["article_url"] = "x"
+        infos = LocationCache.resolve_many(session, locs)
+        assert len(resolved) == 2
+        assert "article_url" not in infos[("Japan", "country")]
+        # Database hits, as in another processor worker
+        LocationCache.clear()
+        LocationCache.resolve_many(session, locs + [("Kýótó", "placename")])
+        assert resolved[2:] == ["Kýótó"]
+        st = LocationCache.stats()
+        assert st["db_hits"] == 2 and st["misses"] == 1 and st["size"] == 3
+        # The parse cache is separate
+        assert ParseCache.stats()["size"] == 0
+    finally:
+        locationcache.location_info = real_location_info
+        LocationCache.clear()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    """ A local HTTP server that handles each request in a new thread
+        (http.server.ThreadingHTTPServer is not available in Python 3.6) """
+
+    daemon_threads = True
+
+
+def test_http_pool():
+    """ Test the scraper's HTTP connection pool against a local server """
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler
+    import requests
+    from fetcher import HttpPool
+
+    lock = threading.Lock()
+    # Number of requests being handled, and the maximum seen
+    active = [0, 0]
+    stalled = threading.Event()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/slow":
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                time.sleep(0.2)
+                with lock:
+                    active[0] -= 1
+            elif self.path == "/stalled":
+                # Hold the request until the test is done
+                stalled.wait(10.0)
+            body = "<html><body>{0}</body></html>".format(self.path).encode("utf-8")
+            self.send_response(200 if self.path != "/missing" else 404)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    pool = HttpPool(timeout=1.0, retries=0, domain_concurrency=2, pool_size=4)
+    try:
+        domain = "127.0.0.1:{0}".format(server.server_port)
+        for i in range(5):
+            r = pool.get("http://{0}/page{1}".format(domain, i))
+            assert r.status_code == 200
+            assert "/page{0}".format(i) in r.text
+        assert pool.get("http://{0}/missing".format(domain)).status_code == 404
+        stats = pool.stats()
+        assert stats[domain][0] == 6
+        assert stats[domain][1] == 0
+        total = dict()
+        HttpPool.merge_stats(total, stats)
+        HttpPool.merge_stats(total, stats)
+        assert total[domain][0] == 12
+
+        # No more than domain_concurrency requests are in flight at once
+        url = "http://{0}/slow".format(domain)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            responses = list(executor.map(pool.get, [url] * 6))
+        assert all(r.status_code == 200 for r in responses)
+        assert active[1] == 2
+
+        # A request to a stalled server times out (with urllib3 retries
+        # configured, requests reports read timeouts as connection errors)
+        t0 = time.time()
+        with pytest.raises(
+            (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+        ):
+            pool.get("http://{0}/stalled".format(domain))
+        assert time.time() - t0 < 5.0
+        assert pool.stats()[domain][1] == 1
+    finally:
+        stalled.set()
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+
+def test_db_pool_size(tmp_path, monkeypatch):
+    """ Check that the database connection pool has room for a session
+        in every scraper fetch thread at once, besides the pass's own """
+    import threading
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import QueuePool
+    from db import Scraper_DB
+    from settings import Settings
+
+    # More threads than SQLAlchemy's default pool of 5 + 10 connections
+    monkeypatch.setattr(Settings, "FETCH_THREADS", 20)
+    engine = create_engine(
+        "sqlite:///{0}".format(tmp_path / "pool.db"),
+        poolclass=QueuePool,
+        pool_timeout=2,
+        **Scraper_DB.pool_args()
+    )
+    num_threads = Settings.FETCH_THREADS + 1
+    # All threads hold a connection at the same time
+    barrier = threading.Barrier(num_threads, timeout=10)
+    errors = []
+
+    def work():
+        try:
+            with engine.connect() as conn:
+                conn.execute("SELECT 1")
+                barrier.wait()
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    threads = [threading.Thread(target=work) for _ in range(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    assert not errors, errors
+
+
+def test_api_client():
+    """ Test the query modules' API client against a local server """
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler
+    from apiclient import ApiClient
+    from queries import _parse_json
+
+    served = []
+    version = [1]
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            served.append(self.path)
+            if self.path.startswith("/slow"):
+                time.sleep(1.0)
+            body = json.dumps(dict(path=self.path, version=version[0])).encode()
+            try:
+                self.send_response(200 if not self.path.startswith("/missing") else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except BrokenPipeError:
+                # The client has timed out and gone away
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = ApiClient(timeout=0.3, cache_size=2)
+    try:
+        base = "http://127.0.0.1:{0}".format(server.server_port)
+        url = base + "/data?key=secret"
+        # Not cached without a ttl
+        assert client.get(url, _parse_json)["version"] == 1
+        assert client.get(url, _parse_json)["version"] == 1
+        assert len(served) == 2
+        # Cached with a ttl
+        assert client.get(url, _parse_json, ttl=60)["version"] == 1
+        assert client.get(url, _parse_json, ttl=60)["version"] == 1
+        assert len(served) == 3
+        # Stale: the old value is returned and refreshed in the background
+        version[0] = 2
+        time.sleep(0.05)
+        assert client.get(url, _parse_json, ttl=0.01, stale=60)["version"] == 1
+        for _ in range(100):
+            if client.get(url, _parse_json, ttl=60)["version"] == 2:
+                break
+            time.sleep(0.01)
+        assert client.get(url, _parse_json, ttl=60)["version"] == 2
+        # Expired beyond the stale period: fetched synchronously
+        version[0] = 3
+        time.sleep(0.05)
+        assert client.get(url, _parse_json, ttl=0.01, stale=0.01)["version"] == 3
+        # Failures are not cached
+        missing = base + "/missing"
+        assert client.get(missing, _parse_json, ttl=60) is None
+        assert client.get(missing, _parse_json, ttl=60) is None
+        # Slow responses time out
+        t0 = time.monotonic()
+        assert client.get(base + "/slow", _parse_json, ttl=60) is None
+        assert time.monotonic() - t0 < 0.9
+        # The cache is bounded
+        client.get(base + "/a", _parse_json, ttl=60)
+        client.get(base + "/b", _parse_json, ttl=60)
+        n = len(served)
+        client.get(url, _parse_json, ttl=60)
+        assert len(served) == n + 1
+
+        stats = client.stats()
+        # API keys in query strings are not exposed
+        st = stats[base + "/data"]
+        assert not any("secret" in endpoint for endpoint in stats)
+        assert st["hits"] >= 3 and st["stale_hits"] == 1 and st["refreshes"] == 1
+        assert st["errors"] == 0 and st["max_seconds"] > 0.0
+        assert stats[base + "/missing"]["errors"] == 2
+        assert stats[base + "/slow"]["errors"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_conditional_scrape():
+    """ Test that unchanged root pages are skipped when re-scraped """
+    import threading
+    from types import SimpleNamespace
+    from http.server import BaseHTTPRequestHandler
+    from bs4 import BeautifulSoup
+    from fetcher import Fetcher
+    from scraper import Scraper
+
+    assert Fetcher.conditional_headers() is None
+    assert Fetcher.conditional_headers("\"v1\"", "Mon, 01 Mar 2021 12:00:00 GMT") == {
+        "If-None-Match": "\"v1\"",
+        "If-Modified-Since": "Mon, 01 Mar 2021 12:00:00 GMT",
+    }
+
+    pages = [
+        '<html><body><a href="/a1">Frétt</a> <a href="/a2">Önnur</a></body></html>',
+        # Same text, different markup and whitespace
+        '<html><body>\n  <a class="x" href="/a1">Frétt</a>\n'
+        '<script>var x = 1;</script> <a href="/a2">Önnur</a></body></html>',
+        # Changed text
+        '<html><body><a href="/a3">Ný frétt</a></body></html>',
+    ]
+    page = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            etag = '"{0}"'.format(page[0])
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = pages[page[0]].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    assert Fetcher.content_hash(
+        BeautifulSoup(pages[0], "html.parser").html.body
+    ) == Fetcher.content_hash(BeautifulSoup(pages[1], "html.parser").html.body)
+
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        domain = "127.0.0.1:{0}".format(server.server_port)
+        root = SimpleNamespace(url="http://{0}/".format(domain), domain=domain)
+        scraper = Scraper()
+        validators = dict()
+        urls = scraper.urls2fetch(root, None, validators)
+        assert urls == {"http://{0}/a1".format(domain), "http://{0}/a2".format(domain)}
+        assert validators[root.url]["etag"] == '"0"'
+        # Not modified: the server answers 304
+        assert not scraper.urls2fetch(root, None, validators)
+        # Modified markup but unchanged text
+        page[0] = 1
+        assert not scraper.urls2fetch(root, None, validators)
+        assert validators[root.url]["etag"] == '"1"'
+        # Changed text
+        page[0] = 2
+        urls = scraper.urls2fetch(root, None, validators)
+        assert urls == {"http://{0}/a3".format(domain)}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_rescrape_article(monkeypatch):
+    """ Test that a re-scrape sends the stored validators of an article
+        and keeps the stored article if its content is unchanged """
+    from article import Article
+    from db.models import Article as ArticleRow
+    from fetcher import Fetcher, FetchResult
+
+    ar = ArticleRow(
+        id="00000000-0000-0000-0000-000000000001",
+        url="https://example.is/frett",
+        html="<html><body>Gömul frétt</body></html>",
+        etag='"1"',
+        last_modified="Mon, 05 Apr 2021 10:00:00 GMT",
+        content_hash="abc",
+        tree="S1\n",
+    )
+    calls = []
+    result = [FetchResult(not_modified=True, etag='"1"')]
+
+    def fetch_article_html(url, session, etag=None, last_modified=None):
+        calls.append((etag, last_modified))
+        return result[0]
+
+    monkeypatch.setattr(Fetcher, "fetch_article_html", fetch_article_html)
+    session = object()
+
+    a = Article._init_from_scrape(ar.url, session, ar)
+    assert calls[-1] == (ar.etag, ar.last_modified)
+    assert a.unchanged
+    assert a.html == ar.html
+
+    # Modified according to the server, but with the same text content
+    result[0] = FetchResult(html="<html>Gömul frétt</html>", content_hash="abc")
+    a = Article._init_from_scrape(ar.url, session, ar)
+    assert a.unchanged
+    assert a.html == ar.html
+
+    # Changed content
+    result[0] = FetchResult(html="<html>Ný frétt</html>", content_hash="def")
+    a = Article._init_from_scrape(ar.url, session, ar)
+    assert not a.unchanged
+    assert a.html == "<html>Ný frétt</html>"
+
+    # An article that hasn't been scraped before is fetched unconditionally
+    a = Article._init_from_scrape(ar.url, session, ArticleRow(url=ar.url))
+    assert calls[-1] == (None, None)
+
+
+def test_articles_fixture():
+    """ Check that the columns which the CI database seed copies from the
+        articles fixture exist in the table and match the fixture rows """
+    import csv
+    import re
+    from db.models import Article
+
+    with open(os.path.join(mainpath, ".travis.yml"), encoding="utf-8") as f:
+        m = re.search(r"copy articles \(([^)]*)\) from", f.read())
+    assert m, "The articles seed should list its columns"
+    columns = [c.strip() for c in m.group(1).split(",")]
+    assert set(columns) <= set(Article.__table__.columns.keys())
+    path = os.path.join(basepath, "test_files", "testdb_articles.csv")
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            assert len(row) == len(columns)
+
+
+def test_bulk_writer(monkeypatch):
+    """ Test that the bulk writer inserts rows with multi-row INSERTs,
+        after flushing pending changes in the session """
+    from db import BulkWriter
+    from db.models import Word, Location, Person, Entity
+    from sqlalchemy.dialects import postgresql
+
+    class FakeSession:
+        def __init__(self):
+            self.calls = []
+
+        def flush(self):
+            self.calls.append("flush")
+
+        def execute(self, statement):
+            compiled = statement.compile(dialect=postgresql.dialect())
+            # No values should be fetched from the database before the insert
+            assert not compiled.insert_prefetch
+            self.calls.append((str(compiled), compiled.params))
+
+    monkeypatch.setattr(BulkWriter, "MAX_ROWS", 3)
+    session = FakeSession()
+    writer = BulkWriter(session)
+    assert writer.flush() == 0
+    assert not session.calls
+    for i in range(5):
+        writer.add(Word, article_id="a", stem="orð{0}".format(i), cat="hk", cnt=i)
+    # Rows with different columns are inserted separately
+    writer.add(Location, name="Ísland", kind="country", country="IS")
+    writer.add(Location, name="Reykjavík", kind="placename")
+    assert len(writer) == 7
+    assert writer.flush() == 7
+    assert len(writer) == 0 and writer.rows == 7
+    assert session.calls[0] == "flush"
+    inserts = session.calls[1:]
+    assert len(inserts) == 4
+    sql, params = inserts[0]
+    assert sql.startswith("INSERT INTO words")
+    assert sql.count("VALUES") == 1 and sql.count("%(stem_m2)s") == 1
+    assert params["stem_m2"] == "orð2"
+    sql, params = inserts[1]
+    assert params["stem_m1"] == "orð4" and "stem_m2" not in params
+    assert all(sql.startswith("INSERT INTO locations") for sql, _ in inserts[2:])
+    assert "country" in inserts[2][0] and "country" not in inserts[3][0]
+    # Nothing is pending any more
+    assert writer.flush() == 0
+    # Sequence primary keys are assigned by the server in every row
+    session.calls = []
+    for name in ("Jón Jónsson", "Guðrún Helgadóttir"):
+        writer.add(Person, name=name, title="forstjóri", gender="kk")
+        writer.add(Entity, name=name, verb="er", definition="manneskja")
+    assert writer.flush() == 4
+    sql, params = session.calls[1]
+    assert sql.startswith("INSERT INTO persons")
+    assert sql.count("nextval('persons_id_seq')") == 2
+    sql, params = session.calls[2]
+    assert sql.startswith("INSERT INTO entities")
+    assert sql.count("nextval('entities_id_seq')") == 2
+
+
+def test_treepack():
+    """ Test the packed binary format for article trees and tokens """
+    from treepack import PackedArticle, pack_article, unpack_tokens_json, unpack_tree
+
+    tree = (
+        "S1\nC12\nL3\nN0 S0\nN1 Setning\nT2 no_et_nf_kvk \"Hún\" pfn_kvk_et_nf\n"
+        "T2 so_0_et_p3 \"hló\"\nT2 \".\" \".\" PUNCTUATION\nQ0\nS2\nE1\n"
+    )
+    tokens = [
+        [
+            [
+                {"x": "Hún", "m": ["hún", "pfn", "alm", "NFET"], "t": "pfn"},
+                {"x": "hló", "m": ["hlæja", "so", "alm", "GM-FH-ÞT-3P-ET"]},
+                {"x": ".", "k": 1},
+            ]
+        ],
+        [],
+        [
+            [
+                {"x": "Ó", "k": 6, "v": [1.5, None, True, -3]},
+                {"x": ".", "k": 1, "err": 1},
+            ]
+        ],
+    ]
+    tokens_json = json.dumps(tokens, separators=(",", ":"), ensure_ascii=False)
+    packed = pack_article(tree, tokens_json)
+    assert unpack_tree(packed) == tree
+    assert unpack_tokens_json(packed) == tokens_json
+    pa = PackedArticle(packed)
+    assert pa.num_sentences == 2
+    assert pa.num_tokens == 5
+    sents = list(pa.sentences())
+    assert [s.index for s in sents] == [1, 2]
+    assert [s.paragraph for s in sents] == [1, 3]
+    assert sents[0].tree.startswith("S1\nC12\n")
+    assert sents[1].tokens == tokens[2][0]
+    assert list(pa.sentence_tokens()) == [tokens[0][0], tokens[2][0]]
+    assert pack_article("", []) and unpack_tree(pack_article("", [])) == ""
+    # Counting the tokens of a long article only decompresses its header
+    long_tree = "\n".join(
+        "S{0}\nN0 S0\nT1 no \"orð{0}\"".format(i + 1) for i in range(5000)
+    )
+    long_tokens = [[[{"x": "orð{0}".format(i)}] for i in range(5000)]]
+    packed = pack_article(long_tree, long_tokens)
+    pa = PackedArticle(packed)
+    assert pa.num_sentences == 5000 and pa.num_tokens == 5000
+    assert pa._symbols_list is None
+    assert len(pa._body.buf) < len(unpack_tree(packed))
+    assert pa.tree() == long_tree
+    assert pa.tokens() == long_tokens
+    with pytest.raises(ValueError):
+        # Two sentences in the tree but only one in the token list
+        pack_article(tree, [tokens[0]])
+    with pytest.raises(ValueError):
+        # Only the current format version is read
+        PackedArticle(packed[:3] + b"\x01" + packed[4:])
+
+
+def test_answercache():
+    """ Test the in-memory query answer cache """
+    from datetime import datetime, timedelta
+    from answercache import AnswerCache
+
+    AnswerCache.clear()
+    now = datetime.utcnow()
+    key = AnswerCache.key("Hvað er  klukkan", True, "ios", (64.14401, -21.94301))
+    assert key == AnswerCache.key("hvað er klukkan", True, "ios", (64.144, -21.943))
+    assert key != AnswerCache.key("hvað er klukkan", False, "ios", (64.144, -21.943))
+    assert key != AnswerCache.key("hvað er klukkan", True, "ios", (65.68, -18.1))
+    assert AnswerCache.get(key, now) is None
+    # Results without an expiration time are not cached
+    AnswerCache.put(key, dict(answer="12:00"), None, 10.0)
+    assert AnswerCache.get(key, now) is None
+    result = dict(answer="12:00", response=dict(answer="12:00"))
+    context = dict(city="Reykjavík")
+    AnswerCache.put(key, result, now + timedelta(minutes=1), 10.0, context)
+    cached = AnswerCache.get(key, now)
+    assert cached.result == result and cached.context == context
+    assert cached.expires == now + timedelta(minutes=1)
+    # The caller gets a copy that it can modify
+    del cached.result["response"]["answer"]
+    cached.context.clear()
+    cached = AnswerCache.get(key, now)
+    assert cached.result == result and cached.context == context
+    # Expired results are evicted
+    assert AnswerCache.get(key, now + timedelta(minutes=2)) is None
+    st = AnswerCache.stats()
+    assert st["hits"] == 2 and st["expired"] == 1 and st["saved_ms"] == 20.0
+    assert st["size"] == 0
+    AnswerCache.clear()
+
+
+def test_answercache_logging(monkeypatch):
+    """ Test that answers served from the in-memory cache are logged
+        with their query context, like other answered queries """
+    from contextlib import contextmanager
+    from datetime import datetime, timedelta
+    from answercache import AnswerCache
+    import query
+
+    class FakeSession:
+        def __init__(self):
+            self.rows = []
+
+        def add(self, row):
+            self.rows.append(row)
+
+    session = FakeSession()
+
+    @contextmanager
+    def fake_context(**kwargs):
+        yield session
+
+    monkeypatch.setattr(query, "SessionContext", fake_context)
+    AnswerCache.clear()
+    expires = datetime.utcnow() + timedelta(minutes=5)
+    result = dict(
+        valid=True, q="Hvað er klukkan?", answer="12:00", voice="Klukkan er tólf"
+    )
+    context = dict(subject="klukkan")
+    key = AnswerCache.key("hvað er klukkan", True, "ios", None)
+    AnswerCache.put(key, result, expires, 10.0, context)
+
+    r = query.process_query("Hvað er klukkan?", True, client_type="ios")
+    assert r["answer"] == "12:00" and r["q_raw"] == "Hvað er klukkan?"
+    qrows = [row for row in session.rows if isinstance(row, Query)]
+    assert len(qrows) == 1 and len(session.rows) == 2
+    assert qrows[0].question == "Hvað er klukkan"
+    assert qrows[0].context == context and qrows[0].expires == expires
+
+    # Private queries are not logged
+    session.rows.clear()
+    r = query.process_query("Hvað er klukkan?", True, client_type="ios", private=True)
+    assert r["answer"] == "12:00" and not session.rows
+    AnswerCache.clear()
+
+
 def test_search():
     from search import Search
 
@@ -429,6 +1323,58 @@ def test_geo():
     assert location_info("Fiskislóð 31", "address")["country"] == "IS"
 
 
+def test_spatial_index():
+    """ Test the spatial index in geo.py against
+        the scalar distance function """
+    import random
+    from geo import SpatialIndex, distance
+
+    rnd = random.Random(42)
+    locs = [(rnd.uniform(-89.0, 89.0), rnd.uniform(-180.0, 180.0)) for _ in range(500)]
+    # Also a cluster of nearby points, as for bus stops
+    locs += [(64.1 + rnd.random() / 10, -21.9 + rnd.random() / 10) for _ in range(200)]
+    names = ["p{0}".format(i) for i in range(len(locs))]
+    index = SpatialIndex(locs, names)
+    assert len(index) == len(locs)
+
+    for q in [(64.14, -21.94), (-33.9, 151.2), (89.9, 0.0), (0.0, 179.99)]:
+        d = [distance(q, loc) for loc in locs]
+        by_distance = sorted(range(len(locs)), key=lambda i: d[i])
+        nearest = index.nearest(q, 5)
+        assert [name for name, _ in nearest] == [names[i] for i in by_distance[:5]]
+        assert all(abs(km - d[i]) < 1e-6 for (_, km), i in zip(nearest, by_distance))
+        for radius in (0.0, 2.0, 500.0, 5000.0):
+            within = index.within(q, radius)
+            assert [name for name, _ in within] == [
+                names[i] for i in by_distance if d[i] <= radius
+            ]
+
+    assert index.nearest((0.0, 0.0), 0) == []
+    assert len(index.nearest((0.0, 0.0), 1000)) == len(locs)
+    assert len(index.within((0.0, 0.0), 30000.0)) == len(locs)
+    assert SpatialIndex([]).nearest((0.0, 0.0)) == []
+    assert SpatialIndex([]).within((0.0, 0.0), 10.0) == []
+    # Without items, the indices of the locations are returned
+    assert SpatialIndex([(64.1, -21.9), (65.7, -18.1)]).nearest((65.0, -18.0))[0][0] == 1
+
+
+
+def test_bus_stop_index():
+    """ Check that the bus stop index of the bus query module
+        is rebuilt when the straeto package reloads its stops """
+    import straeto
+    from queries.bus import _closest_stops
+
+    loc = (64.1466, -21.9426)
+    stop = _closest_stops(loc)[0]
+    assert stop is straeto.BusStop.closest_to_list(loc)[0]
+    # Reloading creates new stop objects, which the index should return
+    straeto.initialize()
+    reloaded = _closest_stops(loc, n=2, within_radius=5.0)
+    assert reloaded[0] is not stop and reloaded[0].stop_id == stop.stop_id
+    assert all(straeto.BusStop.lookup(s.stop_id) is s for s in reloaded)
+
+
 def test_doc():
     """ Test document-related functions in doc.py """
     from doc import PlainTextDocument, DocxDocument
@@ -21,9 +21,10 @@
 
 """
 
-from collections import OrderedDict
 import os, sys
 
+import pytest
+
 # Shenanigans to enable Pytest to discover modules in the
 # main workspace directory (the parent of /tests)
 basepath, _ = os.path.split(os.path.realpath(__file__))
@@ -34,15 +35,17 @@ if mainpath not in sys.path:
 from reynir import tokenize
 from reynir.incparser import IncrementalParser
 from reynir.fastparser import Fast_Parser, ParseForestDumper
-from tree import Tree
+from tree import Tree, TerminalNode
 from treeutil import TreeUtility
 
 import processors.entities as entities
+import processors.persons as persons
 
 
 class SessionShim:
 
-    """ Shim (wrapper) that fakes an SQLAlchemy session class """
+    """ Shim (wrapper) that fakes an SQLAlchemy session class
+        and the bulk writer of rows """
 
     def __init__(self):
         # Accumulate rows that are added to the session
@@ -52,9 +55,9 @@ class SessionShim:
         """ Shim out SQLAlchemy execute() calls """
         pass
 
-    def add(self, row):
-        """ Shim out SQLAlchemy add() calls """
-        self.defs.add((row.name, row.verb, row.definition))
+    def add(self, model, **values):
+        """ Shim out BulkWriter add() calls """
+        self.defs.add((values["name"], values["verb"], values["definition"]))
 
     def check(self, t):
         """ Check whether the tuple t is in the defs set, and
@@ -68,6 +71,31 @@ class SessionShim:
         return t in self.defs
 
 
+def _tree_string(text, require_parse=False):
+    """ Parse the given text and return its sentence trees in the
+        string dump format that Tree.load() reads, with an error
+        line for each sentence that does not parse """
+    fp = Fast_Parser(verbose=False)
+    ip = IncrementalParser(fp, tokenize(text), verbose=False)
+    trees = []
+    for p in ip.paragraphs():
+        for sent in p.sentences():
+            if sent.parse():
+                # Create a verbose text representation of
+                # the highest scoring parse tree
+                token_dicts = TreeUtility.dump_tokens(sent.tokens, sent.tree)
+                tree = ParseForestDumper.dump_forest(sent.tree, token_dicts=token_dicts)
+                # Add information about the sentence tree's score
+                # and the number of tokens
+                trees.append("C{0}\nL{1}\n{2}".format(sent.score, len(sent), tree))
+            else:
+                assert not require_parse, "Sentence does not parse: " + sent.text
+                trees.append("E{0}".format(sent.err_index))
+    # Create a tree representation string out of
+    # all the accumulated parse trees
+    return "".join("S{0}\n{1}\n".format(ix, t) for ix, t in enumerate(trees, start=1))
+
+
 def test_entities():
     text = """
 
@@ -106,37 +134,13 @@ def test_entities():
        Íslendingar stofnuðu skipafélagið Eimskipafélag Íslands.
        
     """
-    toklist = tokenize(text)
-    fp = Fast_Parser(verbose=False)
-    ip = IncrementalParser(fp, toklist, verbose=False)
-    # Dict of parse trees in string dump format,
-    # stored by sentence index (1-based)
-    trees = OrderedDict()
-    num_sent = 0
-    for p in ip.paragraphs():
-        for sent in p.sentences():
-            num_sent += 1
-            num_tokens = len(sent)
-            assert sent.parse(), "Sentence does not parse: " + sent.text
-            # Obtain a text representation of the parse tree
-            token_dicts = TreeUtility.dump_tokens(sent.tokens, sent.tree)
-            # Create a verbose text representation of
-            # the highest scoring parse tree
-            tree = ParseForestDumper.dump_forest(sent.tree, token_dicts=token_dicts)
-            # Add information about the sentence tree's score
-            # and the number of tokens
-            trees[num_sent] = "\n".join(
-                ["C{0}".format(sent.score), "L{0}".format(num_tokens), tree]
-            )
-    # Create a tree representation string out of
-    # all the accumulated parse trees
-    tree_string = "".join("S{0}\n{1}\n".format(key, val) for key, val in trees.items())
+    tree_string = _tree_string(text, require_parse=True)
 
     tree = Tree()
     tree.load(tree_string)
 
     session = SessionShim()
-    tree.process(session, entities)
+    tree.process(session, entities, writer=session)
 
     session.check(("Bygma", "er", "dönsk byggingavörukeðja"))
     session.check(("Húsasmiðjan", "er", "íslenskt verslunarfyrirtæki"))
@@ -158,5 +162,292 @@ def test_entities():
     assert session.is_empty()
 
 
+def test_tree_load():
+    """ Check that the inline handling of nonterminal and terminal lines
+        in Tree.load() builds the same tree as the generic loader, which
+        calls a handler method for every line """
+    text = """
+       Danska byggingavörukeðjan Bygma hefur keypt íslenska
+       verslunarfyrirtækið Húsasmiðjuna.
+       Ég ræddi við fulltrúa Norðuráls (álverksmiðjunnar í Hvalfirði) í gær.
+       Klukkan 14:30 þann 3. maí 2021 greiddi hún 1.500 krónur.
+       Flibbertigibbet skrabbl frumpf.
+    """
+    tree_string = _tree_string(text)
+
+    def signature(node):
+        """ Return a nested tuple describing a sentence tree """
+        result = []
+        while node is not None:
+            if isinstance(node, TerminalNode):
+                td = node.td
+                result.append(
+                    (
+                        type(node).__name__,
+                        td.terminal,
+                        node.augmented_terminal,
+                        node.token,
+                        node.tokentype,
+                        node.aux,
+                        node.at_start,
+                    )
+                )
+            else:
+                result.append(
+                    (
+                        node.nt,
+                        node.nt_base,
+                        sorted(node.variants),
+                        node.is_repeated,
+                        signature(node.child),
+                    )
+                )
+            node = node.nxt
+        return tuple(result)
+
+    fast, generic = Tree(), Tree()
+    fast.load(tree_string)
+    generic.load_generic(tree_string)
+    assert list(fast.s.keys()) == list(generic.s.keys())
+    # The last sentence does not parse and is left out of the tree
+    assert len(fast.s) == 3
+    assert fast.scores == generic.scores and fast.lengths == generic.lengths
+    for ix, root in fast.s.items():
+        assert signature(root) == signature(generic.s[ix])
+
+
+class RowRecorder:
+
+    """ A bulk writer that records the rows added to it """
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, model, **values):
+        values.pop("timestamp", None)
+        self.rows.append((model.__name__, sorted(values.items())))
+
+
+class NodeRecorder:
+
+    """ A processor that records the nonterminals it is called for
+        and declines to visit prepositional phrases """
+
+    def __init__(self):
+        self.calls = []
+
+    def visit(self, state, node):
+        return not node.has_nt_base("FsLiður")
+
+    def default(self, node, params, result):
+        self.calls.append((node.nt_base, len(params)))
+
+    def sentence(self, state, result):
+        self.calls.append(("sentence", state["index"]))
+
+
+def test_process_all():
+    """ Check that processing a tree with several processors in a single
+        traversal gives the same results as processing it with each
+        processor in turn """
+    text = """
+       Jón Jónsson, forstjóri Norðuráls, sagði að Bygma væri dönsk byggingavörukeðja.
+       Guðrún Helgadóttir rithöfundur skrifaði bókina í Reykjavík.
+       Flibbertigibbet skrabbl frumpf.
+       Primera Air var íslenskt flugfélag.
+    """
+    tree_string = _tree_string(text)
+    tree = Tree("https://example.is/frett", 1.0)
+    tree.load(tree_string)
+
+    separate, recorder = RowRecorder(), NodeRecorder()
+    for processor in (persons, entities, recorder):
+        tree.process(SessionShim(), processor, writer=separate)
+    fused, fused_recorder = RowRecorder(), NodeRecorder()
+    tree.process_all(SessionShim(), [persons, entities, fused_recorder], writer=fused)
+
+    assert separate.rows and any(row[0] == "Person" for row in separate.rows)
+    assert any(row[0] == "Entity" for row in separate.rows)
+    assert sorted(fused.rows) == sorted(separate.rows)
+    assert fused_recorder.calls == recorder.calls
+    assert ("sentence", 4) in recorder.calls
+    assert not any(nt == "FsLiður" for nt, _ in recorder.calls)
+
+
+class WordCollector:
+
+    """ A processor that collects the words of each sentence in a list,
+        which is merged upwards from child results to their parents """
+
+    def __init__(self, skip=None):
+        self.skip = skip
+        self.results = []
+
+    def visit(self, state, node):
+        return not node.has_nt_base(self.skip)
+
+    def default(self, node, params, result):
+        if node.has_nt_base("Lag"):
+            result.depth = params[-1].get("depth", 0) + 1 if params[-1] else 1
+            result.words = [params[0]._text] + result.get("words", [])
+
+    def sentence(self, state, result):
+        self.results.append(result)
+
+
+def test_deep_tree():
+    """ Check that trees much deeper than the recursion limit
+        can be loaded, processed and traversed """
+    depth = 2 * sys.getrecursionlimit()
+    lines = ["S1", "C0", "L{0}".format(depth)]
+    for level in range(depth):
+        lines.append("N{0} Lag".format(level))
+        lines.append('T{0} no_et_nf_hk "orð{1}"'.format(level + 1, level))
+    lines.append("N{0} Botn".format(depth))
+    lines.append('T{0} no_et_nf_hk "botn"'.format(depth + 1))
+    lines.append("Q0")
+    tree = Tree("https://example.is/djup", 1.0)
+    tree.load("\n".join(lines) + "\n")
+    words = ["orð{0}".format(level) for level in range(depth)]
+    root = tree.s[1]
+    assert root.contained_text() == " ".join(words + ["botn"])
+    assert sum(1 for _ in root.descendants()) == 2 * depth + 1
+
+    collector = WordCollector()
+    tree.process(SessionShim(), collector)
+    result = collector.results[0]
+    assert result.depth == depth
+    assert result.words == words
+    assert result._text == " ".join(words + ["botn"])
+    assert sum(1 for _ in result.enum_descendants()) == 2 * depth + 1
+    assert result.find_descendant(nt_base="Botn")._text == "botn"
+
+    # Processors that decline to visit a subtree get None as its result
+    fused = [WordCollector(), WordCollector(skip="Botn")]
+    tree.process_all(SessionShim(), fused)
+    assert fused[0].results[0].words == words
+    assert fused[1].results[0].words == words
+    assert fused[0].results[0].find_descendant(nt_base="Botn") is not None
+    assert fused[1].results[0].find_descendant(nt_base="Botn") is None
+
+
+def _database():
+    """ Return the scraper database, skipping the
+        calling test if it is not available """
+    from db import Scraper_DB, DatabaseError
+
+    try:
+        db = Scraper_DB()
+        db.execute("SELECT 1")
+    except (ImportError, DatabaseError):
+        pytest.skip("The scraper database is not available")
+    return db
+
+
+def test_batched_claiming(monkeypatch):
+    """ Check that concurrent processor workers claim disjoint batches
+        of the articles that are due for processing, mark them as
+        processed and respect the limit """
+    import threading
+    import time
+    from collections import defaultdict
+    from contextlib import closing
+    from datetime import datetime
+    from db.models import Article
+    from processor import Processor
+
+    db = _database()
+    urls = ["https://example.is/claim/{0}".format(i) for i in range(12)]
+
+    def is_test_article():
+        return Article.url.in_(urls)
+
+    now = datetime.utcnow()
+    with closing(db.session) as session:
+        session.execute(Article.table().delete().where(is_test_article()))
+        for url in urls:
+            session.add(
+                Article(url=url, tree="S1\n", tokens="[]", scraped=now, parsed=now)
+            )
+        session.commit()
+
+    # The URLs of the test articles processed by each worker
+    claimed = defaultdict(list)
+
+    def process_tree(self, session, writer, url, *args):
+        if url in urls:
+            claimed[threading.current_thread().name].append(url)
+        # Give the other worker time to claim batches meanwhile
+        time.sleep(0.05)
+
+    monkeypatch.setattr(Processor, "_db", db)
+    monkeypatch.setattr(Processor, "_process_tree", process_tree)
+    proc = Processor.__new__(Processor)
+    proc.pmodules = []
+    proc.processors = []
+
+    def run(update=False):
+        """ Run two workers at the same time, returning
+            the test articles that each of them processed """
+        claimed.clear()
+        work = (None, 0, False, update, now, 2)
+        workers = [
+            threading.Thread(target=proc.go_batches, args=(work,), name=str(ix))
+            for ix in range(2)
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return claimed["0"], claimed["1"]
+
+    def processed():
+        with closing(db.session) as session:
+            q = session.query(Article.url, Article.processed)
+            return dict(q.filter(is_test_article()).all())
+
+    try:
+        # Each article is claimed by exactly one of the workers
+        first, second = run()
+        assert first and second
+        assert not set(first) & set(second)
+        assert sorted(first + second) == sorted(urls)
+        assert all(processed().values())
+
+        # Articles parsed again since they were processed
+        reparsed = urls[::3]
+        with closing(db.session) as session:
+            session.execute(
+                Article.table()
+                .update()
+                .where(Article.url.in_(reparsed))
+                .values(parsed=datetime.utcnow())
+            )
+            session.commit()
+        first, second = run(update=True)
+        assert not set(first) & set(second)
+        assert sorted(first + second) == sorted(reparsed)
+
+        # A limit that is not a multiple of the batch size
+        with closing(db.session) as session:
+            session.execute(
+                Article.table().update().where(is_test_article()).values(processed=None)
+            )
+            session.commit()
+        count, _, _ = proc.go_batches((None, 5, False, False, now, 2))
+        assert count == 5
+        assert sum(1 for p in processed().values() if p is not None) == 5
+    finally:
+        with closing(db.session) as session:
+            session.execute(Article.table().delete().where(is_test_article()))
+            session.commit()
+        db.dispose()
+
+
 if __name__ == "__main__":
     test_entities()
+    test_tree_load()
+    test_process_all()
+    test_deep_tree()
+    with pytest.MonkeyPatch.context() as mp:
+        test_batched_claiming(mp)
@@ -890,3 +890,209 @@ def test_numbers():
         numbers_to_neutral("Baugatangi 1-17, Reykjavík")
         == "Baugatangi eitt-17, Reykjavík"
     )
+
+
+def _node_signature(node):
+    """ Return a nested tuple describing a tree, for comparison """
+    from tree import TerminalNode
+
+    result = []
+    while node is not None:
+        if isinstance(node, TerminalNode):
+            result.append(
+                (
+                    type(node).__name__,
+                    node.td.terminal,
+                    node.augmented_terminal,
+                    node.token,
+                    node.tokentype,
+                    node.aux,
+                    node.at_start,
+                )
+            )
+        else:
+            result.append(("N", node.nt, _node_signature(node.child)))
+        node = node.nxt
+    return tuple(result)
+
+
+def test_query_trees(monkeypatch):
+    """ Check that the tree of a query, built directly from its parse
+        forest, is the same as the one loaded from the text dump of the
+        forest, and that timing information is only returned in debug mode """
+    from reynir.fastparser import ParseForestDumper
+    from settings import Settings
+    from query import Query
+    from tree import Tree
+
+    if Query._parser is None:
+        Query.init_class()
+
+    def query(text):
+        return Query(None, text, True, True, None, None, None)
+
+    monkeypatch.setattr(Settings, "DEBUG", False)
+    for text in (
+        "hvað eru 2 plús 2",
+        "hver er forseti íslands",
+        "hvaða dagur er í dag",
+        "hvað er langt til akureyrar",
+    ):
+        q = query(text)
+        assert q.tree_text() is None
+        result = dict()
+        assert q.parse(result), text
+        assert result["num_sent"] == result["num_parsed_sent"] == 1
+        dump = ParseForestDumper.dump_forest(q._forest)
+        assert q.tree_text() == "S1\n" + dump
+        loaded = Tree()
+        loaded.load(q.tree_text())
+        assert list(q._tree.s) == list(loaded.s) == [1]
+        assert _node_signature(q._tree.s[1]) == _node_signature(loaded.s[1]), text
+        assert set(q.timing()) >= {"tokenize", "parse", "tree"}
+
+    result = query("hvað eru 2 plús 2").execute()
+    assert result["valid"] and result["answer"] == "4"
+    assert "timing" not in result and "processor_timing" not in result
+
+    monkeypatch.setattr(Settings, "DEBUG", True)
+    result = query("hvað eru 2 plús 2").execute()
+    assert result["answer"] == "4"
+    assert set(result["timing"]) >= {"tokenize", "parse", "tree", "dispatch"}
+    assert all(t >= 0.0 for t in result["timing"].values())
+    assert list(result["processor_timing"]) == ["queries.arithmetic"]
+
+
+def test_tree_processor_index():
+    """ Check that each alternative of the Query nonterminal maps to the
+        processor whose grammar fragment defines it, and that processors
+        whose fragments can't be indexed are still given every tree """
+    from types import ModuleType, SimpleNamespace
+    from query import Query, _query_alternatives
+
+    if Query._parser is None:
+        Query.init_class()
+    grammar = Query._parser.grammar
+    alternatives = grammar.nt_dict[grammar.nonterminals["Query"]]
+    assert alternatives
+    for _, prod in alternatives:
+        nt = str(prod._rhs[0]).split("_")[0].rstrip("?*+")
+        # The processor(s) whose fragment has a rule for the nonterminal
+        rx = re.compile(r"^" + re.escape(nt) + r"\b[^\n#]*→", re.MULTILINE)
+        defining = [
+            p for p in Query._tree_processors if rx.search(getattr(p, "GRAMMAR", ""))
+        ]
+        assert defining, nt
+        assert Query._tree_processor_index.get(nt) == defining, nt
+
+    # A fragment whose Query alternative begins with a literal can't be indexed
+    assert _query_alternatives("Query →\n    QFoo\n    | 'halló'\n") is None
+    assert _query_alternatives(
+        "# Comment\nQuery → QFoo? | QBar_nf\n    > QBaz\n\nQFoo → 'a'\n"
+    ) == {"QFoo", "QBar", "QBaz"}
+
+    # Dispatch to the owner of the tree's Query alternative,
+    # plus any unindexed processors, in their original order
+    foo, bar, unindexed = ModuleType("foo"), ModuleType("bar"), ModuleType("other")
+
+    def dispatch(nt_base):
+        query_node = SimpleNamespace(
+            children=lambda: iter([SimpleNamespace(nt_base=nt_base)])
+        )
+        q = SimpleNamespace(
+            _tree={1: SimpleNamespace(child=query_node)},
+            _tree_processors=[foo, unindexed, bar],
+            _tree_processor_index=dict(QFoo=[foo], QBar=[bar]),
+            _unindexed_tree_processors=[unindexed],
+        )
+        return Query._candidate_tree_processors(q)
+
+    assert dispatch("QFoo") == [foo, unindexed]
+    assert dispatch("QBar") == [unindexed, bar]
+    # Not in the index: try all processors
+    assert dispatch("QUnknown") == [foo, unindexed, bar]
+
+
+def test_plain_text_triggers():
+    """ Check that queries for each text processor with trigger keywords
+        pass the trigger prefilter for it, and that others do not """
+    from types import SimpleNamespace
+    from query import Query
+    from queries import distance, repeat, tel, time, words
+
+    if Query._parser is None:
+        Query.init_class()
+
+    def candidates(ql):
+        q = SimpleNamespace(
+            query_lower=ql,
+            _text_processors=Query._text_processors,
+            _untriggered_text_processors=Query._untriggered_text_processors,
+            _text_trigger_rx=Query._text_trigger_rx,
+            _text_trigger_owners=Query._text_trigger_owners,
+        )
+        return Query._candidate_text_processors(q)
+
+    # Representative queries for each text processor with trigger keywords
+    samples = {
+        distance: (
+            "hvað er ég langt frá perlunni",
+            "hvað er langt til akureyrar",
+            "hversu langt í burtu er esjan",
+            "hvað eru margir kílómetrar til selfoss",
+            "hversu marga metra er ég frá hallgrímskirkju",
+            "hvað er ég lengi að ganga á laugaveg",
+            "hvað tekur langan tíma að keyra til keflavíkur",
+        ),
+        tel: (
+            "hringdu í 5885522",
+            "hringdu í síma 588-5522",
+            "hringdu fyrir mig í númerið 112",
+        ),
+        words: (
+            "hvernig stafsetur maður orðið hestur",
+            "hvernig skrifar maður kjóll",
+            "hvernig er nafnorðið hestur stafsett",
+            "hvernig beygi ég orðið hestur",
+            "hvernig á maður að fallbeygja nafnið jón",
+        ),
+        time: (
+            "klukkan",
+            "hvað er klukkan",
+            "hvað er tíminn núna",
+            "hvað líður tímanum",
+            "veistu hvað klukkan er",
+            "hvað er klukkan í tókýó",
+        ),
+        repeat: (
+            "segðu setninguna ég er hér",
+            "endurtaktu eftir mér halló heimur",
+            "farðu með setninguna góðan daginn",
+            "hermdu eftir mér",
+        ),
+    }
+    patterns = {
+        distance: distance._QDISTANCE_REGEXES + distance._QTRAVELTIME_REGEXES,
+        tel: tuple(tel._PHONECALL_REGEXES),
+        words: words._SPELLING_RX + words._DECLENSION_RX,
+    }
+    for module, queries in samples.items():
+        assert module.PLAIN_TEXT_TRIGGERS
+        for ql in queries:
+            rxs = patterns.get(module)
+            assert rxs is None or any(re.search(rx, ql) for rx in rxs), ql
+            assert module.handle_plain_text in candidates(ql), ql
+    # Queries that none of these processors handle do not reach them
+    for ql in (
+        "segðu mér brandara",
+        "hvað er veðrið á morgun",
+        "hver er forseti íslands",
+        "hvað er ég gamall",
+        "hvaða dagur er í dag",
+    ):
+        assert not any(m.handle_plain_text in candidates(ql) for m in samples), ql
+    # A query without any trigger keywords only goes to the
+    # untriggered processors
+    untriggered = candidates("segðu mér brandara")
+    assert untriggered
+    assert all(h in Query._untriggered_text_processors for h in untriggered)
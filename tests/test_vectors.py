@@ -0,0 +1,720 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Tests for the topic vector index and similarity server
+    in the vectors/ directory
+
+"""
+
+import os
+import sys
+import json
+import math
+import uuid
+import heapq
+import operator
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from collections import defaultdict
+
+import pytest
+import numpy as np
+
+# Shenanigans to enable Pytest to discover modules in the
+# vectors directory (a sibling of /tests)
+basepath, _ = os.path.split(os.path.realpath(__file__))
+vectorspath = os.path.join(basepath, "..", "vectors")
+if vectorspath not in sys.path:
+    sys.path.append(vectorspath)
+
+from topicindex import TopicMatrix, IVFIndex, VectorStore, pack_vector, unpack_vector
+
+
+DIMENSIONS = 20
+
+
+def random_vectors(count, seed=0):
+    """ Return a list of article ids and a matrix of random topic vectors """
+    rng = np.random.default_rng(seed)
+    ids = ["article-{0}".format(i) for i in range(count)]
+    return ids, rng.normal(size=(count, DIMENSIONS))
+
+
+def similar_by_loop(atopics, n, vector):
+    """ The similarity query of the similarity server before it used
+        TopicMatrix: a cosine similarity per article, and a heap """
+    base = np.array(vector)
+    norm_base = np.dot(base, base)
+    if norm_base < 1.0e-6:
+        return []
+
+    def cosine_similarity(v):
+        return float(np.dot(v, base) / math.sqrt(np.dot(v, v) * norm_base))
+
+    return heapq.nlargest(
+        n,
+        ((article_id, cosine_similarity(v)) for article_id, v in atopics.items()),
+        key=operator.itemgetter(1),
+    )
+
+
+def assert_same_ranking(result, expected):
+    assert [a for a, _ in result] == [a for a, _ in expected]
+    for (_, s1), (_, s2) in zip(result, expected):
+        assert s1 == pytest.approx(s2, abs=1.0e-5)
+
+
+def test_pack_vector():
+    """ Test the binary and JSON representations of topic vectors """
+    _, vectors = random_vectors(1)
+    data = pack_vector(vectors[0])
+    assert len(data) == 4 * DIMENSIONS
+    v = unpack_vector(data)
+    assert v.dtype == np.float32 and np.allclose(v, vectors[0], atol=1.0e-6)
+    # The binary representation takes precedence over JSON
+    assert np.array_equal(unpack_vector(data, json.dumps([1.0, 2.0])), v)
+    v = unpack_vector(None, json.dumps(list(vectors[0])))
+    assert v.dtype == np.float32 and np.allclose(v, vectors[0], atol=1.0e-6)
+    assert unpack_vector(None, None) is None and unpack_vector(b"", "") is None
+    for faulty in ('{"a": 1}', "[[1.0, 2.0]]", '["x"]'):
+        assert len(unpack_vector(None, faulty)) == 0
+
+
+def test_topic_matrix():
+    """ Test that the topic matrix ranks articles like the per-article
+        loop, and that it is updated in place """
+    ids, vectors = random_vectors(3000)
+    atopics = dict(zip(ids, vectors))
+    matrix = TopicMatrix(DIMENSIONS)
+    assert len(matrix) == 0
+    assert matrix.top_n(5, [vectors[0]]) == [[]]
+    # Add the vectors in two batches, the second one growing the matrix
+    matrix.update(ids[:1000], vectors[:1000])
+    matrix.update(ids[1000:], vectors[1000:])
+    assert len(matrix) == 3000 and matrix.ids == ids
+
+    rng = np.random.default_rng(1)
+    queries = rng.normal(size=(8, DIMENSIONS))
+    results = matrix.top_n(10, queries)
+    assert len(results) == len(queries)
+    for q, result in zip(queries, results):
+        assert_same_ranking(result, similar_by_loop(atopics, 10, q))
+    # Fewer articles than requested
+    small = TopicMatrix(DIMENSIONS)
+    small.update(ids[:3], vectors[:3])
+    assert_same_ranking(
+        small.top_n(10, [queries[0]])[0],
+        similar_by_loop(dict(zip(ids[:3], vectors[:3])), 10, queries[0]),
+    )
+
+    # Stored vectors are normalized to unit length
+    v = matrix.vector(ids[5])
+    assert v.dtype == np.float32
+    assert np.linalg.norm(v) == pytest.approx(1.0, abs=1.0e-6)
+    assert np.allclose(v, vectors[5] / np.linalg.norm(vectors[5]), atol=1.0e-6)
+    assert matrix.vector("no-such-article") is None
+
+    # Replacing a vector keeps its row, and the ranking follows
+    rows = matrix.update([ids[5], "article-new"], [queries[0], -queries[0]])
+    assert list(rows) == [5, 3000]
+    assert len(matrix) == 3001
+    atopics[ids[5]] = queries[0]
+    atopics["article-new"] = -queries[0]
+    result = matrix.top_n(10, [queries[0]])[0]
+    assert result[0][0] == ids[5] and result[0][1] == pytest.approx(1.0)
+    assert_same_ranking(result, similar_by_loop(atopics, 10, queries[0]))
+    assert matrix.top_n(1, [-queries[0]])[0][0][0] == "article-new"
+
+
+def clustered_vectors(count, clusters, seed=0):
+    """ Return a list of article ids and a matrix of topic vectors
+        that are grouped in clusters, like real articles """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, DIMENSIONS))
+    vectors = centers[rng.integers(clusters, size=count)]
+    vectors += 0.5 * rng.normal(size=vectors.shape)
+    ids = ["article-{0}".format(i) for i in range(count)]
+    return ids, vectors
+
+
+def test_ivf_index_recall():
+    """ Test that the approximate index finds most of the exact results,
+        and all of them when every cluster is probed """
+    ids, vectors = clustered_vectors(5000, 25)
+    matrix = TopicMatrix(DIMENSIONS)
+    matrix.update(ids, vectors)
+    index = IVFIndex(matrix, n_probes=8, min_size=0)
+    # Untrained, the index answers exactly
+    queries = vectors[::250]
+    assert index.top_n(10, queries) == matrix.top_n(10, queries)
+    index.train(n_lists=64)
+    assert index.trained and index.num_lists == 64
+    assert index.trained_size == 5000
+
+    exact = matrix.top_n(10, queries)
+    approx = index.top_n(10, queries)
+    found = sum(
+        len(set(a for a, _ in e) & set(a for a, _ in r)) for e, r in zip(exact, approx)
+    )
+    assert found / sum(len(e) for e in exact) >= 0.9
+    for e, r in zip(exact, index.top_n(10, queries, n_probes=64)):
+        assert_same_ranking(r, e)
+
+    # Updated and added rows are assigned to clusters
+    rows = matrix.update([ids[0], "article-new"], [vectors[1], vectors[1]])
+    index.update(rows)
+    result = [a for a, _ in index.top_n(3, [vectors[1]])[0]]
+    assert set(result) == {ids[0], ids[1], "article-new"}
+
+
+def test_ivf_index_save_load(tmp_path):
+    """ Test that the centroids and cluster assignments are saved and
+        loaded, also into a matrix whose rows are in a different order """
+    ids, vectors = clustered_vectors(3000, 20)
+    matrix = TopicMatrix(DIMENSIONS)
+    matrix.update(ids, vectors)
+    index = IVFIndex(matrix, n_probes=4, min_size=0)
+    index.train(n_lists=30)
+    path = str(tmp_path / "ann.npz")
+    index.save(path)
+    queries = vectors[::300]
+    expected = index.top_n(10, queries)
+
+    # Same matrix: the assignments are loaded, not recomputed
+    loaded = IVFIndex(matrix, n_probes=4, min_size=0)
+    nearest = loaded._nearest
+    loaded._nearest = lambda v: pytest.fail("Assignments recomputed")
+    assert loaded.load(path)
+    loaded._nearest = nearest
+    assert loaded.num_lists == 30 and loaded.trained_size == 3000
+    assert np.array_equal(loaded._assign, index._assign)
+    assert loaded.top_n(10, queries) == expected
+
+    # Shuffled matrix with one new article: assignments follow the ids
+    order = np.random.default_rng(3).permutation(len(ids))
+    shuffled = TopicMatrix(DIMENSIONS)
+    shuffled.update([ids[i] for i in order], vectors[order])
+    shuffled.update(["article-new"], [vectors[0]])
+    loaded = IVFIndex(shuffled, n_probes=4, min_size=0)
+    assert loaded.load(path)
+    assert np.array_equal(loaded._assign[:-1], index._assign[order])
+    assert loaded._assign[-1] == index._assign[0]
+    for e, r in zip(expected, loaded.top_n(11, queries)):
+        assert set(a for a, _ in e) <= set(a for a, _ in r)
+
+    # Missing files and mismatching dimensions are rejected
+    assert not IVFIndex(matrix).load(str(tmp_path / "missing.npz"))
+    assert not IVFIndex(TopicMatrix(DIMENSIONS + 1)).load(path)
+
+
+
+def uuid_vectors(count, seed=0):
+    """ Return a list of article UUIDs and a matrix of random topic vectors """
+    _, vectors = random_vectors(count, seed)
+    return [str(uuid.uuid4()) for _ in range(count)], vectors
+
+
+def test_vector_store(tmp_path):
+    """ Test writing, growing and mapping the vector store """
+    path = str(tmp_path / "vectors.bin")
+    ids, vectors = uuid_vectors(40)
+    with VectorStore.create(path, DIMENSIONS, capacity=16) as store:
+        assert len(store) == 0 and store.timestamp is None
+        # Another writer is locked out
+        with pytest.raises(BlockingIOError):
+            VectorStore(path, writable=True)
+        store.put(ids[:10], vectors[:10])
+        reader = VectorStore(path)
+        assert reader.ids() == ids[:10]
+        # Grow the store beyond its capacity
+        store.put(ids[10:], vectors[10:])
+        assert len(store) == 40 and store.capacity == 64
+        # Replacing a vector keeps its row
+        store.put([ids[3]], [vectors[0]])
+        ts = datetime(2021, 3, 1, 12, 30, 15, 250000)
+        store.set_timestamp(ts)
+    # The earlier reader still sees the rows it mapped
+    assert reader.ids() == ids[:10]
+    assert np.allclose(
+        reader.matrix()[:10], TopicMatrix.normalize(vectors[:10]), atol=1.0e-6
+    )
+    reader.close()
+
+    expected = dict(zip(ids, vectors))
+    expected[ids[3]] = vectors[0]
+    with VectorStore(path) as store:
+        assert store.dimensions == DIMENSIONS and len(store) == 40
+        assert store.ids() == ids
+        assert abs(store.timestamp - ts) < timedelta(milliseconds=1)
+        matrix = TopicMatrix.from_store(store)
+    assert len(matrix) == 40 and matrix.ids == ids
+    assert np.allclose(matrix.vector(ids[3]), matrix.vector(ids[0]), atol=1.0e-6)
+    rng = np.random.default_rng(4)
+    for q in rng.normal(size=(4, DIMENSIONS)):
+        assert_same_ranking(
+            matrix.top_n(5, [q])[0], similar_by_loop(expected, 5, q)
+        )
+    # Modifying and growing the matrix doesn't touch the file
+    matrix.update([ids[0]], [-vectors[0]])
+    matrix.update(["new-{0}".format(i) for i in range(100)], vectors.repeat(3, 0)[:100])
+    with VectorStore(path) as store:
+        assert np.allclose(
+            store.matrix()[0], TopicMatrix.normalize(vectors[0])[0], atol=1.0e-6
+        )
+        assert len(store) == 40
+
+    # Files that aren't vector stores are rejected
+    other = tmp_path / "other.bin"
+    other.write_bytes(b"not a vector store")
+    with pytest.raises(ValueError):
+        VectorStore(str(other))
+
+
+@pytest.fixture
+def simserver():
+    """ Import the similarity server module, with the vectors directory
+        first on the path so that it gets its own settings module, and
+        restore the previously imported modules afterwards """
+    pytest.importorskip("gensim")
+    saved_path = list(sys.path)
+    saved_modules = dict(sys.modules)
+    sys.path.insert(0, vectorspath)
+    for name in ("settings", "builder", "simserver"):
+        sys.modules.pop(name, None)
+    try:
+        import simserver
+
+        yield simserver
+    finally:
+        sys.path[:] = saved_path
+        for name in list(sys.modules):
+            if name not in saved_modules:
+                del sys.modules[name]
+        sys.modules.update(saved_modules)
+
+
+class FakeConnection:
+
+    """ A client connection that receives the given requests
+        and records the replies sent to it """
+
+    def __init__(self, requests):
+        self.requests = list(requests)
+        self.replies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def recv(self):
+        if not self.requests:
+            raise EOFError()
+        return self.requests.pop(0)
+
+    def send(self, reply):
+        self.replies.append(reply)
+
+
+def test_similarity_server(simserver):
+    """ Test the similarity queries of the similarity server, including
+        the batched 'topics' command, against the per-article loop """
+    server = simserver.SimilarityServer()
+    server._corpus = SimpleNamespace(dimensions=DIMENSIONS)
+    # Nothing is loaded yet
+    assert server.article_topic("article-0") is None
+    assert server.find_similar(5, [1.0] * DIMENSIONS) == []
+
+    ids, vectors = random_vectors(2000)
+    atopics = dict(zip(ids, vectors))
+    server._atopics = simserver.TopicMatrix(DIMENSIONS)
+    server._atopics.update(ids, vectors)
+
+    # article_topic() returns the normalized vector
+    v = server.article_topic(ids[7])
+    assert np.allclose(v, vectors[7] / np.linalg.norm(vectors[7]), atol=1.0e-6)
+    assert server.article_topic("no-such-article") is None
+
+    rng = np.random.default_rng(2)
+    queries = [list(q) for q in rng.normal(size=(4, DIMENSIONS))]
+    # Zero vectors and vectors of the wrong length give empty results
+    batch = queries + [[0.0] * DIMENSIONS, [1.0] * (DIMENSIONS - 1), None]
+    results = server.find_similar_batch(10, batch)
+    assert len(results) == len(batch)
+    for q, result in zip(queries, results):
+        assert_same_ranking(result, similar_by_loop(atopics, 10, q))
+    assert results[len(queries) :] == [[], [], []]
+    assert_same_ranking(server.find_similar(10, queries[0]), results[0])
+
+    conn = FakeConnection(
+        [
+            dict(cmd="similar", n=5, topics=queries[:2]),
+            dict(cmd="similar", n=5, topic=queries[1]),
+            dict(cmd="similar", topics="not a list"),
+            dict(cmd="similar", n=3, id=ids[7]),
+            dict(cmd="logout"),
+        ]
+    )
+    server._command_loop(conn)
+    assert len(conn.replies) == 3
+    batch_reply, single_reply, id_reply = conn.replies
+    assert len(batch_reply["articles"]) == 2
+    for q, result in zip(queries[:2], batch_reply["articles"]):
+        assert_same_ranking(result, similar_by_loop(atopics, 5, q))
+    assert_same_ranking(single_reply["articles"], batch_reply["articles"][1])
+    assert id_reply["articles"][0][0] == ids[7]
+    assert_same_ranking(id_reply["articles"], similar_by_loop(atopics, 3, vectors[7]))
+
+
+class FakeQuery:
+
+    """ A database query of article topic vectors (or only their ids),
+        applying the filters on the indexing time and the presence of
+        a topic vector to a list of rows """
+
+    def __init__(self, rows, loaded, ids_only=False):
+        self.rows = rows
+        self.loaded = loaded
+        self.ids_only = ids_only
+
+    def join(self, *args):
+        return self
+
+    def with_entities(self, *args):
+        return self
+
+    def filter(self, criterion):
+        key = getattr(getattr(criterion, "left", None), "key", None)
+        if key == "indexed":
+            since = criterion.right.value
+            rows = [r for r in self.rows if r.indexed >= since]
+        elif "topic_vector" in str(criterion):
+            rows = [
+                r
+                for r in self.rows
+                if r.topic_vector_bin is not None or r.topic_vector is not None
+            ]
+        else:
+            rows = self.rows
+        return FakeQuery(rows, self.loaded, self.ids_only)
+
+    def yield_per(self, n):
+        if not self.ids_only:
+            self.loaded.extend(r.id for r in self.rows)
+        return iter(list(self.rows))
+
+
+def test_vector_store_loading(simserver, tmp_path, monkeypatch):
+    """ Test that the builder writes the vector store and that the similarity
+        server maps it, only loading newer articles from the database """
+    import builder
+
+    rows = []
+    loaded = []
+
+    class FakeSession:
+        def query(self, *args):
+            ids_only = getattr(args[0], "key", None) == "id"
+            return FakeQuery(rows, loaded, ids_only)
+
+    @contextmanager
+    def fake_context(**kwargs):
+        yield FakeSession()
+
+    def add_rows(ids, vectors, indexed):
+        for ix, (article_id, v) in enumerate(zip(ids, vectors)):
+            rows[:] = [r for r in rows if r.id != article_id]
+            # Every other article has its topic vector in the older JSON format
+            as_json = v is not None and ix % 2
+            rows.append(
+                SimpleNamespace(
+                    id=article_id,
+                    topic_vector_bin=None if v is None or as_json else pack_vector(v),
+                    topic_vector=json.dumps(list(v)) if as_json else None,
+                    indexed=indexed,
+                )
+            )
+
+    monkeypatch.setattr(builder, "SessionContext", fake_context)
+    monkeypatch.setattr(simserver, "SessionContext", fake_context)
+    monkeypatch.setattr(simserver.Settings, "ANN_INDEX", False)
+    monkeypatch.setattr(
+        builder.ReynirCorpus,
+        "_VECTOR_STORE_FILE",
+        str(tmp_path / "vectors-{0}.bin"),
+    )
+    corpus = builder.ReynirCorpus(dimensions=DIMENSIONS)
+
+    ids, vectors = uuid_vectors(60)
+    past = datetime.utcnow() - timedelta(days=1)
+    add_rows(ids[:50], vectors[:50], past)
+    # Articles without a topic vector, or with a faulty one, are skipped
+    add_rows([str(uuid.uuid4())], [None], past)
+    add_rows([str(uuid.uuid4())], [[1.0, 2.0]], past)
+    corpus.update_vector_store()
+    with VectorStore(corpus.vector_store_file) as store:
+        assert store.ids() == ids[:50]
+        assert store.timestamp > past
+
+    # Articles indexed after the update: ten new ones and one re-indexed
+    later = datetime.utcnow()
+    add_rows(ids[50:], vectors[50:], later)
+    add_rows([ids[7]], [vectors[0]], later)
+    server = simserver.SimilarityServer()
+    server._corpus = corpus
+    loaded.clear()
+    server._load_topics()
+    # Only the articles indexed after the update are loaded from the database
+    assert sorted(loaded) == sorted(ids[50:] + [ids[7]])
+    assert len(server._atopics) == 60
+    expected = dict(zip(ids, vectors))
+    expected[ids[7]] = vectors[0]
+    assert np.allclose(server.article_topic(ids[7]), server.article_topic(ids[0]))
+    rng = np.random.default_rng(5)
+    for q in rng.normal(size=(4, DIMENSIONS)):
+        assert_same_ranking(
+            server.find_similar(5, list(q)), similar_by_loop(expected, 5, q)
+        )
+
+    # The next update adds the newer articles to the store
+    corpus.update_vector_store()
+    with VectorStore(corpus.vector_store_file) as store:
+        assert store.ids() == ids
+        assert store.timestamp > later
+    loaded.clear()
+    server._load_topics()
+    assert not loaded and len(server._atopics) == 60
+    # Without the store, everything is loaded from the database
+    server._load_topics(use_store=False)
+    assert len(loaded) == 60 + 2
+
+    # An article is deleted (as when it is scraped again with a new id)
+    # and another one loses its topic vector: the server leaves both out
+    # at startup, and the next update removes them from the store
+    rows[:] = [r for r in rows if r.id != ids[3]]
+    for r in rows:
+        if r.id == ids[4]:
+            r.topic_vector_bin = r.topic_vector = None
+    live = [i for i in ids if i not in (ids[3], ids[4])]
+    server._load_topics()
+    assert server._atopics.ids == live
+    assert server.article_topic(ids[3]) is None
+    similar = server.find_similar(60, list(vectors[3]))
+    assert all(a not in (ids[3], ids[4]) for a, _ in similar)
+    corpus.update_vector_store()
+    with VectorStore(corpus.vector_store_file) as store:
+        assert store.ids() == live and store.capacity >= len(live)
+        assert np.allclose(
+            store.matrix()[: len(live)], server._atopics.vectors, atol=1.0e-6
+        )
+    server._load_topics()
+    assert server._atopics.ids == live
+
+
+def test_batched_article_vectors(simserver):
+    """ Test the batched calculation of article topic vectors in the builder
+        against the calculation of each article's vector on its own """
+    import builder
+
+    rng = np.random.default_rng(7)
+    words = ["orð{0}/kk".format(i) for i in range(30)]
+    num_terms = 25  # The last words are not in the model
+    token2id = {w: i for i, w in enumerate(words)}
+    idfs = {i: float(w) for i, w in enumerate(rng.uniform(0.5, 3.0, size=30))}
+    u = rng.normal(size=(num_terms, DIMENSIONS + 5))
+    article_ids = [str(uuid.uuid4()) for _ in range(12)]
+    rows = []
+    for ix, article_id in enumerate(article_ids):
+        # The first article has no words at all, the second one
+        # only has words that are outside the model
+        if ix == 1:
+            rows.append((article_id, "orð27", "kk", 2))
+        elif ix > 1:
+            for term_id in rng.choice(30, size=8, replace=False):
+                stem, cat = words[term_id].split("/")
+                rows.append((article_id, stem, cat, int(rng.integers(1, 4))))
+    # The same word may occur more than once for an article
+    rows.append(rows[-1])
+
+    class FakeSession:
+        def query(self, *args):
+            return self
+
+        def filter(self, *args):
+            return iter(rows)
+
+    corpus = builder.ReynirCorpus(dimensions=DIMENSIONS)
+    corpus._dictionary = SimpleNamespace(token2id=token2id)
+    corpus._tfidf = SimpleNamespace(idfs=idfs)
+    corpus._model = SimpleNamespace(
+        projection=SimpleNamespace(u=u), num_topics=DIMENSIONS
+    )
+    vectors = corpus._article_vectors(FakeSession(), article_ids)
+    assert vectors.shape == (len(article_ids), DIMENSIONS)
+
+    for row, article_id in enumerate(article_ids):
+        bag = np.zeros(num_terms)
+        for a_id, stem, cat, cnt in rows:
+            term_id = token2id[builder.w_from_stem(stem, cat)]
+            if a_id == article_id and term_id < num_terms:
+                bag[term_id] += cnt * idfs[term_id]
+        norm = np.linalg.norm(bag)
+        if norm == 0.0:
+            assert not vectors[row].any()
+            continue
+        expected = (bag / norm) @ u[:, :DIMENSIONS]
+        assert np.allclose(vectors[row], expected)
+
+
+def test_article_id_ranges(simserver):
+    """ Test that the article id ranges of parallel tagging processes
+        are disjoint and cover all article ids """
+    import builder
+
+    for parts in (1, 3, 8):
+        ranges = [builder.ReynirCorpus.article_id_range(p, parts) for p in range(parts)]
+        assert ranges[0][0] == str(uuid.UUID(int=0))
+        assert ranges[-1][1] is None
+        for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+            assert upper == lower
+        for _ in range(20):
+            article_id = str(uuid.uuid4())
+            owners = [
+                p
+                for p, (lower, upper) in enumerate(ranges)
+                if lower <= article_id and (upper is None or article_id < upper)
+            ]
+            assert len(owners) == 1
+
+
+class FakeWordQuery:
+
+    """ A streamed database query of the words of articles, applying the
+        filter on the parsing time to a list of (row, parsed) tuples """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def join(self, *args):
+        return self
+
+    def filter(self, criterion):
+        since = criterion.right.value
+        return FakeWordQuery([(r, parsed) for r, parsed in self.rows if parsed > since])
+
+    def order_by(self, *args):
+        return FakeWordQuery(sorted(self.rows, key=lambda r: r[0][0]))
+
+    @property
+    def statement(self):
+        return self
+
+    def execution_options(self, **kwargs):
+        assert kwargs.get("stream_results")
+        return self
+
+    def fetchmany(self, n):
+        batch = [r for r, _ in self.rows[:n]]
+        self.rows = self.rows[n:]
+        return batch
+
+
+def test_streaming_model_build(simserver, tmp_path, monkeypatch):
+    """ Test the single pass model build against the dictionary and TF-IDF
+        models built by Gensim, and the online update of the LSI model """
+    import builder
+    from gensim import corpora, models
+
+    rng = np.random.default_rng(11)
+    words = ["orð{0}".format(i) for i in range(40)]
+    past = datetime.utcnow() - timedelta(days=1)
+    rows = []
+
+    def add_articles(count, parsed):
+        for _ in range(count):
+            article_id = str(uuid.uuid4())
+            size = int(rng.integers(1, 12))
+            for ix in rng.choice(len(words), size=size, replace=False):
+                rows.append(
+                    ((article_id, words[ix], "kk", int(rng.integers(1, 5))), parsed)
+                )
+
+    class FakeSession:
+        def query(self, *args):
+            return FakeWordQuery(list(rows))
+
+        def execute(self, statement):
+            return statement
+
+    @contextmanager
+    def fake_context(**kwargs):
+        yield FakeSession()
+
+    monkeypatch.setattr(builder, "SessionContext", fake_context)
+    monkeypatch.setattr(builder.WordStream, "_FETCH_SIZE", 7)
+    for name in ("DICTIONARY", "TFIDF_MODEL", "LSI_MODEL", "MODEL_INFO"):
+        attr = "_{0}_FILE".format(name)
+        path = str(tmp_path / getattr(builder.ReynirCorpus, attr).split("/")[-1])
+        monkeypatch.setattr(builder.ReynirCorpus, attr, path)
+
+    add_articles(60, past)
+    corpus = builder.ReynirCorpus(dimensions=5)
+    # There is nothing to update before the model has been built
+    assert corpus.update_model() is None
+    assert corpus.create_model() == 60
+
+    # The same dictionary and TF-IDF model as built by Gensim
+    bags = defaultdict(list)
+    for (article_id, stem, cat, cnt), _ in sorted(rows):
+        bags[article_id].extend([builder.w_from_stem(stem, cat)] * cnt)
+    dic = corpora.Dictionary(bags.values())
+    dic.filter_extremes(no_below=3, keep_n=None)
+    assert corpus._dictionary.token2id == dic.token2id
+    assert corpus._dictionary.dfs == dic.dfs
+    assert corpus._dictionary.num_docs == dic.num_docs
+    tfidf = models.TfidfModel(dictionary=dic)
+    bows = [dic.doc2bow(bag) for bag in bags.values()]
+    bow = np.zeros((len(bows), len(dic)))
+    expected = np.zeros((len(bows), len(dic)))
+    for row, doc in enumerate(bows):
+        for term_id, cnt in doc:
+            bow[row, term_id] = cnt
+        for term_id, weight in tfidf[doc]:
+            expected[row, term_id] = weight
+    tfidf_matrix = corpus._tfidf_matrix(builder.sparse.csr_matrix(bow))
+    assert np.allclose(tfidf_matrix.toarray(), expected)
+
+    # The LSI model has the largest singular values of the TF-IDF matrix
+    lsi = corpus._model
+    assert lsi.num_terms == len(dic)
+    assert lsi.docs_processed == 60
+    s = np.linalg.svd(expected, compute_uv=False)[:5]
+    assert np.allclose(lsi.projection.s, s, rtol=1.0e-3)
+
+    # Only articles parsed after the build are added by an update,
+    # in chunks of the model
+    add_articles(25, datetime.utcnow() + timedelta(seconds=2))
+    lsi.chunksize = 10
+    lsi.save(builder.ReynirCorpus._LSI_MODEL_FILE.format(5))
+    assert builder.ReynirCorpus(dimensions=5).update_model() == 25
+    corpus = builder.ReynirCorpus(dimensions=5)
+    corpus.load_lsi_model()
+    assert corpus._model.docs_processed == 85
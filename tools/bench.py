@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Reproducible benchmark suite, running the main processing stages
+    on a frozen sample corpus stored in local files, without a database.
+
+    A corpus directory contains articles.jsonl, with one article per line
+    (url, authority, the extracted HTML content, and the parse tree and
+    token list as stored in the articles table), and queries.txt, with
+    one query per line. A corpus can be exported from the articles table
+    (the only command that needs a database), or made from plain text
+    files by parsing them. The suite in tools/benchcorpus is made from
+    the text files in tools/benchcorpus/text.
+
+    The runners are:
+
+        tokenize    Tokenization and entity recognition (Fetcher.to_tokens)
+        parse       Parsing of the article HTML (Article._parse)
+        load        Loading of parse trees (Tree.load)
+        processors  The tree and token processors, as run by
+                    Processor.go_single() on each article
+        trees       Traversal of the loaded parse trees by the persons
+                    and entities processors (Tree.process_all)
+        tag         Tagging of the article text (TreeUtility.tag_text)
+        query       Query handling (query.process_query)
+
+    For each runner, the throughput (sentences/sec and tokens/sec), the
+    p50 and p95 latency per article (or query) and the peak RSS of the
+    process so far are reported as JSON, so that runs can be compared
+    across commits. All database access is to an empty null session,
+    and the parse and location caches are disabled.
+
+    Usage:
+        python tools/bench.py run [--corpus DIR] [--runner NAME ...]
+            [--rounds R] [--output FILE]
+        python tools/bench.py make [--corpus DIR] textfile ...
+        python tools/bench.py export [--corpus DIR] [--limit N]
+
+"""
+
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+from contextlib import contextmanager
+
+# Hack to make this Python program executable from the tools subdirectory
+basepath, _ = os.path.split(os.path.realpath(__file__))
+_TOOLS = os.sep + "tools"
+if basepath.endswith(_TOOLS):
+    basepath = basepath[0 : -len(_TOOLS)]
+    sys.path.append(basepath)
+
+from settings import Settings, ConfigError
+
+
+_DEFAULT_CORPUS = os.path.join(basepath, "tools", "benchcorpus")
+_ARTICLES_FILE = "articles.jsonl"
+_QUERIES_FILE = "queries.txt"
+
+RUNNERS = ("tokenize", "parse", "load", "processors", "trees", "tag", "query")
+
+
+class NullQuery:
+
+    """ A query (or query result) on a database that contains nothing """
+
+    def __getattr__(self, name: str) -> Callable[..., "NullQuery"]:
+        # Query builder methods (filter, order_by, join, limit, ...)
+        # return the query itself
+        return lambda *args, **kwargs: self
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(())
+
+    def all(self) -> List[Any]:
+        return []
+
+    fetchall = all
+
+    def fetchmany(self, size: int = 0) -> List[Any]:
+        return []
+
+    def first(self) -> None:
+        return None
+
+    fetchone = one_or_none = scalar = first
+
+    def count(self) -> int:
+        return 0
+
+
+class NullSession:
+
+    """ A database session that finds nothing and stores nothing """
+
+    def __init__(self) -> None:
+        self.info: Dict[str, Any] = dict()
+
+    def query(self, *args: Any, **kwargs: Any) -> NullQuery:
+        return NullQuery()
+
+    def execute(self, *args: Any, **kwargs: Any) -> NullQuery:
+        return NullQuery()
+
+    @contextmanager
+    def begin_nested(self) -> Iterator[None]:
+        yield
+
+    def add(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    add_all = delete = expunge = flush = commit = rollback = close = add
+
+
+class NullDB:
+
+    """ Stands in for Scraper_DB, handing out null sessions """
+
+    @property
+    def session(self) -> NullSession:
+        return NullSession()
+
+    def dispose(self) -> None:
+        pass
+
+
+def go_offline() -> None:
+    """ Route all database access through null sessions and disable
+        the parse and location caches, so that every run does the full work """
+    from db import SessionContext
+    from processor import Processor
+
+    SessionContext._db = NullDB()  # type: ignore
+    Processor._db = NullDB()  # type: ignore
+    Settings.PARSE_CACHE_SIZE = 0
+    Settings.PARSE_CACHE_DB_ROWS = 0
+    Settings.LOCATION_CACHE_SIZE = 0
+    Settings.LOCATION_CACHE_DB_ROWS = 0
+
+
+def peak_rss_mb() -> float:
+    """ Return the peak resident set size of this process, in megabytes """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    if sys.platform == "darwin":
+        rss //= 1024
+    return round(rss / 1024.0, 1)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """ Return the p-th percentile of the values, by the nearest-rank method """
+    if not values:
+        return 0.0
+    s = sorted(values)
+    rank = max(int(-(-p * len(s) // 100)), 1)
+    return s[rank - 1]
+
+
+def git_commit() -> str:
+    """ Return the hash of the checked-out commit, if available """
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=basepath,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("ascii")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def count_tokens(tokens_json: str) -> Tuple[int, int]:
+    """ Return the number of sentences and tokens in a token list
+        in the format of the tokens column of the articles table """
+    pgs = json.loads(tokens_json)
+    sentences = [sent for pg in pgs for sent in pg]
+    return len(sentences), sum(len(sent) for sent in sentences)
+
+
+def plain_text(tokens_json: str) -> str:
+    """ Reconstruct the plain text of an article from its token list,
+        with paragraphs separated by blank lines """
+    pgs = json.loads(tokens_json)
+    return "\n\n".join(
+        " ".join(t["x"] for sent in pg for t in sent) for pg in pgs if pg
+    )
+
+
+def load_corpus(corpus: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """ Load the articles and queries of a benchmark corpus """
+    articles: List[Dict[str, Any]] = []
+    path = os.path.join(corpus, _ARTICLES_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    a = json.loads(line)
+                    a["sentences"], a["tokens_count"] = count_tokens(a["tokens"])
+                    articles.append(a)
+    queries: List[str] = []
+    path = os.path.join(corpus, _QUERIES_FILE)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            queries = [q.strip() for q in f if q.strip() and not q.startswith("#")]
+    return articles, queries
+
+
+def write_articles(corpus: str, articles: List[Dict[str, Any]]) -> None:
+    """ Write the articles of a benchmark corpus """
+    os.makedirs(corpus, exist_ok=True)
+    path = os.path.join(corpus, _ARTICLES_FILE)
+    with open(path, "w", encoding="utf-8") as f:
+        for a in articles:
+            f.write(json.dumps(a, ensure_ascii=False, sort_keys=True))
+            f.write("\n")
+    print("Wrote {0} articles to {1}".format(len(articles), path))
+
+
+def article_items(articles: List[Dict[str, Any]]) -> Iterator[Tuple[Any, int, int]]:
+    """ Yield (article, sentences, tokens) for each article """
+    for a in articles:
+        yield a, a["sentences"], a["tokens_count"]
+
+
+def run_tokenize(articles, queries, session):
+    """ Tokenize the article HTML and recognize entities """
+    from fetcher import Fetcher
+
+    def work(a):
+        soup = Fetcher.make_soup(a["html"])
+        for _ in Fetcher.to_tokens(soup.html.body, enclosing_session=session):
+            pass
+
+    return work, article_items(articles)
+
+
+def run_parse(articles, queries, session):
+    """ Parse the article HTML """
+    from article import Article
+
+    def work(a):
+        article = Article(url=a["url"])
+        article._html = a["html"]
+        article._parse(session)
+
+    return work, article_items(articles)
+
+
+def run_load(articles, queries, session):
+    """ Load the parse trees of the articles """
+    from tree import Tree
+
+    def work(a):
+        Tree(a["url"], a["authority"]).load(a["tree"])
+
+    return work, article_items(articles)
+
+
+def run_processors(articles, queries, session):
+    """ Run the processors on the articles, the way Processor.go_single()
+        does once it has read an article from the database """
+    from db import BulkWriter
+    from processor import Processor
+
+    processor = Processor("processors")
+    processor._import_modules()
+
+    def work(a):
+        writer = BulkWriter(session)
+        processor._process_tree(
+            session, writer, a["url"], a["tree"], a["tokens"], None, a["authority"]
+        )
+        writer.flush()
+
+    return work, article_items(articles)
+
+
+def run_trees(articles, queries, session):
+    """ Process the parse trees of the articles with the persons and
+        entities processors, with the trees loaded beforehand """
+    from db import BulkWriter
+    from tree import Tree
+    import processors.entities as entities
+    import processors.persons as persons
+
+    trees: Dict[str, Tree] = dict()
+    for a in articles:
+        tree = trees[a["url"]] = Tree(a["url"], a["authority"])
+        tree.load(a["tree"])
+
+    def work(a):
+        writer = BulkWriter(session)
+        trees[a["url"]].process_all(session, [persons, entities], writer=writer)
+        writer.flush()
+
+    return work, article_items(articles)
+
+
+def run_tag(articles, queries, session):
+    """ Tag the plain text of the articles """
+    from treeutil import TreeUtility
+
+    def work(text):
+        TreeUtility.tag_text(session, text)
+
+    return (
+        work,
+        ((plain_text(a["tokens"]), a["sentences"], a["tokens_count"]) for a in articles),
+    )
+
+
+def run_query(articles, queries, session):
+    """ Process the queries, as the query API does """
+    # The query modules need the application context of the web server
+    import main  # noqa: F401
+    from query import process_query
+
+    def work(q):
+        process_query(q, True, private=True, bypass_cache=True)
+
+    return work, ((q, 1, len(q.split())) for q in queries)
+
+
+def run_benchmark(
+    name: str, articles: List[Dict[str, Any]], queries: List[str], rounds: int
+) -> Dict[str, Any]:
+    """ Run one of the benchmarks and return its results """
+    runner = globals()["run_" + name]
+    session = NullSession()
+    work, items = runner(articles, queries, session)
+    items = list(items)
+    if not items:
+        return dict(items=0)
+    # Warm up (loading the parser, grammar and other resources)
+    # on the first item, outside the timed runs
+    work(items[0][0])
+    latencies: List[float] = []
+    sentences = tokens = 0
+    for _ in range(rounds):
+        for item, num_sentences, num_tokens in items:
+            t0 = time.perf_counter()
+            work(item)
+            latencies.append(time.perf_counter() - t0)
+            sentences += num_sentences
+            tokens += num_tokens
+    seconds = sum(latencies)
+    return dict(
+        items=len(latencies),
+        sentences=sentences,
+        tokens=tokens,
+        seconds=round(seconds, 4),
+        sentences_per_sec=round(sentences / seconds, 2) if seconds else 0.0,
+        tokens_per_sec=round(tokens / seconds, 2) if seconds else 0.0,
+        p50_ms=round(percentile(latencies, 50) * 1000.0, 3),
+        p95_ms=round(percentile(latencies, 95) * 1000.0, 3),
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+def run(args) -> None:
+    """ Run the benchmarks and output the results as JSON """
+    go_offline()
+    articles, queries = load_corpus(args.corpus)
+    results: Dict[str, Any] = dict(
+        commit=git_commit(),
+        python="{0} {1}".format(
+            platform.python_implementation(), platform.python_version()
+        ),
+        corpus=dict(
+            path=args.corpus,
+            articles=len(articles),
+            sentences=sum(a["sentences"] for a in articles),
+            tokens=sum(a["tokens_count"] for a in articles),
+            queries=len(queries),
+        ),
+        rounds=args.rounds,
+        runners=dict(),
+    )
+    for name in args.runner or RUNNERS:
+        print("Running {0}".format(name), file=sys.stderr)
+        results["runners"][name] = run_benchmark(name, articles, queries, args.rounds)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+            f.write("\n")
+    print(output)
+
+
+def make(args) -> None:
+    """ Make a corpus from plain text files, one article per file,
+        with paragraphs separated by blank lines """
+    from html import escape
+    from article import Article
+
+    go_offline()
+    session = NullSession()
+    articles: List[Dict[str, Any]] = []
+    for path in args.files:
+        with open(path, "r", encoding="utf-8") as f:
+            paragraphs = [p.strip() for p in f.read().split("\n\n") if p.strip()]
+        html = "<html><body>{0}</body></html>".format(
+            "".join("<p>{0}</p>".format(escape(p)) for p in paragraphs)
+        )
+        name = os.path.splitext(os.path.basename(path))[0]
+        article = Article(url="https://greynir.is/bench/{0}".format(name))
+        article._html = html
+        article._parse(session)
+        print(
+            "{0}: {1} sentences, {2} parsed".format(
+                name, article.num_sentences, article.num_parsed
+            )
+        )
+        articles.append(
+            dict(
+                url=article.url,
+                authority=1.0,
+                html=html,
+                tree=article.tree,
+                tokens=article.tokens,
+            )
+        )
+    write_articles(args.corpus, articles)
+
+
+def export(args) -> None:
+    """ Export a sample of parsed articles from the database """
+    from db import SessionContext
+    from db.models import Article as ArticleRow
+    from fetcher import Fetcher
+    from treepack import PackedArticle
+
+    articles: List[Dict[str, Any]] = []
+    with SessionContext(read_only=True) as session:
+        q = (
+            session.query(ArticleRow)
+            .filter(ArticleRow.tree != None)
+            .filter(ArticleRow.html != None)
+            .order_by(ArticleRow.timestamp.desc())
+            .limit(args.limit)
+        )
+        for a in q:
+            tree, tokens = a.tree, a.tokens
+            if a.packed is not None and not (tree and tokens):
+                packed = PackedArticle(a.packed)
+                tree, tokens = packed.tree(), packed.tokens_json()
+            if not (tree and tokens):
+                continue
+            # Store the content as extracted by the scrape helper,
+            # so that the corpus can be tokenized without it
+            helper = Fetcher.helper_for(session, a.url)
+            soup = Fetcher.make_soup(a.html, helper)
+            if soup is None:
+                continue
+            content = soup.html.body if helper is None else helper.get_content(soup)
+            if not content:
+                continue
+            html = "<html><body>{0}</body></html>".format(content)
+            articles.append(
+                dict(
+                    url=a.url,
+                    authority=a.authority,
+                    html=html,
+                    tree=tree,
+                    tokens=tokens,
+                )
+            )
+    write_articles(args.corpus, articles)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the processing stages of Greynir on a frozen corpus"
+    )
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=_DEFAULT_CORPUS,
+        help="corpus directory (default: tools/benchcorpus)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser("run", help="run the benchmarks")
+    p.add_argument(
+        "--runner",
+        choices=RUNNERS,
+        action="append",
+        help="benchmark to run (may be repeated; default: all)",
+    )
+    p.add_argument(
+        "--rounds", type=int, default=1, help="times to run over the corpus"
+    )
+    p.add_argument("--output", type=str, help="file to write the JSON results to")
+    p.set_defaults(func=run)
+
+    p = subparsers.add_parser("make", help="make a corpus from plain text files")
+    p.add_argument("files", nargs="+", help="text files, one article each")
+    p.set_defaults(func=make)
+
+    p = subparsers.add_parser("export", help="export a corpus from the database")
+    p.add_argument(
+        "--limit", type=int, default=100, help="number of articles to export"
+    )
+    p.set_defaults(func=export)
+
+    args = parser.parse_args()
+    args.corpus = os.path.abspath(args.corpus)
+    # Processor modules and resources are found relative to the main directory
+    os.chdir(basepath)
+
+    try:
+        # Read configuration file
+        Settings.read(os.path.join(basepath, "config", "Greynir.conf"))
+    except ConfigError as e:
+        print("Configuration error: {0}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
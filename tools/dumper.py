@@ -37,6 +37,7 @@ from datetime import datetime
 from settings import Settings, ConfigError
 from db import Scraper_DB
 from db.models import Article
+from treepack import unpack_tokens
 from tokenizer import TOK
 
 
@@ -58,10 +59,11 @@ class Dumper:
         pass
 
 
-    def dump(self, tokens_json, file):
+    def dump(self, tokens, file):
         """ Dump the sentences of a single article to a text file,
             one sentence per line """
-        tokens = json.loads(tokens_json)
+        if isinstance(tokens, str):
+            tokens = json.loads(tokens)
         skip_punctuation = frozenset(( '„', '“', '”' ))
         abort_punctuation = frozenset(( '…', '|', '#', '@' ))
         for p in tokens:
@@ -167,7 +169,7 @@ class Dumper:
         with closing(db.session) as session, open(output, "w") as file:
 
             """ Go through parsed articles and process them """
-            q = session.query(Article.tokens).filter(Article.tree != None)
+            q = session.query(Article.tokens, Article.packed).filter(Article.has_tree)
             if limit > 0:
                 q = q[0:limit]
             else:
@@ -176,7 +178,7 @@ class Dumper:
             for a in q:
                 if cnt % 1000 == 0:
                     print("Dumped {0} articles".format(cnt), end=chr(13))
-                self.dump(a.tokens, file)
+                self.dump(a.tokens or unpack_tokens(a.packed), file)
                 cnt += 1
             print("Dumped {0} articles".format(cnt), end=chr(13))
 
@@ -16,11 +16,12 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 
 from db import SessionContext, desc
 from db.models import Article
+from treepack import unpack_tokens
 
 with SessionContext(read_only=True) as session:
     q = (
-        session.query(Article.id, Article.timestamp, Article.tokens)
-        .filter(Article.tree != None)
+        session.query(Article.id, Article.timestamp, Article.tokens, Article.packed)
+        .filter(Article.has_tree)
         .filter(Article.timestamp != None)
         .filter(Article.timestamp <= datetime.utcnow())
         .filter(Article.heading > "")
@@ -31,7 +32,7 @@ with SessionContext(read_only=True) as session:
 
     for i, a in enumerate(q.yield_per(100)):
         print("%d\r" % i, end="")
-        tokens = json.loads(a.tokens)
+        tokens = json.loads(a.tokens) if a.tokens else unpack_tokens(a.packed)
         # Paragraphs
         for p in tokens:
             # Sentences
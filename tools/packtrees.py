@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Utility script that converts the parse trees and tokens of articles
+    in Greynir's database between the text format (the tree and tokens
+    columns) and the compact binary format of treepack.py (the packed
+    column). Articles are converted in batches, each in its own
+    transaction, so the script can be interrupted and resumed.
+
+    Set packed_articles = True in Greynir.conf before or after packing,
+    so that newly parsed articles are also stored in the packed format.
+
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Hack to make this Python program executable from the tools subdirectory
+basepath, _ = os.path.split(os.path.realpath(__file__))
+_TOOLS = os.sep + "tools"
+if basepath.endswith(_TOOLS):
+    basepath = basepath[0 : -len(_TOOLS)]
+    sys.path.append(basepath)
+
+from settings import Settings, ConfigError
+from db import SessionContext
+from db.models import Article as ArticleModel
+from db.setup import upgrade_tables
+from treepack import pack_article, unpack_tokens_json, unpack_tree
+
+
+def convert(unpack=False, batch_size=500, limit=0, dry_run=False):
+    """ Convert articles to (or from) the packed format """
+    if unpack:
+        src = ArticleModel.packed != None
+    else:
+        src = (ArticleModel.tree != None) & (ArticleModel.tokens != None)
+    last_id = None
+    count = failed = text_bytes = packed_bytes = 0
+    t0 = time.time()
+    while True:
+        with SessionContext(commit=not dry_run) as session:
+            q = session.query(ArticleModel).filter(src)
+            if last_id is not None:
+                q = q.filter(ArticleModel.id > last_id)
+            n = batch_size if not limit else min(batch_size, limit - count - failed)
+            batch = q.order_by(ArticleModel.id).limit(n).all()
+            if not batch:
+                break
+            for a in batch:
+                last_id = a.id
+                if unpack:
+                    a.tree = unpack_tree(a.packed)
+                    a.tokens = unpack_tokens_json(a.packed)
+                    packed = a.packed
+                    a.packed = None
+                else:
+                    try:
+                        packed = pack_article(a.tree, a.tokens)
+                    except ValueError as e:
+                        print("Unable to pack {0}: {1}".format(a.url, e))
+                        failed += 1
+                        continue
+                    text_bytes += len(a.tree.encode("utf-8"))
+                    text_bytes += len(a.tokens.encode("utf-8"))
+                    a.packed = packed
+                    a.tree = None
+                    a.tokens = None
+                packed_bytes += len(packed)
+                count += 1
+            if dry_run:
+                session.rollback()
+        print(
+            "{0} articles converted, {1} failed, {2:.1f} seconds".format(
+                count, failed, time.time() - t0
+            )
+        )
+        if limit and count + failed >= limit:
+            break
+    if text_bytes:
+        print(
+            "Text format: {0:,} bytes, packed format: {1:,} bytes ({2:.1f}%)".format(
+                text_bytes, packed_bytes, 100.0 * packed_bytes / text_bytes
+            )
+        )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Convert article trees and tokens to or from the packed format"
+    )
+    parser.add_argument(
+        "--unpack",
+        action="store_true",
+        help="convert packed articles back to the text format",
+    )
+    parser.add_argument(
+        "--batch", type=int, default=500, help="number of articles per transaction"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=0, help="maximum number of articles to convert"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="convert without storing, to measure the size reduction",
+    )
+    args = parser.parse_args()
+
+    try:
+        # Read configuration file
+        Settings.read(os.path.join(basepath, "config", "Greynir.conf"))
+    except ConfigError as e:
+        print("Configuration error: {0}".format(e))
+        quit()
+
+    # Make sure that the packed column exists
+    upgrade_tables(SessionContext.db)
+
+    convert(
+        unpack=args.unpack,
+        batch_size=max(args.batch, 1),
+        limit=args.limit,
+        dry_run=args.dry_run,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    Benchmark of TreeBase.load(), comparing it with the generic,
+    line-by-line loader (TreeBase.load_generic()) building nodes the
+    way the original loader did, on a sample of stored articles (or on
+    tree text files given on the command line). The trees built by both
+    loaders are also checked for equality.
+
+    Usage:
+        python tools/treebench.py [--limit N] [--rounds R] [file ...]
+
+"""
+
+import os
+import sys
+import time
+import argparse
+
+# Hack to make this Python program executable from the tools subdirectory
+basepath, _ = os.path.split(os.path.realpath(__file__))
+_TOOLS = os.sep + "tools"
+if basepath.endswith(_TOOLS):
+    basepath = basepath[0 : -len(_TOOLS)]
+    sys.path.append(basepath)
+
+from settings import Settings, ConfigError
+from tree import Node, NonterminalNode, TerminalNode, Tree, TreeBase
+from tree import _REPEAT_SUFFIXES
+from treepack import unpack_tree
+
+
+class LegacyTree(Tree):
+
+    """ A Tree that builds its nodes the way the original loader did,
+        without the caches of parsed terminal and nonterminal names.
+        Since it overrides the node handlers, TreeBase.load() dispatches
+        every line to a handler method, as the original loader did. """
+
+    def handle_T(self, n, s):
+        t = TreeBase._parse_T_uncached(s)
+        constructor = self._TC.get(t.cat, TerminalNode)
+        self.push(
+            n,
+            constructor(
+                t.terminal,
+                t.augmented_terminal,
+                t.token,
+                t.tokentype,
+                t.aux,
+                self.at_start,
+            ),
+        )
+        self.at_start = False
+
+    def handle_N(self, n, nonterminal):
+        node = NonterminalNode.__new__(NonterminalNode)
+        Node.__init__(node)
+        node.nt = nonterminal
+        elems = nonterminal.split("_")
+        node.nt_base = elems[0]
+        node.variants = set(elems[1:])
+        node.is_repeated = node.nt_base[-1] in _REPEAT_SUFFIXES
+        self.push(n, node)
+
+
+def signature(node):
+    """ Return a nested tuple describing a sentence tree, for comparison """
+    result = []
+    while node is not None:
+        if isinstance(node, TerminalNode):
+            result.append(("T", node.td.terminal, node.token, node.at_start))
+        else:
+            result.append(("N", node.nt, node.nt_base, signature(node.child)))
+        node = node.nxt
+    return tuple(result)
+
+
+def sample_trees(limit):
+    """ Fetch tree texts of recently parsed articles from the database """
+    from db import SessionContext, desc
+    from db.models import Article
+
+    with SessionContext(read_only=True) as session:
+        q = (
+            session.query(Article.tree, Article.packed)
+            .filter(Article.has_tree)
+            .order_by(desc(Article.parsed))
+            .limit(limit)
+        )
+        return [a.tree or unpack_tree(a.packed) for a in q]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark TreeBase.load()")
+    parser.add_argument(
+        "--limit", type=int, default=200, help="number of articles to sample"
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="number of timed rounds"
+    )
+    parser.add_argument("files", nargs="*", help="tree text files to load")
+    args = parser.parse_args()
+
+    if args.files:
+        trees = []
+        for fname in args.files:
+            with open(fname, "r", encoding="utf-8") as f:
+                trees.append(f.read())
+    else:
+        try:
+            Settings.read(os.path.join(basepath, "config", "Greynir.conf"))
+        except ConfigError as e:
+            print("Configuration error: {0}".format(e))
+            quit()
+        trees = sample_trees(args.limit)
+
+    if not trees:
+        print("No trees to load")
+        return
+
+    # Check that both loaders build identical trees
+    for txt in trees:
+        t_old, t_new = LegacyTree(), Tree()
+        t_old.load(txt)
+        t_new.load(txt)
+        assert list(t_old.s.keys()) == list(t_new.s.keys())
+        assert t_old.scores == t_new.scores and t_old.lengths == t_new.lengths
+        for ix, root in t_old.s.items():
+            assert signature(root) == signature(t_new.s[ix])
+
+    num_lines = sum(txt.count("\n") for txt in trees)
+    print(
+        "{0} articles, {1:,} lines, {2} rounds".format(
+            len(trees), num_lines, args.rounds
+        )
+    )
+    timings = dict()
+    for name, loader in (
+        ("original", lambda txt: LegacyTree().load(txt)),
+        ("current", lambda txt: Tree().load(txt)),
+    ):
+        best = None
+        for _ in range(args.rounds):
+            t0 = time.perf_counter()
+            for txt in trees:
+                loader(txt)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        print(
+            "{0:>8}: {1:8.1f} ms total, {2:6.2f} ms/article, "
+            "{3:8,.0f} lines/sec".format(
+                name, 1000 * best, 1000 * best / len(trees), num_lines / best
+            )
+        )
+    print("Speedup: {0:.2f}x".format(timings["original"] / timings["current"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,7 @@ from reynir.bindb import BIN_Db
 from db import SessionContext, DatabaseError, desc
 from db.models import Article, Trigram
 from tree import TreeTokenList, TerminalDescriptor
+from treepack import unpack_tree
 
 
 CHANGING = set() # A set of all words we need to change
@@ -64,7 +65,7 @@ def dump_tokens(limit):
         # Iterate through the articles
         q = (
             session.query(Article)
-            .filter(Article.tree != None)
+            .filter(Article.has_tree)
             .order_by(Article.timestamp)
         )
         if limit is None:
@@ -77,7 +78,7 @@ def dump_tokens(limit):
                 .format(a)
             )
             tree = TreeTokenList()
-            tree.load(a.tree)
+            tree.load(a.tree or unpack_tree(a.packed))
             for ix, toklist in tree.token_lists():
                 print("\nSentence {0}:".format(ix))
                 at_start = True
@@ -134,8 +135,8 @@ def make_trigrams(limit, output_tsv=False):
         fill_corrections()
         # Iterate through the articles
         q = (
-            session.query(Article.url, Article.timestamp, Article.tree)
-            .filter(Article.tree != None)
+            session.query(Article.url, Article.timestamp, Article.tree, Article.packed)
+            .filter(Article.has_tree)
             .order_by(Article.timestamp)
         )
         if limit is None:
@@ -148,7 +149,7 @@ def make_trigrams(limit, output_tsv=False):
             for a in q:
                 #print("Processing article from {0.timestamp}: {0.url}".format(a))
                 tree = TreeTokenList()
-                tree.load(a.tree)
+                tree.load(a.tree or unpack_tree(a.packed))
                 for _, toklist in tree.token_lists():
                     if toklist and len(toklist) > 1:
                         # For each sentence, start and end with empty strings
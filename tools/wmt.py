@@ -41,6 +41,7 @@ from settings import Settings, ConfigError
 from db import SessionContext
 from db.models import Article
 from tokenizer import correct_spaces
+from treepack import PackedArticle
 
 def main():
 
@@ -56,7 +57,11 @@ def main():
         aft = datetime(2020, 7, 27, 0, 0, 1)
         q = (
             session.query(
-                Article.url, Article.timestamp, Article.heading, Article.tokens
+                Article.url,
+                Article.timestamp,
+                Article.heading,
+                Article.tokens,
+                Article.packed,
             )
             .filter(Article.timestamp > bef)
             .filter(Article.timestamp < aft)
@@ -64,18 +69,24 @@ def main():
         )
         items = list()
         for r in q.all():
-            (url, ts, title, tokens) = r
+            (url, ts, title, tokens, packed) = r
             text = ""
-            tokens = json.loads(tokens)
-            if not tokens:
+            # The token list is stored either as JSON text
+            # or in the packed binary format
+            if tokens:
+                # Paragraphs
+                sentences = (s for p in json.loads(tokens) for s in p)
+            elif packed is not None:
+                sentences = PackedArticle(packed).sentence_tokens()
+            else:
+                continue
+            # Sentences
+            for s in sentences:
+                # Tokens
+                for t in s:
+                    text += t["x"] + " "
+            if not text:
                 continue
-            # Paragraphs
-            for p in tokens:
-                # Sentences
-                for s in p:
-                    # Tokens
-                    for t in s:
-                        text += t["x"] + " "
 
             d = dict(url=url, timestamp=ts.isoformat(), title=title, text=text)
             d["text"] = correct_spaces(d["text"])
@@ -27,7 +27,20 @@
 
 """
 
-from typing import Dict, Optional, List, Tuple, Any, Union, Callable, Iterator, Iterable, NamedTuple, cast
+from typing import (
+    Dict,
+    FrozenSet,
+    Optional,
+    List,
+    Tuple,
+    Any,
+    Union,
+    Callable,
+    Iterator,
+    Iterable,
+    NamedTuple,
+    cast,
+)
 
 import json
 import re
@@ -37,6 +50,7 @@ import abc
 
 from reynir.bindb import BIN_Db
 from reynir.binparser import BIN_Token
+from reynir.fastparser import ParseForestNavigator
 from reynir.simpletree import SimpleTreeBuilder
 from reynir.cache import LRU_Cache
 
@@ -82,12 +96,23 @@ BIN_ORDFL = {
 
 _REPEAT_SUFFIXES = frozenset(("+", "*", "?"))
 
+# Patterns for parsing T (terminal) lines in the text tree format
+_T_SINGLE_QUOTED = re.compile(r"\'[^\']*\'\w*")
+_T_DOUBLE_QUOTED = re.compile(r"\"[^\"]*\"\w*")
+_T_TOKEN = re.compile(r"\"[^\"]*\"")
+_T_TOKEN_COMPAT = re.compile(r"\'[^\']*\'")
+
+# Maximum number of entries in the cache of parsed T lines
+_T_CACHE_SIZE = 65536
+
 
 class Node(abc.ABC):
 
     """ Base class for terminal and nonterminal nodes reconstructed from
         trees in text format loaded from the scraper database """
 
+    __slots__ = ("child", "nxt")
+
     def __init__(self) -> None:
         self.child: OptionalNode = None
         self.nxt: OptionalNode = None
@@ -151,11 +176,19 @@ class Node(abc.ABC):
     ) -> Iterator["Node"]:
         """ Do a depth-first traversal of all children of this node,
             returning those that pass a test function, if given """
+        # The traversal uses an explicit stack of the ancestors of the
+        # current node, rather than recursion, since trees can be deep
+        stack: List[Node] = []
         c = self.child
-        while c:
-            for cc in c.descendants():
-                if test_f is None or test_f(cc):
-                    yield cc
+        while True:
+            if c is not None:
+                # Descend into the children of c before yielding it
+                stack.append(c)
+                c = c.child
+                continue
+            if not stack:
+                return
+            c = stack.pop()
             if test_f is None or test_f(c):
                 yield c
             c = c.nxt
@@ -227,13 +260,27 @@ class Result:
         it will automatically get an "operand" attribute
         containing [ left_op, right_op ].
 
+        A result keeps track of whether it may contain user attributes,
+        i.e. attributes whose names do not start with an underscore,
+        so that the (typically many) results without any of them are
+        skipped when merging child results into their parents.
+
     """
 
+    # Our own custom dict for instance attributes, the associated node,
+    # processor state and child results, and the user attribute flag
+    __slots__ = ("dict", "_node", "_state", "_params", "_user")
+
+    _SLOTS = frozenset(__slots__)
+
     def __init__(self, node, state, params):
-        self.dict = dict()  # Our own custom dict for instance attributes
-        self._node = node
-        self._state = state
-        self._params = params
+        # Bypass our fancy attribute setter for the slots
+        setattr_ = object.__setattr__
+        setattr_(self, "dict", dict())
+        setattr_(self, "_node", node)
+        setattr_(self, "_state", state)
+        setattr_(self, "_params", params)
+        setattr_(self, "_user", False)
 
     @property
     def node(self):
@@ -254,12 +301,14 @@ class Result:
 
     def __setattr__(self, key, val):
         """ Fancy attribute setter using our own dict for instance attributes """
-        if key == "__dict__" or key == "dict" or key in self.__dict__:
+        if key in self._SLOTS:
             # Relay to Python's default attribute resolution mechanism
-            super().__setattr__(key, val)
+            object.__setattr__(self, key, val)
         else:
             # Set attribute in our own dict
             self.dict[key] = val
+            if not key.startswith("_"):
+                object.__setattr__(self, "_user", True)
 
     def __getattr__(self, key):
         """ Fancy attribute getter with special cases for _root and _nominative """
@@ -304,6 +353,8 @@ class Result:
 
     def __setitem__(self, key, val):
         self.dict[key] = val
+        if not isinstance(key, str) or not key.startswith("_"):
+            object.__setattr__(self, "_user", True)
 
     def __delitem__(self, key):
         del self.dict[key]
@@ -324,9 +375,10 @@ class Result:
 
     def copy_from(self, p):
         """ Copy all user attributes from p into this result """
-        if p is self or p is None:
+        if p is self or p is None or not p._user:
             return
         d = self.dict
+        object.__setattr__(self, "_user", True)
         for key, val in p.user_attribs():
             # Pass all named parameters whose names do not start with an underscore
             # up to the parent, by default
@@ -370,14 +422,25 @@ class Result:
     def enum_descendants(self, test_f=None):
         """ Enumerate the descendant parameters of this node, yielding (child_node, result)
             where the child node meets the given test, if any """
-        if self._params:
-            for p, c in zip(self._params, self._node.children()):
-                if p is not None:
-                    # yield from p.enum_descendants(test_f)
-                    for d_c, d_p in p.enum_descendants(test_f):
-                        yield (d_c, d_p)
+        if not self._params:
+            return
+        # Explicit stack of (child iterator, (child_node, result) of the parent),
+        # where the parent is yielded once its descendants have been enumerated
+        stack: List[Tuple[Iterator[Tuple[Any, Node]], Any]] = [
+            (zip(self._params, self._node.children()), None)
+        ]
+        while stack:
+            for p, c in stack[-1][0]:
+                if p is not None and p._params:
+                    # Enumerate the descendants of p before yielding it
+                    stack.append((zip(p._params, p._node.children()), (c, p)))
+                    break
                 if test_f is None or test_f(c):
                     yield (c, p)
+            else:
+                _, parent = stack.pop()
+                if parent is not None and (test_f is None or test_f(parent[0])):
+                    yield parent
 
     def find_child(self, **kwargs):
         """ Find a child parameter meeting the criteria given in kwargs """
@@ -696,6 +759,24 @@ class TerminalNode(Node):
 
     """ A Node corresponding to a terminal """
 
+    __slots__ = (
+        "td",
+        "token",
+        "_text",
+        "_at_start",
+        "tokentype",
+        "is_word",
+        "is_literal",
+        "is_declinable",
+        "augmented_terminal",
+        "aux",
+        "_aux",
+        "root_cache",
+        "nominative_cache",
+        "indefinite_cache",
+        "canonical_cache",
+    )
+
     # Undeclinable terminal categories
     _NOT_DECLINABLE = frozenset(
         ["ao", "eo", "spao", "fs", "st", "stt", "nhm", "uh", "töl"]
@@ -1031,10 +1112,11 @@ class TerminalNode(Node):
         """ Prepare a result object to be passed up to enclosing nonterminals """
         assert not params  # A terminal node should not have parameters
         result = Result(self, state, None)  # No params
-        result._terminal = self.td.terminal
-        result._text = self.text
-        result._token = self.token
-        result._tokentype = self.tokentype
+        d = result.dict
+        d["_terminal"] = self.td.terminal
+        d["_text"] = self._text
+        d["_token"] = self.token
+        d["_tokentype"] = self.tokentype
         return result
 
     def build_simple_tree(self, builder: Any) -> None:
@@ -1072,6 +1154,8 @@ class PersonNode(TerminalNode):
 
     """ Specialized TerminalNode for person terminals """
 
+    __slots__ = ("fullnames",)
+
     def __init__(self, terminal, augmented_terminal, token, tokentype, aux, at_start):
         super().__init__(terminal, augmented_terminal, token, tokentype, aux, at_start)
         # Load the full names from the auxiliary JSON information
@@ -1153,14 +1237,24 @@ class NonterminalNode(Node):
 
     """ A Node corresponding to a nonterminal """
 
+    __slots__ = ("nt", "nt_base", "variants", "is_repeated")
+
+    # Cache of (base name, variants, is_repeated) tuples by nonterminal name.
+    # There is a limited number of nonterminals in the grammar, and each
+    # of them occurs many times in a typical article.
+    _NT_CACHE: Dict[str, Tuple[str, FrozenSet[str], bool]] = dict()
+
     def __init__(self, nonterminal: str) -> None:
         super().__init__()
         self.nt = nonterminal
-        elems = nonterminal.split("_")
-        # Calculate the base name of this nonterminal (without variants)
-        self.nt_base = elems[0]
-        self.variants = set(elems[1:])
-        self.is_repeated = self.nt_base[-1] in _REPEAT_SUFFIXES
+        info = self._NT_CACHE.get(nonterminal)
+        if info is None:
+            elems = nonterminal.split("_")
+            # Calculate the base name of this nonterminal (without variants)
+            base = elems[0]
+            info = (base, frozenset(elems[1:]), base[-1] in _REPEAT_SUFFIXES)
+            self._NT_CACHE[nonterminal] = info
+        self.nt_base, self.variants, self.is_repeated = info
 
     def build_simple_tree(self, builder: Any) -> None:
         builder.push_nonterminal(self.nt_base)
@@ -1216,14 +1310,20 @@ class NonterminalNode(Node):
     def process(self, state, params):
         """ Apply any requested processing to this node """
         result = Result(self, state, params)
-        result._nonterminal = self.nt
+        d = result.dict
+        d["_nonterminal"] = self.nt
         # Calculate the combined text rep of the results of the children
-        result._text = " ".join(p._text for p in params if p is not None and p._text)
+        texts = []
         for p in params:
-            # Copy all user variables (attributes not starting with an underscore _)
-            # coming from the children into the result
             if p is not None:
-                result.copy_from(p)
+                t = p.dict.get("_text") or p._text
+                if t:
+                    texts.append(t)
+                if p._user:
+                    # Copy all user variables (attributes not starting with
+                    # an underscore _) coming from the child into the result
+                    result.copy_from(p)
+        d["_text"] = " ".join(texts)
         # Invoke a processor function for this nonterminal, if
         # present in the given processor module. The check for 'Query'
         # catches a corner case where the processor may have imported
@@ -1251,6 +1351,39 @@ class NonterminalNode(Node):
         return result
 
 
+class _ForestLoader(ParseForestNavigator):
+
+    """ Feeds the nodes of an unambiguous parse forest to the handlers
+        of a tree, in the same order and with the same parameters as
+        loading the output of ParseForestDumper.dump_forest() would """
+
+    def __init__(self, tree: "TreeBase") -> None:
+        super().__init__(visit_all=True)
+        self._tree = tree
+
+    def visit_epsilon(self, level: int) -> Any:
+        return None
+
+    def visit_token(self, level: int, w: Any) -> Any:
+        self._tree.handle_T(level, "{0} {1}".format(w.terminal.name, w.token.dump))
+        return None
+
+    def visit_nonterminal(self, level: int, w: Any) -> Any:
+        # Interior nodes are not loaded and do not increment the level
+        if not w.is_interior:
+            if w.is_empty and w.nonterminal.is_optional:
+                # Skip optional nodes that don't contain anything
+                return NotImplemented
+            self._tree.handle_N(level, w.nonterminal.name)
+        return None
+
+    def visit_family(
+        self, results: Any, level: int, w: Any, ix: int, prod: Any
+    ) -> None:
+        # The forest must have been reduced to a single tree
+        assert not w.is_ambiguous
+
+
 class TreeBase:
 
     """ A tree corresponding to a single parsed article """
@@ -1361,8 +1494,24 @@ class TreeBase:
         """ Epsilon node: leave the parent nonterminal childless """
         pass
 
+    # Cache of parsed T descriptors. The same terminal lines (for instance
+    # for punctuation and common function words) recur across sentences
+    # and articles.
+    _T_CACHE: Dict[str, TreeToken] = dict()
+
     @staticmethod
     def _parse_T(s: str) -> TreeToken:
+        """ Parse a T (Terminal) descriptor """
+        t = TreeBase._T_CACHE.get(s)
+        if t is None:
+            t = TreeBase._parse_T_uncached(s)
+            if len(TreeBase._T_CACHE) >= _T_CACHE_SIZE:
+                TreeBase._T_CACHE.clear()
+            TreeBase._T_CACHE[s] = t
+        return t
+
+    @staticmethod
+    def _parse_T_uncached(s: str) -> TreeToken:
         """ Parse a T (Terminal) descriptor """
         # The string s contains:
         # terminal "token" [TOKENTYPE] [auxiliary-json]
@@ -1373,11 +1522,11 @@ class TreeBase:
         # separated by underscores. The \w regexp pattern matches
         # alpabetic characters as well as digits and underscores.
         if s[0] == "'":
-            r = re.match(r"\'[^\']*\'\w*", s)
+            r = _T_SINGLE_QUOTED.match(s)
             terminal = r.group() if r else ""
             s = s[r.end() + 1 :] if r else ""
         elif s[0] == '"':
-            r = re.match(r"\"[^\"]*\"\w*", s)
+            r = _T_DOUBLE_QUOTED.match(s)
             terminal = r.group() if r else ""
             s = s[r.end() + 1 :] if r else ""
         else:
@@ -1385,10 +1534,10 @@ class TreeBase:
             terminal = a[0]
             s = a[1]
         # Retrieve token text
-        r = re.match(r"\"[^\"]*\"", s)
+        r = _T_TOKEN.match(s)
         if r is None:
             # Compatibility: older versions used single quotes around token text
-            r = re.match(r"\'[^\']*\'", s)
+            r = _T_TOKEN_COMPAT.match(s)
         token = r.group() if r else ""
         s = s[r.end() + 1 :] if r else ""
         augmented_terminal = terminal
@@ -1429,24 +1578,95 @@ class TreeBase:
         """ Nonterminal """
         self.push(n, NonterminalNode(nonterminal))
 
+    def load_forest(self, n: int, forest: Any) -> None:
+        """ Loads sentence n directly from an unambiguous (reduced) parse
+            forest, yielding the same tree as loading the forest's text
+            dump would, but without the round trip through text """
+        self.handle_S(n)
+        _ForestLoader(self).go(forest)
+        self.handle_Q(0)
+
     def load(self, txt: str) -> None:
         """ Loads a tree from the text format stored by the scraper """
+        cls = type(self)
+        # Nonterminal and terminal lines make up the bulk of the text.
+        # Unless a subclass overrides their handling, they are processed
+        # inline here, avoiding method dispatch for every line.
+        if not (
+            cls.push is TreeBase.push
+            and cls.handle_N is TreeBase.handle_N
+            and cls.handle_T is TreeBase.handle_T
+        ):
+            self.load_generic(txt)
+            return
+        handlers: Dict[str, Callable[..., None]] = dict()
+        parse_T = self._parse_T
+        constructors = self._TC
         for line in txt.split("\n"):
             if not line:
                 continue
-            a = line.split(" ", maxsplit=1)
-            if not a:
-                continue
-            code = a[0]
-            n = int(code[1:])
-            f = getattr(self, "handle_" + code[0], None)
-            if f:
-                if len(a) >= 2:
-                    f(n, a[1])
+            code = line[0]
+            sp = line.find(" ")
+            if sp > 0 and (code == "N" or code == "T"):
+                n = int(line[1:sp])
+                node: Node
+                if code == "N":
+                    node = NonterminalNode(line[sp + 1 :])
                 else:
-                    f(n)
-            else:
+                    t = parse_T(line[sp + 1 :])
+                    node = constructors.get(t.cat, TerminalNode)(
+                        t.terminal,
+                        t.augmented_terminal,
+                        t.token,
+                        t.tokentype,
+                        t.aux,
+                        self.at_start,
+                    )
+                    self.at_start = False
+                # Add the node into the tree at the right level,
+                # as in push() but without the method call overhead
+                stack = self.stack
+                assert stack is not None
+                if n == len(stack):
+                    # First child of parent
+                    if n:
+                        stack[n - 1].child = node
+                    stack.append(node)
+                else:
+                    # Next child of parent
+                    stack[n].nxt = node
+                    stack[n] = node
+                    del stack[n + 1 :]
+                continue
+            self._dispatch(handlers, line, sp)
+
+    def _dispatch(
+        self, handlers: Dict[str, Callable[..., None]], line: str, sp: int
+    ) -> None:
+        """ Call the handle_X() method for a line of the text format,
+            where sp is the index of the first space in the line, if any.
+            The handlers dict caches the methods by line code. """
+        code = line[0]
+        f = handlers.get(code)
+        if f is None:
+            f = getattr(self, "handle_" + code, None)
+            if f is None:
                 assert False, "*** No handler for {0}".format(line)
+            handlers[code] = f
+        if sp > 0:
+            f(int(line[1:sp]), line[sp + 1 :])
+        else:
+            f(int(line[1:]))
+
+    def load_generic(self, txt: str) -> None:
+        """ Loads a tree from the text format by calling the handle_X()
+            method for every line. This is what load() does for subclasses
+            that override the node handlers; it is also the reference
+            that the inline handling in load() must agree with. """
+        handlers: Dict[str, Callable[..., None]] = dict()
+        for line in txt.split("\n"):
+            if line:
+                self._dispatch(handlers, line, line.find(" "))
 
 
 class Tree(TreeBase):
@@ -1460,15 +1680,39 @@ class Tree(TreeBase):
 
     def visit_children(self, state, node):
         """ Visit the children of node, obtain results from them and pass them to the node """
-        # First check whether the processor has a visit() method
+        # This is a post-order traversal using an explicit stack of
+        # (ancestor, index of its first child result) tuples, instead of
+        # recursion. The results of the children of all the ancestors
+        # of the current node are kept in a single list, from which
+        # they are sliced off as the parameters of their parent.
         visit = state["_visit"]
-        if visit is not None and not visit(state, node):
-            # Call the visit() method and if it returns False, we do not visit this node
-            # or its children
-            return None
-        return node.process(
-            state, [self.visit_children(state, child) for child in node.children()]
-        )
+        stack: List[Tuple[Node, int]] = []
+        results: List[Optional[Result]] = []
+        while True:
+            if visit is not None and not visit(state, node):
+                # Call the processor's visit() method, if it has one, and if it
+                # returns False, we do not visit this node or its children
+                results.append(None)
+            elif node.child is None:
+                results.append(node.process(state, []))
+            else:
+                # Visit the children before processing the node itself
+                stack.append((node, len(results)))
+                node = node.child
+                continue
+            # The node has been processed: move on to its next sibling,
+            # or process its parent if it was the parent's last child
+            while stack:
+                if node.nxt is not None:
+                    node = node.nxt
+                    break
+                node, start = stack.pop()
+                params = results[start:]
+                del results[start:]
+                results.append(node.process(state, params))
+            else:
+                # Back at the node we started from
+                return results[0]
 
     def process_sentence(self, state, tree):
         """ Process a single sentence tree """
@@ -1481,36 +1725,91 @@ class Tree(TreeBase):
         if sentence is not None:
             sentence(state, result)
 
+    def visit_children_all(self, states, node):
+        """ Visit the children of node on behalf of several processors at once,
+            returning a list of results with one entry per processor state.
+            A state is None where the processor's visit() method has declined
+            to visit the node or one of its ancestors. """
+        # This is a post-order traversal using an explicit stack,
+        # as in visit_children(), where each stack entry also holds
+        # the states of the processors that are visiting the ancestor
+        stack: List[Tuple[Node, int, List[Any]]] = []
+        results: List[List[Optional[Result]]] = []
+        while True:
+            active = [
+                state
+                if state is not None
+                and (state["_visit"] is None or state["_visit"](state, node))
+                else None
+                for state in (stack[-1][2] if stack else states)
+            ]
+            if not any(active):
+                results.append([None] * len(states))
+            elif node.child is None:
+                results.append(
+                    [
+                        node.process(state, []) if state is not None else None
+                        for state in active
+                    ]
+                )
+            else:
+                stack.append((node, len(results), active))
+                node = node.child
+                continue
+            while stack:
+                if node.nxt is not None:
+                    node = node.nxt
+                    break
+                node, start, active = stack.pop()
+                child_results = results[start:]
+                del results[start:]
+                results.append(
+                    [
+                        node.process(state, [r[ix] for r in child_results])
+                        if state is not None
+                        else None
+                        for ix, state in enumerate(active)
+                    ]
+                )
+            else:
+                return results[0]
+
+    def _processor_state(self, session, processor, bin_db, kwargs):
+        """ Initialize the running state that we keep between sentences
+            for a processor module """
+        sentence = getattr(processor, "sentence", None) if processor else None
+        # If visit(state, node) returns False for a node, do not visit child nodes
+        visit = getattr(processor, "visit", None) if processor else None
+        # If no handler exists for a nonterminal, call default() instead
+        default = getattr(processor, "default", None) if processor else None
+        state = {
+            "session": session,
+            "processor": processor,
+            "bin_db": bin_db,
+            "url": self.url,
+            "authority": self.authority,
+            "_sentence": sentence,
+            "_visit": visit,
+            "_default": default,
+            "index": 0,
+        }
+        # Add state parameters passed via keyword arguments, if any
+        state.update(kwargs)
+        return state
+
     def process(self, session, processor, **kwargs):
         """ Process a tree for an entire article """
         # For each sentence in turn, do a depth-first traversal,
         # visiting each parent node after visiting its children
-        # Initialize the running state that we keep between sentences
 
         article_begin = getattr(processor, "article_begin", None) if processor else None
         article_end = getattr(processor, "article_end", None) if processor else None
-        sentence = getattr(processor, "sentence", None) if processor else None
-        # If visit(state, node) returns False for a node, do not visit child nodes
-        visit = getattr(processor, "visit", None) if processor else None
-        # If no handler exists for a nonterminal, call default() instead
-        default = getattr(processor, "default", None) if processor else None
 
         with BIN_Db.get_db() as bin_db:
 
-            state = {
-                "session": session,
-                "processor": processor,
-                "bin_db": bin_db,
-                "url": self.url,
-                "authority": self.authority,
-                "_sentence": sentence,
-                "_visit": visit,
-                "_default": default,
-                "index": 0,
-            }
-            # Add state parameters passed via keyword arguments, if any
-            state.update(kwargs)
-
+            # Processors that add database rows get a bulk writer for
+            # them from the caller, via the writer keyword argument
+            state = self._processor_state(session, processor, bin_db, kwargs)
             # Call the article_begin(state) function, if it exists
             if article_begin is not None:
                 article_begin(state)
@@ -1522,6 +1821,43 @@ class Tree(TreeBase):
             if article_end is not None:
                 article_end(state)
 
+    def process_all(self, session, processors, **kwargs):
+        """ Process a tree for an entire article with several processor
+            modules in a single traversal of each sentence. Each processor
+            gets its own state and results, and its functions are called
+            in the same order relative to each other as by process(),
+            but the sentences are processed by all the processors before
+            moving on to the next one. """
+        if len(processors) == 1:
+            self.process(session, processors[0], **kwargs)
+            return
+
+        with BIN_Db.get_db() as bin_db:
+
+            states = [
+                self._processor_state(session, processor, bin_db, kwargs)
+                for processor in processors
+            ]
+
+            for processor, state in zip(processors, states):
+                article_begin = getattr(processor, "article_begin", None)
+                if article_begin is not None:
+                    article_begin(state)
+            for index, tree in self.s.items():
+                assert tree.nxt is None
+                for state in states:
+                    state["index"] = index
+                results = self.visit_children_all(states, tree)
+                # Invoke the 'sentence(state, result)' function of each processor
+                for state, result in zip(states, results):
+                    sentence = state["_sentence"]
+                    if sentence is not None:
+                        sentence(state, result)
+            for processor, state in zip(processors, states):
+                article_end = getattr(processor, "article_end", None)
+                if article_end is not None:
+                    article_end(state)
+
 
 class TreeGist(TreeBase):
 
@@ -0,0 +1,391 @@
+"""
+
+    Greynir: Natural language processing for Icelandic
+
+    Compact binary format for article parse trees and tokens
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module implements a compact binary serialization of the parse
+    tree text and the token list of an article, as stored in the
+    articles.packed column.
+
+    The text formats (Article.tree and Article.tokens) repeat the same
+    tree lines ("N5 Setning") and token dicts ({"x":".","k":1}) over
+    and over again, and consumers have to split or json.loads() them in
+    full even if they only need a few sentences. In the packed format,
+    every distinct tree line and every distinct token (in compact JSON)
+    is interned once in a symbol table, and the article itself is a
+    sequence of symbol ids. Counts are varint-encoded, while the symbol
+    ids are fixed-width arrays so that they can be decoded in bulk
+    rather than byte by byte in Python.
+    The header, with the sentence and token counts, comes first and the
+    symbol table last, so that a reader can decompress just the header
+    (to count sentences or tokens, for instance) without decompressing
+    the rest. The symbol table is only split into strings when a tree or
+    token list is first asked for, and each sentence can be decoded, or
+    skipped, independently of the others.
+    The whole body is compressed with zstd if the zstandard package is
+    installed, otherwise with zlib.
+
+    Layout (after the 5-byte prefix, within the compressed body):
+
+        symbols:        count
+        id width:       2 or 4 (bytes per symbol id)
+        prelude:        number of tree lines before the first sentence
+        paragraphs:     count, then number of sentences per paragraph
+        sentences:      (tree line count, token count) per sentence
+        symbol length:  byte length of the symbol strings
+        line ids:       symbol ids of all tree lines, in order
+        token ids:      symbol ids of all tokens, in order
+        symbol strings: NUL-separated UTF-8 strings
+
+    The packed form round-trips exactly: unpack_tree() returns the
+    original tree text and unpack_tokens_json() the original token
+    list in compact JSON format.
+
+"""
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import sys
+import json
+import zlib
+from array import array
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+
+# Prefix of every packed blob: magic bytes and format version
+PACK_MAGIC = b"GnP"
+PACK_VERSION = 2
+
+# Compression methods
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_ZSTD = 2
+
+# Array type codes for symbol ids, by width in bytes
+_ID_TYPES = {2: "H", 4: "I"}
+
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+class PackedSentence(NamedTuple):
+
+    """ A sentence from a packed article """
+
+    # 1-based index of the sentence within the article
+    index: int
+    # 1-based index of the paragraph containing the sentence
+    paragraph: int
+    # The sentence's part of the tree text, starting with its S line
+    tree: str
+    # The sentence's token dicts
+    tokens: List[Dict[str, Any]]
+
+
+def _varint(out: bytearray, n: int) -> None:
+    """ Append a non-negative integer to out, 7 bits per byte """
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _compress(body: bytes) -> Tuple[int, bytes]:
+    if zstandard is not None:
+        return COMPRESS_ZSTD, zstandard.ZstdCompressor(level=3).compress(body)
+    return COMPRESS_ZLIB, zlib.compress(body, 6)
+
+
+def pack_article(tree: str, tokens: Union[str, List[Any]]) -> bytes:
+    """ Pack the tree text and token list (or its JSON string) of an
+        article into the compact binary format. Raises ValueError if
+        the tree's sentences don't correspond to the token list. """
+    if isinstance(tokens, str):
+        tokens = json.loads(tokens)
+    assert isinstance(tokens, list)
+    symbols: Dict[str, int] = dict()
+
+    def sym(s: str) -> int:
+        ix = symbols.get(s)
+        if ix is None:
+            if "\x00" in s:
+                raise ValueError("Unable to pack a string containing NUL")
+            ix = symbols[s] = len(symbols)
+        return ix
+
+    # Split the tree text into the lines before the first sentence,
+    # and the lines of each sentence, starting with its S line
+    line_ids: List[int] = []
+    line_counts: List[int] = []
+    count = 0
+    for line in tree.split("\n"):
+        if line[0:1] == "S":
+            line_counts.append(count)
+            count = 0
+        line_ids.append(sym(line))
+        count += 1
+    line_counts.append(count)
+    prelude = line_counts.pop(0)
+    if len(line_counts) != sum(len(pg) for pg in tokens):
+        raise ValueError("Sentences in tree and token list don't match")
+    token_ids: List[int] = []
+    token_counts: List[int] = []
+    dumps = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+    for pg in tokens:
+        for sent in pg:
+            token_ids.extend(sym(dumps(t)) for t in sent)
+            token_counts.append(len(sent))
+
+    body = bytearray()
+    _varint(body, len(symbols))
+    width = 2 if len(symbols) <= 0x10000 else 4
+    body.append(width)
+    _varint(body, prelude)
+    _varint(body, len(tokens))
+    for pg in tokens:
+        _varint(body, len(pg))
+    for nl, nt in zip(line_counts, token_counts):
+        _varint(body, nl)
+        _varint(body, nt)
+    blob = "\x00".join(symbols).encode("utf-8")
+    _varint(body, len(blob))
+    for ids in (line_ids, token_ids):
+        a = array(_ID_TYPES[width], ids)
+        if _BIG_ENDIAN:
+            a.byteswap()
+        body += a.tobytes()
+    body += blob
+    method, data = _compress(bytes(body))
+    return PACK_MAGIC + bytes((PACK_VERSION, method)) + data
+
+
+class _Body:
+
+    """ The decompressed body of a packed article, which is decompressed
+        incrementally, only as far as has been asked for """
+
+    # Number of compressed bytes to decompress at a time
+    _CHUNK = 4096
+
+    def __init__(self, method: int, data: bytes) -> None:
+        self._data = data
+        self._pos = 0
+        self._decompress: Any = None
+        if method == COMPRESS_ZSTD:
+            if zstandard is None:
+                raise ValueError("The zstandard package is required to unpack")
+            self._decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+            self.buf = bytearray()
+        elif method == COMPRESS_ZLIB:
+            self._decompress = zlib.decompressobj().decompress
+            self.buf = bytearray()
+        elif method == COMPRESS_NONE:
+            self.buf = bytearray(data)
+            self._pos = len(data)
+        else:
+            raise ValueError("Unknown compression method {0}".format(method))
+
+    def need(self, end: int) -> None:
+        """ Make sure that the body has been decompressed up to end """
+        buf = self.buf
+        data = self._data
+        while len(buf) < end and self._pos < len(data):
+            chunk = max(self._CHUNK, end - len(buf))
+            buf += self._decompress(data[self._pos : self._pos + chunk])
+            self._pos += chunk
+        if len(buf) < end:
+            raise ValueError("Packed article is truncated")
+
+
+class PackedArticle:
+
+    """ Reader for a packed article. Only the header is decompressed and
+        decoded up front; the symbol table and the sentences are
+        decompressed and decoded lazily, on demand. """
+
+    def __init__(self, data: bytes) -> None:
+        data = bytes(data)
+        if data[0:3] != PACK_MAGIC or data[3] != PACK_VERSION:
+            raise ValueError("Not a packed article")
+        self._body = _Body(data[4], data[5:])
+        self._pos = 0
+        varint = self._varint
+        nsym = varint()
+        width = self._byte()
+        self._type = _ID_TYPES[width]
+        self._width = width
+        self._prelude = varint()
+        self._paragraphs = [varint() for _ in range(varint())]
+        num_sentences = sum(self._paragraphs)
+        self._counts = [(varint(), varint()) for _ in range(num_sentences)]
+        self._num_lines = self._prelude + sum(nl for nl, _ in self._counts)
+        self._num_tokens = sum(nt for _, nt in self._counts)
+        blob_length = varint()
+        # Offsets of the symbol id arrays and the symbol strings
+        self._lines_start = self._pos
+        self._tokens_start = self._pos + self._num_lines * width
+        blob_start = self._tokens_start + self._num_tokens * width
+        self._blob = (blob_start, blob_length, nsym)
+        self._symbols_list: Optional[List[str]] = None
+        self._line_ids: Optional[array] = None
+        self._token_ids: Optional[array] = None
+
+    def _byte(self) -> int:
+        pos = self._pos
+        self._body.need(pos + 1)
+        self._pos = pos + 1
+        return self._body.buf[pos]
+
+    def _varint(self) -> int:
+        b = self._byte()
+        n = b & 0x7F
+        shift = 7
+        while b & 0x80:
+            b = self._byte()
+            n |= (b & 0x7F) << shift
+            shift += 7
+        return n
+
+    @property
+    def _symbols(self) -> List[str]:
+        """ The symbol strings, decoded when first needed """
+        if self._symbols_list is None:
+            start, length, nsym = self._blob
+            self._body.need(start + length)
+            blob = self._body.buf[start : start + length].decode("utf-8")
+            self._symbols_list = blob.split("\x00") if nsym else []
+        return self._symbols_list
+
+    def _ids(self, start: int, count: int) -> array:
+        """ Decode an array of symbol ids from the buffer """
+        end = start + count * self._width
+        self._body.need(end)
+        a = array(self._type)
+        a.frombytes(self._body.buf[start:end])
+        if _BIG_ENDIAN:
+            a.byteswap()
+        return a
+
+    @property
+    def line_ids(self) -> array:
+        if self._line_ids is None:
+            self._line_ids = self._ids(self._lines_start, self._num_lines)
+        return self._line_ids
+
+    @property
+    def token_ids(self) -> array:
+        if self._token_ids is None:
+            self._token_ids = self._ids(self._tokens_start, self._num_tokens)
+        return self._token_ids
+
+    def _sentence_json(self, token_ids: array, start: int, count: int) -> str:
+        """ Return the JSON string of a sentence's token list """
+        ids = token_ids[start : start + count]
+        return "[" + ",".join(map(self._symbols.__getitem__, ids)) + "]"
+
+    @property
+    def num_sentences(self) -> int:
+        return len(self._counts)
+
+    @property
+    def num_tokens(self) -> int:
+        """ The number of tokens in the article, found without decoding them """
+        return self._num_tokens
+
+    def _iterate(self, want_tree: bool, want_tokens: bool) -> Iterator[PackedSentence]:
+        """ Iterate through the sentences, decoding only what is asked for """
+        syms = self._symbols
+        line_ids = self.line_ids if want_tree else None
+        token_ids = self.token_ids if want_tokens else None
+        lpos = self._prelude
+        tpos = 0
+        counts = iter(self._counts)
+        index = 0
+        for pix, count in enumerate(self._paragraphs, start=1):
+            for _ in range(count):
+                index += 1
+                nl, nt = next(counts)
+                tree = ""
+                tokens: List[Dict[str, Any]] = []
+                if line_ids is not None:
+                    tree = "\n".join(map(syms.__getitem__, line_ids[lpos : lpos + nl]))
+                if token_ids is not None:
+                    tokens = json.loads(self._sentence_json(token_ids, tpos, nt))
+                lpos += nl
+                tpos += nt
+                yield PackedSentence(index, pix, tree, tokens)
+
+    def sentences(self) -> Iterator[PackedSentence]:
+        """ Lazily generate the sentences of the article """
+        return self._iterate(True, True)
+
+    def sentence_tokens(self) -> Iterator[List[Dict[str, Any]]]:
+        """ Lazily generate the token lists of the sentences,
+            without decoding the tree text """
+        for s in self._iterate(False, True):
+            yield s.tokens
+
+    def sentence_trees(self) -> Iterator[Tuple[int, str]]:
+        """ Lazily generate (index, tree text) tuples for the sentences,
+            without decoding the tokens """
+        for s in self._iterate(True, False):
+            yield s.index, s.tree
+
+    def tree(self) -> str:
+        """ Return the tree text of the whole article """
+        return "\n".join(map(self._symbols.__getitem__, self.line_ids))
+
+    def tokens_json(self) -> str:
+        """ Return the token list of the whole article as a compact JSON
+            string of paragraphs containing sentences containing token dicts """
+        token_ids = self.token_ids
+        counts = iter(self._counts)
+        tpos = 0
+        pgs: List[str] = []
+        for count in self._paragraphs:
+            sents: List[str] = []
+            for _ in range(count):
+                _, nt = next(counts)
+                sents.append(self._sentence_json(token_ids, tpos, nt))
+                tpos += nt
+            pgs.append("[" + ",".join(sents) + "]")
+        return "[" + ",".join(pgs) + "]"
+
+    def tokens(self) -> List[List[List[Dict[str, Any]]]]:
+        """ Return the token list of the whole article, as paragraphs
+            containing sentences containing token dicts """
+        return json.loads(self.tokens_json())
+
+
+def unpack_tree(packed: Optional[bytes]) -> Optional[str]:
+    """ Return the tree text of a packed article, or None """
+    return None if packed is None else PackedArticle(packed).tree()
+
+
+def unpack_tokens(packed: Optional[bytes]) -> Optional[List[Any]]:
+    """ Return the token list of a packed article, or None """
+    return None if packed is None else PackedArticle(packed).tokens()
+
+
+def unpack_tokens_json(packed: Optional[bytes]) -> Optional[str]:
+    """ Return the token list of a packed article as a JSON string, or None """
+    return None if packed is None else PackedArticle(packed).tokens_json()
@@ -33,6 +33,8 @@ from collections import namedtuple
 from nertokenizer import recognize_entities
 from db import SessionContext
 from settings import Settings
+from parsecache import ParseCache
+from tokenizer import __version__ as tokenizer_version
 
 from reynir import TOK, mark_paragraphs, tokenize
 from reynir.binparser import BIN_Token, augment_terminal, describe_token
@@ -301,35 +303,83 @@ class TreeUtility:
         return s.result
 
     @staticmethod
-    def _process_toklist(parser, session, toklist, xform):
+    def _process_toklist(parser, session, toklist, xform, cache_kind=None):
         """ Low-level utility function to parse token lists and return
-            the result of a transformation function (xform) for each sentence """
+            the result of a transformation function (xform) for each sentence.
+            If cache_kind is given, the (JSON-serializable) results of the
+            xform function are cached in the sentence parse cache under
+            that kind, and cached results are used instead of parsing
+            where available. """
         # Paragraph list, containing sentences, containing tokens
         pgs = []  # type: List[List[BIN_Token]]
         ip = IncrementalParser(parser, toklist, verbose=True)
-        for p in ip.paragraphs():
+        # Parse statistics, accumulated here since sentences found
+        # in the parse cache are not seen by the IncrementalParser
+        num_tokens = num_sentences = num_parsed = 0
+        num_combinations = total_score = total_tokens = 0
+        total_ambig = 0.0
+        # Split the text into sentences up front, so that the parse
+        # cache can be consulted for all of them in one lookup
+        paragraphs = [list(p.sentences()) for p in ip.paragraphs()]
+        keys = dict()
+        found = dict()
+        if cache_kind is not None:
+            version = "{0}/{1}".format(parser.version, tokenizer_version)
+            keys = {
+                id(sent): ParseCache.key(sent.tokens, version, cache_kind)
+                for p in paragraphs
+                for sent in p
+            }
+            found = ParseCache.get_many(session, keys.values())
+        # Parse results not found in the cache, to be stored there
+        parsed = dict()
+        for p in paragraphs:
             pgs.append([])
-            for sent in p.sentences():
-                if sent.parse():
-                    # Parsed successfully
-                    pgs[-1].append(xform(sent.tokens, sent.tree, None))
-                else:
-                    # Error in parse
-                    pgs[-1].append(xform(sent.tokens, None, sent.err_index))
+            for sent in p:
+                key = keys.get(id(sent))
+                cached = found.get(key) if key is not None else None
+                if cached is None:
+                    num_comb = ip.num_combinations
+                    if sent.parse():
+                        # Parsed successfully
+                        result = xform(sent.tokens, sent.tree, None)
+                    else:
+                        # Error in parse
+                        result = xform(sent.tokens, None, sent.err_index)
+                    cached = dict(
+                        n=ip.num_combinations - num_comb,
+                        score=sent.score,
+                        result=result,
+                    )
+                    if key is not None:
+                        parsed[key] = cached
+                slen = len(sent)
+                num = cached["n"]
+                num_sentences += 1
+                num_tokens += slen
+                if num > 0:
+                    num_parsed += 1
+                    num_combinations += num
+                    total_ambig += num ** (1 / slen) * slen
+                    total_tokens += slen
+                    total_score += cached["score"]
+                pgs[-1].append(cached["result"])
+
+        ParseCache.put_many(session, parsed)
 
         stats = dict(
-            num_tokens=ip.num_tokens,
-            num_sentences=ip.num_sentences,
-            num_parsed=ip.num_parsed,
-            ambiguity=ip.ambiguity,
-            num_combinations=ip.num_combinations,
-            total_score=ip.total_score,
+            num_tokens=num_tokens,
+            num_sentences=num_sentences,
+            num_parsed=num_parsed,
+            ambiguity=(total_ambig / total_tokens) if total_tokens > 0 else 1.0,
+            num_combinations=num_combinations,
+            total_score=total_score,
         )
 
         return pgs, stats
 
     @staticmethod
-    def _process_text(parser, session, text, all_names, xform):
+    def _process_text(parser, session, text, all_names, xform, cache_kind=None):
         """ Low-level utility function to parse text and return the result of
             a transformation function (xform) for each sentence.
             Set all_names = True to get a comprehensive name register.
@@ -342,7 +392,9 @@ class TreeUtility:
         token_stream = tokenize(text)
         toklist = list(recognize_entities(token_stream, enclosing_session=session))
         t1 = time.time()
-        pgs, stats = TreeUtility._process_toklist(parser, session, toklist, xform)
+        pgs, stats = TreeUtility._process_toklist(
+            parser, session, toklist, xform, cache_kind
+        )
 
         if all_names is None:
             register = None
@@ -368,7 +420,9 @@ class TreeUtility:
                 normalized tokens for the sentence """
             return TreeUtility.dump_tokens(tokens, tree, error_index=err_index)
 
-        return TreeUtility._process_text(parser, session, text, all_names, xform)
+        return TreeUtility._process_text(
+            parser, session, text, all_names, xform, cache_kind="tag"
+        )
 
     @staticmethod
     def tag_text(session, text, all_names=False):
@@ -389,7 +443,9 @@ class TreeUtility:
             return TreeUtility.dump_tokens(tokens, tree, error_index=err_index)
 
         with Fast_Parser(verbose=False) as parser:  # Don't emit diagnostic messages
-            pgs, stats = TreeUtility._process_toklist(parser, session, toklist, xform)
+            pgs, stats = TreeUtility._process_toklist(
+                parser, session, toklist, xform, cache_kind="tag"
+            )
         from queries.builtin import create_name_register
 
         register = create_name_register(toklist, session, all_names=all_names)
@@ -407,7 +463,11 @@ class TreeUtility:
             return TreeUtility.dump_tokens(tokens, tree, error_index=err_index)
 
         with Fast_Parser(verbose=False, root=root) as parser:
-            return TreeUtility._process_toklist(parser, session, toklist, xform)
+            # Results depend on the root nonterminal, so only
+            # cache results for the default root
+            return TreeUtility._process_toklist(
+                parser, session, toklist, xform, cache_kind="tag" if root is None else None
+            )
 
     @staticmethod
     def parse_text(session, text, all_names=False):
@@ -422,7 +482,9 @@ class TreeUtility:
             return TreeUtility._simplify_tree(tokens, tree)
 
         with Fast_Parser(verbose=False) as parser:  # Don't emit diagnostic messages
-            return TreeUtility._process_text(parser, session, text, all_names, xform)
+            return TreeUtility._process_text(
+                parser, session, text, all_names, xform, cache_kind="simple"
+            )
 
     @staticmethod
     def simple_parse(text):
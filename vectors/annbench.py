@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Benchmark of the approximate nearest neighbour index
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This program measures the recall and latency of similarity queries
+    answered by the approximate nearest neighbour index (IVFIndex in
+    topicindex.py) for different numbers of probed clusters, compared
+    with the exact search of TopicMatrix. The queries are topic vectors
+    of randomly chosen articles.
+
+    By default, the article topic vectors are loaded from the database.
+    With --random N, a synthetic, clustered collection of N vectors is
+    used instead.
+
+    Usage:
+        python annbench.py [--random N] [--queries Q] [--n N]
+                           [--lists L] [--probes 1,2,4,8,16,32]
+
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from topicindex import TopicMatrix, IVFIndex, unpack_vector
+
+
+def load_articles(matrix):
+    """ Load article topic vectors from the database into the matrix """
+    from settings import Settings
+    from db import SessionContext
+    from db.models import Article, Root
+
+    Settings.read("Vectors.conf")
+    ids = []
+    vectors = []
+    with SessionContext(read_only=True) as session:
+        q = (
+            session.query(Article)
+            .join(Root)
+            .filter(Root.visible)
+            .filter(Article.has_topic_vector)
+            .with_entities(Article.id, Article.topic_vector_bin, Article.topic_vector)
+        )
+        for a in q.yield_per(2000):
+            vec = unpack_vector(a.topic_vector_bin, a.topic_vector)
+            if len(vec) == matrix.dimensions:
+                ids.append(a.id)
+                vectors.append(vec)
+    matrix.update(ids, vectors)
+
+
+def random_articles(matrix, count, seed=0):
+    """ Fill the matrix with a synthetic collection of clustered vectors """
+    rng = np.random.default_rng(seed)
+    num_clusters = max(1, count // 500)
+    centers = rng.normal(size=(num_clusters, matrix.dimensions))
+    for start in range(0, count, 50000):
+        size = min(50000, count - start)
+        vectors = centers[rng.integers(num_clusters, size=size)]
+        vectors += 0.6 * rng.normal(size=vectors.shape)
+        matrix.update(list(range(start, start + size)), vectors)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the approximate nearest neighbour index"
+    )
+    parser.add_argument(
+        "--random", type=int, default=0, help="use N synthetic vectors"
+    )
+    parser.add_argument(
+        "--dimensions", type=int, default=200, help="dimensions of topic vectors"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=200, help="number of queries"
+    )
+    parser.add_argument("--n", type=int, default=10, help="results per query")
+    parser.add_argument(
+        "--lists", type=int, default=0, help="number of clusters (0 = auto)"
+    )
+    parser.add_argument(
+        "--probes",
+        default="1,2,4,8,16,32,64",
+        help="comma-separated numbers of clusters to probe",
+    )
+    args = parser.parse_args()
+
+    matrix = TopicMatrix(args.dimensions)
+    t0 = time.time()
+    if args.random:
+        random_articles(matrix, args.random)
+    else:
+        load_articles(matrix)
+    if not len(matrix):
+        print("No topic vectors found")
+        sys.exit(1)
+    print(
+        "{0:,} vectors of {1} dimensions loaded in {2:.2f} seconds".format(
+            len(matrix), matrix.dimensions, time.time() - t0
+        )
+    )
+
+    index = IVFIndex(matrix, min_size=0)
+    t0 = time.time()
+    index.train(n_lists=args.lists)
+    print(
+        "Index of {0} clusters trained in {1:.2f} seconds".format(
+            index.num_lists, time.time() - t0
+        )
+    )
+
+    rng = np.random.default_rng(1)
+    queries = matrix.vectors[rng.choice(len(matrix), args.queries)]
+
+    def timed(func):
+        """ Run func on each query, returning the results and the
+            mean latency in milliseconds """
+        results = []
+        t0 = time.perf_counter()
+        for q in queries:
+            results.extend(func(q))
+        return results, 1000.0 * (time.perf_counter() - t0) / len(queries)
+
+    exact, exact_ms = timed(lambda q: matrix.top_n(args.n, [q]))
+    fmt = "{0:>8} {1:>10.4f} {2:>10.3f} {3:>8.1f}"
+    print("{0:>8} {1:>10} {2:>10} {3:>8}".format("probes", "recall", "ms", "speedup"))
+    print(fmt.format("exact", 1.0, exact_ms, 1.0))
+    for probes in (int(p) for p in args.probes.split(",")):
+        approx, ms = timed(lambda q: index.top_n(args.n, [q], n_probes=probes))
+        found = sum(
+            len(set(a for a, _ in e) & set(a for a, _ in r))
+            for e, r in zip(exact, approx)
+        )
+        recall = found / sum(len(e) for e in exact)
+        print(fmt.format(probes, recall, ms, exact_ms / ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -46,6 +46,12 @@
     4) Generation of the LSI lower-dimensionality model (matrix) from the corpus
         after transformation of each document through the TFIDF vector
 
+    Stages 1) to 4) are carried out in a single pass over the words table
+    (see ReynirCorpus.create_model()), keeping the corpus in memory as a
+    sparse matrix. Articles parsed after the model was built can be added
+    to it with the online training of the LSI model, without rebuilding
+    the dictionary (see ReynirCorpus.update_model()).
+
     After the LSI model has been generated, it can be used to calculate LSI
     vectors for any set of words. We calculate such vectors for each topic
     in the topics database table by using the topic keywords as input for each
@@ -53,22 +59,33 @@
     estimated by calculating the cosine similarity between the article's LSI
     vector and the topic's LSI vector.
 
+    After tagging articles, the builder brings the memory-mapped vector
+    store (see VectorStore in topicindex.py) up to date with the article
+    topic vectors in the database. The similarity server maps the store
+    at startup instead of loading every topic vector from the database.
+
 """
 
 import sys
 import getopt
 import json
 import time
+from array import array
+from uuid import UUID
 from datetime import datetime
 from collections import defaultdict
+from multiprocessing import Pool
 
 from settings import Settings, Topics, NoIndexWords
 from db import SessionContext
-from db.models import Article, Topic, ArticleTopic, Word
+from db.models import Article, Root, Topic, ArticleTopic, Word
 from db.queries import TermTopicsQuery
 from similar import SimilarityClient
+from db.setup import upgrade_tables
+from topicindex import VectorStore, pack_vector, unpack_vector
 
 import numpy as np
+from scipy import sparse
 from gensim import corpora, models, matutils
 
 
@@ -122,12 +139,52 @@ class CorpusIterator:
         print("Finished iteration through corpus from words table")
 
 
+class WordStream:
+
+    """ Stream the words database table in a single pass through a
+        server-side cursor, yielding the id of each article along with
+        its bag-of-words as a dict of counts. If since is given, only
+        articles parsed after that time point are included. """
+
+    # Number of rows fetched from the cursor at a time
+    _FETCH_SIZE = 20000
+
+    def __init__(self, since=None):
+        self._since = since
+
+    def __iter__(self):
+        with SessionContext(commit=True, read_only=True) as session:
+            q = session.query(Word.article_id, Word.stem, Word.cat, Word.cnt)
+            if self._since is not None:
+                q = q.join(Article).filter(Article.parsed > self._since)
+            q = q.order_by(Word.article_id)
+            result = session.execute(
+                q.statement.execution_options(stream_results=True)
+            )
+            bag = {}
+            last_uuid = None
+            while True:
+                rows = result.fetchmany(self._FETCH_SIZE)
+                if not rows:
+                    break
+                for uuid, stem, cat, cnt in rows:
+                    if uuid != last_uuid:
+                        if bag:
+                            yield last_uuid, bag
+                            bag = {}
+                        last_uuid = uuid
+                    w = w_from_stem(stem, cat)
+                    bag[w] = bag.get(w, 0) + cnt
+            if bag:
+                yield last_uuid, bag
+
+
 class ReynirDictionary(corpora.Dictionary):
 
     """ Subclass of gensim.corpora.Dictionary that adds a __contains__
         operator for easy membership check """
 
-    def __init__(self, iterator):
+    def __init__(self, iterator=None):
         super().__init__(iterator)
 
     def __contains__(self, word):
@@ -148,6 +205,8 @@ class ReynirCorpus:
     _TFIDF_MODEL_FILE = "./models/tfidf.model"
     _LSI_MODEL_FILE = "./models/lsi-{0}.model"
     _LDA_MODEL_FILE = "./models/lda-{0}.model"
+    _MODEL_INFO_FILE = "./models/lsi-{0}.json"
+    _VECTOR_STORE_FILE = "./models/vectors-{0}.bin"
 
     def __init__(self, verbose=False, dimensions=None):
         self._verbose = verbose
@@ -162,6 +221,10 @@ class ReynirCorpus:
     def dimensions(self):
         return self._dimensions
 
+    @property
+    def vector_store_file(self):
+        return self._VECTOR_STORE_FILE.format(self._dimensions)
+
     def create_dictionary(self):
         """ Iterate through the article database
             and create a fresh Gensim dictionary """
@@ -238,6 +301,150 @@ class ReynirCorpus:
         )
         self._model_name = "lsi"
 
+    def _tfidf_matrix(self, bow):
+        """ Apply the TF-IDF model to a sparse bag-of-words matrix with one
+            row per document: term counts are weighted by inverse document
+            frequency and each row is normalized to unit length """
+        num_terms = bow.shape[1]
+        idf = np.zeros(num_terms, dtype=bow.dtype)
+        for term_id, weight in self._tfidf.idfs.items():
+            if term_id < num_terms:
+                idf[term_id] = weight
+        tfidf = bow @ sparse.diags(idf)
+        norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+        norms[norms == 0.0] = 1.0
+        return sparse.diags(1.0 / norms) @ tfidf
+
+    @staticmethod
+    def _add_documents(lsi, tfidf):
+        """ Add the documents of a TF-IDF matrix to an LSI model, one chunk
+            of rows at a time to bound the memory used by each update """
+        for start in range(0, tfidf.shape[0], lsi.chunksize):
+            chunk = tfidf[start : start + lsi.chunksize]
+            lsi.add_documents(chunk.T.tocsc())
+
+    def create_model(self, **kwargs):
+        """ Create the dictionary, the TFIDF model and the LSI model in a
+            single pass over the words database table. The corpus is kept
+            in memory as a sparse matrix instead of being serialized to
+            work files between stages. Return the number of documents. """
+        ts = datetime.utcnow()
+        # Bags of words in compressed sparse row form, with term ids
+        # assigned in order of first appearance (as Gensim does)
+        token2id = {}
+        dfs = []
+        cfs = []
+        indptr = array("l", [0])
+        indices = array("l")
+        counts = array("l")
+        for _, bag in WordStream():
+            for w, cnt in sorted(bag.items()):
+                term_id = token2id.get(w)
+                if term_id is None:
+                    term_id = token2id[w] = len(dfs)
+                    dfs.append(0)
+                    cfs.append(0)
+                dfs[term_id] += 1
+                cfs[term_id] += cnt
+                indices.append(term_id)
+                counts.append(cnt)
+            indptr.append(len(indices))
+        num_docs = len(indptr) - 1
+        print("Read {0} documents with {1} words".format(num_docs, len(dfs)))
+        dic = ReynirDictionary()
+        dic.token2id = token2id
+        dic.dfs = dict(enumerate(dfs))
+        dic.cfs = dict(enumerate(cfs))
+        dic.num_docs = num_docs
+        dic.num_pos = sum(cfs)
+        dic.num_nnz = len(indices)
+        tokens = list(token2id)
+        # Drop words that only occur only once or twice in the entire set
+        dic.filter_extremes(no_below=3, keep_n=None)
+        dic.save(self._DICTIONARY_FILE)
+        self._dictionary = dic
+        lsi = models.LsiModel(id2word=dic, num_topics=self._dimensions, **kwargs)
+        # Map the term ids of the corpus to the ids of the filtered dictionary
+        remap = np.array([dic.token2id.get(t, -1) for t in tokens], dtype=np.int64)
+        cols = remap[np.frombuffer(indices, dtype=indices.typecode)]
+        rows = np.repeat(
+            np.arange(num_docs), np.diff(np.frombuffer(indptr, dtype=indptr.typecode))
+        )
+        keep = cols >= 0
+        bow = sparse.csr_matrix(
+            (
+                np.frombuffer(counts, dtype=counts.typecode)[keep],
+                (rows[keep], cols[keep]),
+            ),
+            shape=(num_docs, len(dic)),
+            dtype=lsi.dtype,
+        )
+        del indices, counts, cols, rows
+        self.create_tfidf_model()
+        self._add_documents(lsi, self._tfidf_matrix(bow))
+        lsi.save(self._LSI_MODEL_FILE.format(self._dimensions))
+        self._model = lsi
+        self._model_name = "lsi"
+        self._save_model_info(ts)
+        return num_docs
+
+    def update_model(self):
+        """ Update the LSI model with the articles parsed since it was
+            created or last updated, using the online training of Gensim.
+            The dictionary and the TFIDF model are unchanged, so words that
+            are not already in the dictionary are ignored. Articles that
+            have been reparsed are added again. Return the number of
+            documents added, or None if the model must be rebuilt. """
+        since = self._load_model_info()
+        if since is None:
+            return None
+        ts = datetime.utcnow()
+        if self._dictionary is None:
+            self.load_dictionary()
+        if self._tfidf is None:
+            self.load_tfidf_model()
+        # The model is modified, so it can't be memory-mapped
+        lsi = models.LsiModel.load(self._LSI_MODEL_FILE.format(self._dimensions))
+        token2id = self._dictionary.token2id
+        num_terms = lsi.num_terms
+        rows = []
+        cols = []
+        counts = []
+        num_docs = 0
+        for _, bag in WordStream(since=since):
+            for w, cnt in bag.items():
+                term_id = token2id.get(w)
+                if term_id is not None and term_id < num_terms:
+                    rows.append(num_docs)
+                    cols.append(term_id)
+                    counts.append(cnt)
+            num_docs += 1
+        if num_docs:
+            bow = sparse.csr_matrix(
+                (counts, (rows, cols)), shape=(num_docs, num_terms), dtype=lsi.dtype
+            )
+            self._add_documents(lsi, self._tfidf_matrix(bow))
+            lsi.save(self._LSI_MODEL_FILE.format(self._dimensions))
+        self._model = lsi
+        self._model_name = "lsi"
+        self._save_model_info(ts)
+        return num_docs
+
+    def _save_model_info(self, ts):
+        """ Record the time point up to which articles are in the model """
+        with open(self._MODEL_INFO_FILE.format(self._dimensions), "w") as f:
+            json.dump(dict(timestamp=ts.strftime("%Y-%m-%d %H:%M:%S")), f)
+
+    def _load_model_info(self):
+        """ Return the time point up to which articles are in the model,
+            or None if it is not known """
+        try:
+            with open(self._MODEL_INFO_FILE.format(self._dimensions), "r") as f:
+                info = json.load(f)
+            return datetime.strptime(info["timestamp"], "%Y-%m-%d %H:%M:%S")
+        except (OSError, ValueError, KeyError):
+            return None
+
     def create_lda_model(self, **kwargs):
         """ Create a Latent Dirichlet Allocation (LDA) model from the
             entire words database table """
@@ -428,10 +635,10 @@ class ReynirCorpus:
                     # Sum up the topic vectors of the documents where the term
                     # appears, weighted by the number of times it appears
                     # print("Found stem/cat '{0}'/{1} in {2} documents via words table".format(clean_stem, cat, len(q)))
-                    for tv_json, cnt in q:
+                    for tv_bin, tv_json, cnt in q:
                         # Get the term vector of a single document where the term appears
-                        if tv_json and cnt:
-                            tv = np.array(json.loads(tv_json))
+                        tv = unpack_vector(tv_bin, tv_json)
+                        if tv is not None and len(tv) == self._dimensions and cnt:
                             # Multiply the vector by the number of times the term appears
                             total_cnt += cnt
                             term_vector += tv * cnt
@@ -527,34 +734,252 @@ class ReynirCorpus:
             a = session.query(Article).filter(Article.id == article_id).one_or_none()
             if a is not None:
                 a.indexed = datetime.utcnow()
+                # The JSON format of topic vectors is superseded
+                a.topic_vector = None
                 if article_vector:
-                    # Store a pure list of floats
-                    topic_vector = [t[1] for t in article_vector]
-                    a.topic_vector = json.dumps(topic_vector)
+                    # Store a pure array of floats
+                    a.topic_vector_bin = pack_vector([t[1] for t in article_vector])
                 else:
-                    a.topic_vector = None
+                    a.topic_vector_bin = None
 
-    def assign_topics(self, limit=None, process_all=False, uuid=None):
-        """ Assign topics to all articles that have no such assignment yet """
+    def _topic_matrix(self):
+        """ Return the ids of the topics, a matrix of their unit-length
+            topic vectors (one row per topic) and an array of their
+            similarity thresholds """
+        if self._topics is None:
+            self.load_topics()
+        topic_ids = list(self._topics.keys())
+        matrix = np.zeros((len(topic_ids), self._dimensions))
+        for row, topic_id in enumerate(topic_ids):
+            for ix, f in self._topics[topic_id]["vector"]:
+                matrix[row, ix] = f
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0.0] = 1.0
+        thresholds = np.array([t["threshold"] for t in self._topics.values()])
+        return topic_ids, matrix / norms, thresholds
+
+    def _article_vectors(self, session, article_ids):
+        """ Return a matrix of the LSI topic vectors of the given articles,
+            one row per article. This is equivalent to looking up each
+            article's words in the dictionary and transforming them through
+            the TF-IDF and LSI models, but done for all articles at once
+            with sparse matrix products. Articles without any words in
+            the dictionary get a zero row. """
+        token2id = self._dictionary.token2id
+        u = self._model.projection.u[:, : self._model.num_topics]
+        num_terms = u.shape[0]
+        index = {article_id: row for row, article_id in enumerate(article_ids)}
+        rows = []
+        cols = []
+        counts = []
+        q = session.query(Word.article_id, Word.stem, Word.cat, Word.cnt).filter(
+            Word.article_id.in_(article_ids)
+        )
+        for article_id, stem, cat, cnt in q:
+            term_id = token2id.get(w_from_stem(stem, cat))
+            if term_id is not None and term_id < num_terms:
+                rows.append(index[article_id])
+                cols.append(term_id)
+                counts.append(cnt)
+        # Bag-of-words matrix: duplicate entries are summed
+        bow = sparse.csr_matrix(
+            (counts, (rows, cols)), shape=(len(article_ids), num_terms), dtype=u.dtype
+        )
+        # LSI: projection of the TF-IDF vectors onto the
+        # left singular vectors of the model
+        return np.asarray(self._tfidf_matrix(bow) @ u)
+
+    def assign_batch_topics(self, articles, process_all=False):
+        """ Assign topics and topic vectors to a batch of articles, given as
+            a list of (article_id, heading) tuples, in a single transaction """
+        if self._dictionary is None:
+            self.load_dictionary()
+        if self._tfidf is None:
+            self.load_tfidf_model()
+        if self._model is None:
+            self.load_lsi_model()
+        topic_ids, topic_matrix, thresholds = self._topic_matrix()
+        article_ids = [article_id for article_id, _ in articles]
         with SessionContext(commit=True) as session:
-            # Fetch articles that haven't been indexed (or have been parsed since),
-            # and that have at least one associated Word in the words table.
-            q = session.query(Article.id, Article.heading)
-            if uuid:
-                q = q.filter(Article.id == uuid)
-            elif not process_all:
-                q = q.filter(
-                    (Article.indexed == None) | (Article.indexed < Article.parsed)
+            vectors = self._article_vectors(session, article_ids)
+            norms = np.linalg.norm(vectors, axis=1)
+            # Cosine similarities of all articles to all topics
+            similarities = (vectors / np.maximum(norms, 1.0e-12)[:, None]) @ (
+                topic_matrix.T
+            )
+            now = datetime.utcnow()
+            atopics = []
+            updates = []
+            for row, (article_id, heading) in enumerate(articles):
+                vector = None
+                if topic_ids and norms[row] > 0.0:
+                    vector = pack_vector(vectors[row])
+                    found = np.flatnonzero(similarities[row] >= thresholds)
+                    atopics.extend(
+                        dict(article_id=article_id, topic_id=topic_ids[ix])
+                        for ix in found
+                    )
+                    if len(found) and not process_all:
+                        print(
+                            "Article '{0}':\n   topics {1}".format(
+                                heading,
+                                [
+                                    (self._topics[topic_ids[ix]]["name"],
+                                     float(similarities[row, ix]))
+                                    for ix in found
+                                ],
+                            )
+                        )
+                updates.append(
+                    dict(
+                        id=article_id,
+                        indexed=now,
+                        topic_vector_bin=vector,
+                        topic_vector=None,
+                    )
                 )
-            q = q.join(Word).group_by(Article.id, Article.heading)
+            # Replace the previous topics of the articles (if any)
+            session.execute(
+                ArticleTopic.table()
+                .delete()
+                .where(ArticleTopic.article_id.in_(article_ids))
+            )
+            if atopics:
+                session.execute(ArticleTopic.table().insert(), atopics)
+            session.bulk_update_mappings(Article, updates)
+
+    @staticmethod
+    def article_id_range(part, parts):
+        """ Return the bounds of the part'th of parts disjoint ranges of
+            article UUIDs, with None for an open upper bound """
+        lower = UUID(int=(part << 128) // parts)
+        if part + 1 >= parts:
+            return str(lower), None
+        return str(lower), str(UUID(int=((part + 1) << 128) // parts))
+
+    def assign_topics(
+        self, limit=None, process_all=False, uuid=None, batch_size=0, part=None
+    ):
+        """ Assign topics to all articles that have no such assignment yet,
+            returning the number of articles processed. If batch_size is
+            nonzero, articles are processed in batches of that size.
+            If part is given as a tuple (part, parts), only articles in
+            the corresponding range of article ids are processed, so that
+            several processes can share the work. """
+        if uuid or not batch_size or self._model_name != "lsi":
+            return self._assign_topics_singly(limit, process_all, uuid, part)
+        count = 0
+        last_id = None
+        while limit is None or count < limit:
+            with SessionContext(commit=True) as session:
+                q = self._articles_to_tag(session, process_all, part)
+                if last_id is not None:
+                    q = q.filter(Article.id > last_id)
+                n = batch_size if limit is None else min(batch_size, limit - count)
+                batch = q.order_by(Article.id).limit(n).all()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            self.assign_batch_topics(batch, process_all=process_all)
+            count += len(batch)
+            print("{0} articles tagged".format(count))
+        return count
+
+    def _articles_to_tag(self, session, process_all, part):
+        """ Return a query of the ids and headings of articles that haven't
+            been indexed (or have been parsed since), and that have at least
+            one associated Word in the words table """
+        q = session.query(Article.id, Article.heading)
+        if not process_all:
+            q = q.filter((Article.indexed == None) | (Article.indexed < Article.parsed))
+        if part is not None:
+            lower, upper = self.article_id_range(*part)
+            q = q.filter(Article.id >= lower)
+            if upper is not None:
+                q = q.filter(Article.id < upper)
+        return q.join(Word).group_by(Article.id, Article.heading)
+
+    def _assign_topics_singly(self, limit, process_all, uuid, part):
+        """ Assign topics to articles one at a time """
+        with SessionContext(commit=True) as session:
             if uuid:
-                q = q.all()
-            elif limit is None:
-                q = q.yield_per(2000)
+                q = (
+                    session.query(Article.id, Article.heading)
+                    .filter(Article.id == uuid)
+                    .join(Word)
+                    .group_by(Article.id, Article.heading)
+                    .all()
+                )
             else:
-                q = q[0:limit]
+                q = self._articles_to_tag(session, process_all, part)
+                if limit is None:
+                    q = q.yield_per(2000)
+                else:
+                    q = q[0:limit]
+        count = 0
         for article_id, heading in q:
             self.assign_article_topics(article_id, heading, process_all=process_all)
+            count += 1
+        return count
+
+    def update_vector_store(self):
+        """ Add the topic vectors of articles indexed since the last update
+            to the memory-mapped vector store, creating it if needed, and
+            remove the articles that have since been deleted, hidden or
+            have lost their topic vectors """
+        path = self.vector_store_file
+        try:
+            store = VectorStore(path, writable=True)
+        except BlockingIOError:
+            print("Vector store is being updated by another process")
+            return
+        except (OSError, ValueError):
+            store = None
+        if store is not None and store.dimensions != self._dimensions:
+            store.close()
+            store = None
+        if store is None:
+            print("Creating vector store {0}".format(path))
+            store = VectorStore.create(path, self._dimensions)
+        with store:
+            # All articles indexed before this time point will be in the store
+            ts = datetime.utcnow()
+            count = 0
+            with SessionContext(commit=True, read_only=True) as session:
+                q = session.query(Article).join(Root).filter(Root.visible)
+                if store.timestamp is not None:
+                    q = q.filter(Article.indexed >= store.timestamp)
+                q = q.filter(Article.has_topic_vector).with_entities(
+                    Article.id, Article.topic_vector_bin, Article.topic_vector
+                )
+                ids = []
+                vectors = []
+                for a in q.yield_per(2000):
+                    vec = unpack_vector(a.topic_vector_bin, a.topic_vector)
+                    if vec is not None and len(vec) == self._dimensions:
+                        ids.append(a.id)
+                        vectors.append(vec)
+                    if len(ids) >= 2000:
+                        store.put(ids, vectors)
+                        count += len(ids)
+                        ids, vectors = [], []
+                store.put(ids, vectors)
+                count += len(ids)
+                # Articles are deleted and reinserted with new ids when they
+                # are scraped again, so remove the rows of articles that are
+                # no longer visible with topic vectors
+                live = (
+                    session.query(Article.id)
+                    .join(Root)
+                    .filter(Root.visible)
+                    .filter(Article.has_topic_vector)
+                )
+                removed = store.compact(set(a.id for a in live.yield_per(10000)))
+            store.set_timestamp(ts)
+            print(
+                "Vector store updated with {0} topic vectors, {1} removed, "
+                "{2} in total".format(count, removed, len(store))
+            )
 
 
 def build_model(verbose=False):
@@ -567,17 +992,10 @@ def build_model(verbose=False):
     t0 = time.time()
 
     rc = ReynirCorpus(verbose=verbose)
-    print("Creating dictionary")
-    rc.create_dictionary()
-    print("Creating plain corpus")
-    rc.create_plain_corpus()
-    print("Creating TF-IDF model")
-    rc.create_tfidf_model()
-    print("Creating TF-IDF corpus")
-    rc.create_tfidf_corpus()
+    print("Creating dictionary, TF-IDF model and LSI model")
+    num_docs = rc.create_model()
+    print("Model created from {0} documents".format(num_docs))
     # rc.create_lda_model(passes = 15)
-    print("Creating LSI model")
-    rc.create_lsi_model()
 
     t1 = time.time()
 
@@ -587,6 +1005,30 @@ def build_model(verbose=False):
     print("Time: {0}\n".format(ts))
 
 
+def update_model(verbose=False):
+    """ Update the model with articles parsed since it was built """
+
+    print("------ Greynir starting model update -------")
+    ts = "{0}".format(datetime.utcnow())[0:19]
+    print("Time: {0}".format(ts))
+
+    t0 = time.time()
+
+    rc = ReynirCorpus(verbose=verbose)
+    num_docs = rc.update_model()
+    if num_docs is None:
+        print("The model has no build time stamp: rebuild it with 'model'")
+        return
+
+    t1 = time.time()
+
+    print("\n------ Model update completed -------")
+    print("{0} documents added".format(num_docs))
+    print("Total time: {0:.2f} seconds".format(t1 - t0))
+    ts = "{0}".format(datetime.utcnow())[0:19]
+    print("Time: {0}\n".format(ts))
+
+
 def calculate_topics(verbose=False):
     """ Recalculate topic vectors from keywords """
 
@@ -597,7 +1039,18 @@ def calculate_topics(verbose=False):
     print("------ Greynir recalculation complete -------")
 
 
-def tag_articles(limit, verbose=False, process_all=False, uuid=None):
+def _tag_part(args):
+    """ Tag the articles in one part of the range of article ids,
+        in a worker process """
+    limit, verbose, process_all, batch_size, part = args
+    rc = ReynirCorpus(verbose=verbose)
+    rc.load_lsi_model()
+    return rc.assign_topics(limit, process_all, batch_size=batch_size, part=part)
+
+
+def tag_articles(
+    limit, verbose=False, process_all=False, uuid=None, batch_size=0, processes=1
+):
     """ Tag all untagged articles or articles that
         have been parsed since they were tagged """
 
@@ -608,23 +1061,94 @@ def tag_articles(limit, verbose=False, process_all=False, uuid=None):
         print("Processing all articles")
     elif limit:
         print("Limit: {0} articles".format(limit))
+    if batch_size and not uuid:
+        print("Batch size: {0}, processes: {1}".format(batch_size, processes))
     ts = "{0}".format(datetime.utcnow())[0:19]
     print("Time: {0}".format(ts))
 
     t0 = time.time()
 
+    # Make sure that the topic_vector_bin column exists
+    upgrade_tables(SessionContext.db)
     rc = ReynirCorpus(verbose=verbose)
-    rc.load_lsi_model()
-    rc.assign_topics(limit, process_all, uuid)
+    if processes > 1 and not uuid:
+        # Split the article ids into disjoint ranges, one per process,
+        # dividing the limit (if any) between them
+        part_limit = None if limit is None else -(-limit // processes)
+        # Don't share pooled database connections with the worker processes
+        SessionContext.dispose()
+        with Pool(processes) as pool:
+            count = sum(
+                pool.imap_unordered(
+                    _tag_part,
+                    [
+                        (
+                            part_limit,
+                            verbose,
+                            process_all,
+                            batch_size,
+                            (part, processes),
+                        )
+                        for part in range(processes)
+                    ],
+                )
+            )
+    else:
+        rc.load_lsi_model()
+        count = rc.assign_topics(limit, process_all, uuid, batch_size=batch_size)
+    rc.update_vector_store()
 
     t1 = time.time()
 
     print("\n------ Tagging completed -------")
+    print("{0} articles tagged".format(count))
     print("Total time: {0:.2f} seconds".format(t1 - t0))
     ts = "{0}".format(datetime.utcnow())[0:19]
     print("Time: {0}\n".format(ts))
 
 
+def pack_vectors(batch_size=2000):
+    """ Convert article topic vectors from the JSON format of the topic_vector
+        column to the binary format of the topic_vector_bin column, in batches
+        that are each committed separately """
+
+    print("------ Greynir converting topic vectors -------")
+    upgrade_tables(SessionContext.db)
+    t0 = time.time()
+    last_id = None
+    count = failed = 0
+    while True:
+        with SessionContext(commit=True) as session:
+            q = session.query(Article.id, Article.topic_vector).filter(
+                Article.topic_vector != None
+            )
+            if last_id is not None:
+                q = q.filter(Article.id > last_id)
+            batch = q.order_by(Article.id).limit(batch_size).all()
+            if not batch:
+                break
+            mappings = []
+            for article_id, tv_json in batch:
+                last_id = article_id
+                vec = unpack_vector(None, tv_json)
+                if len(vec) == 0:
+                    print("Faulty topic vector for article {0}".format(article_id))
+                    failed += 1
+                    continue
+                mappings.append(
+                    dict(
+                        id=article_id,
+                        topic_vector_bin=pack_vector(vec),
+                        topic_vector=None,
+                    )
+                )
+            session.bulk_update_mappings(Article, mappings)
+            count += len(mappings)
+        print("{0} topic vectors converted, {1} faulty".format(count, failed))
+    print("\n------ Conversion completed -------")
+    print("Total time: {0:.2f} seconds".format(time.time() - t0))
+
+
 def notify_similarity_server():
     """ Notify the similarity server - if running - that article tags have been updated """
     try:
@@ -654,11 +1178,15 @@ __doc__ = """
         -l N, --limit=N  : Limit processing to N articles
         -a, --all        : Process all articles
         -v, --verbose    : Show diagnostics while processing
+        -b N, --batch=N  : Tag articles in batches of N (default 1000, 0 = singly)
+        -p N, --processes=N : Tag articles in N parallel processes
 
     Commands:
         tag [uuid] : tag any untagged articles (or the article with the given uuid)
         topics     : recalculate topic vectors from keywords
         model      : rebuild dictionary and model from parsed articles
+        update     : update the model with articles parsed since it was built
+        pack       : convert article topic vectors from JSON to binary format
 
 """
 
@@ -670,7 +1198,9 @@ def _main(argv=None):
     try:
         try:
             opts, args = getopt.getopt(
-                argv[1:], "hl:van", ["help", "limit=", "verbose", "all", "notify"]
+                argv[1:],
+                "hl:vanb:p:",
+                ["help", "limit=", "verbose", "all", "notify", "batch=", "processes="],
             )
         except getopt.error as msg:
             raise Usage(msg)
@@ -680,6 +1210,8 @@ def _main(argv=None):
         verbose = False
         process_all = False
         notify = False
+        batch_size = 1000
+        processes = 1
 
         # Process options
         for o, a in opts:
@@ -699,6 +1231,16 @@ def _main(argv=None):
                 process_all = True
             elif o in ("-n", "--notify"):
                 notify = True
+            elif o in ("-b", "--batch"):
+                try:
+                    batch_size = max(0, int(a))
+                except ValueError:
+                    raise Usage("Batch size must be a number")
+            elif o in ("-p", "--processes"):
+                try:
+                    processes = max(1, int(a))
+                except ValueError:
+                    raise Usage("Number of processes must be a number")
 
         # if process_all and limit_specified:
         #    raise Usage("--all and --limit cannot be used together")
@@ -723,8 +1265,15 @@ def _main(argv=None):
                     raise Usage("Conflict between uuid argument and --limit option")
             if process_all and not limit_specified:
                 limit = None
+            if processes > 1 and not batch_size:
+                raise Usage("--processes requires tagging in batches")
             tag_articles(
-                limit=limit, verbose=verbose, process_all=process_all, uuid=uuid
+                limit=limit,
+                verbose=verbose,
+                process_all=process_all,
+                uuid=uuid,
+                batch_size=batch_size,
+                processes=processes,
             )
             if notify:
                 # Inform the similarity server that we have new article tags
@@ -739,6 +1288,16 @@ def _main(argv=None):
             if la > 1:
                 raise Usage("Too many arguments")
             build_model(verbose=verbose)
+        elif arg == "update":
+            # Update model with new articles
+            if la > 1:
+                raise Usage("Too many arguments")
+            update_model(verbose=verbose)
+        elif arg == "pack":
+            # Convert topic vectors to the binary format
+            if la > 1:
+                raise Usage("Too many arguments")
+            pack_vectors()
         else:
             raise Usage("Unknown command: '{0}'".format(arg))
 
@@ -242,6 +242,15 @@ class Settings:
     except ValueError:
         raise ConfigError("Invalid environment variable value: SIMSERVER_PORT = {0}".format(SIMSERVER_PORT))
 
+    # Approximate nearest neighbour index in the similarity server
+    ANN_INDEX = False
+    # Number of clusters in the index (0 = square root of the number of articles)
+    ANN_LISTS = 0
+    # Number of clusters searched per query
+    ANN_PROBES = 16
+    # Below this number of articles, similarity queries are answered exactly
+    ANN_MIN_ARTICLES = 20000
+
     # Configuration settings from the Greynir.conf file
 
     @staticmethod
@@ -271,6 +280,14 @@ class Settings:
                 Settings.SIMSERVER_PORT = int(val)
             elif par == 'debug':
                 Settings.DEBUG = bool(val)
+            elif par == 'ann_index':
+                Settings.ANN_INDEX = bool(val)
+            elif par == 'ann_lists':
+                Settings.ANN_LISTS = int(val)
+            elif par == 'ann_probes':
+                Settings.ANN_PROBES = int(val)
+            elif par == 'ann_min_articles':
+                Settings.ANN_MIN_ARTICLES = int(val)
             else:
                 raise ConfigError("Unknown configuration parameter '{0}'".format(par))
         except ValueError:
@@ -23,7 +23,13 @@
     This module implements a similarity query server. The server can
     answer queries about articles that are similar to a given article
     or topic vector. This assumes that articles already have topic vectors
-    that are stored in the topic_vector column in the articles database table.
+    that are stored in the topic_vector_bin (or, for older articles, the
+    topic_vector) column in the articles database table.
+
+    At startup, the server maps the vector store file that builder.py
+    maintains (models/vectors-200.bin) and only loads the topic vectors
+    of articles indexed after its last update from the database. If
+    the file is missing, all topic vectors are loaded from the database.
 
     The similarity server by default accepts TCP connections on port 5001.
     For security, this port should be closed from outside access via iptables or
@@ -62,14 +68,8 @@
 
 """
 
-import json
 import time
-import math
-import heapq
 import sys
-import operator
-
-import numpy as np
 
 from threading import Thread, Lock
 from datetime import datetime
@@ -80,6 +80,7 @@ from settings import Settings, ConfigError
 from db import SessionContext, desc
 from db.models import Article, Root
 from builder import ReynirCorpus
+from topicindex import TopicMatrix, IVFIndex, VectorStore, unpack_vector
 
 
 class InternalError(RuntimeError):
@@ -91,44 +92,130 @@ class InternalError(RuntimeError):
 
 class SimilarityServer:
 
-    """ A class that manages an in-memory dictionary of articles
+    """ A class that manages an in-memory matrix of articles
         and their topic vectors, and allows similarity queries of that
-        dictionary. The dictionary is refreshed upon request from the
+        matrix. The matrix is refreshed upon request from the
         articles database table.
     """
 
+    # File containing the approximate nearest neighbour index
+    _ANN_INDEX_FILE = "./models/ann-{0}.npz"
+
     def __init__(self):
         # Do an initial load of all article topic vectors
         self._lock = Lock()
         self._timestamp = None
-        self._atopics = {}
+        # The TopicMatrix of article topic vectors, or None until it
+        # has been loaded from the database by _load_topics()
+        self._atopics = None
+        # Optional approximate nearest neighbour index over self._atopics
+        self._ann = None
         self._corpus = None
 
-    def _load_topics(self):
-        """ Load all article topics into the self._atopics dictionary """
-        self._atopics = {}
+    def _topic_vectors(self, q, batch_size):
+        """ Return the ids and topic vectors of the articles in a query,
+            skipping articles with missing or faulty topic vectors """
+        ids = []
+        vectors = []
+        for a in q.yield_per(batch_size):
+            vec = unpack_vector(a.topic_vector_bin, a.topic_vector)
+            if vec is not None:
+                if len(vec) == self._corpus.dimensions:
+                    ids.append(a.id)
+                    vectors.append(vec)
+                else:
+                    print("Warning: faulty topic vector for article {0}".format(a.id))
+        return ids, vectors
+
+    def _train_index(self):
+        """ Train the approximate nearest neighbour index and save it """
+        t0 = time.time()
+        self._ann.train(n_lists=Settings.ANN_LISTS)
+        if self._ann.trained:
+            self._ann.save(self._ANN_INDEX_FILE.format(self._corpus.dimensions))
+        print(
+            "Trained index of {0} clusters in {1:.2f} seconds".format(
+                self._ann.num_lists, time.time() - t0
+            )
+        )
+
+    def _build_index(self, retrain=False):
+        """ Set up the approximate nearest neighbour index, if enabled,
+            loading it from disk unless asked to retrain it """
+        if not Settings.ANN_INDEX:
+            self._ann = None
+            return
+        self._ann = IVFIndex(
+            self._atopics,
+            n_probes=Settings.ANN_PROBES,
+            min_size=Settings.ANN_MIN_ARTICLES,
+        )
+        t0 = time.time()
+        if (
+            not retrain
+            and self._ann.load(self._ANN_INDEX_FILE.format(self._corpus.dimensions))
+            and len(self._atopics) <= 2 * self._ann.trained_size
+        ):
+            print(
+                "Loaded index of {0} clusters in {1:.2f} seconds".format(
+                    self._ann.num_lists, time.time() - t0
+                )
+            )
+        else:
+            self._train_index()
+
+    def _open_store(self):
+        """ Open the vector store maintained by builder.py, or return None
+            if it is missing or doesn't match the corpus """
+        try:
+            store = VectorStore(self._corpus.vector_store_file)
+        except (OSError, ValueError) as e:
+            print("Vector store not available: {0}".format(e))
+            return None
+        if store.dimensions != self._corpus.dimensions:
+            print("Vector store has the wrong number of dimensions")
+            store.close()
+            return None
+        return store
+
+    def _load_topics(self, retrain=False, use_store=True):
+        """ Load all article topics into the self._atopics matrix, mapping
+            the vector store if available and loading only the articles
+            indexed after it was last updated from the database """
+        store = self._open_store() if use_store else None
         with SessionContext(commit=True, read_only=True) as session:
             print("Starting load of all article topic vectors")
             t0 = time.time()
             # Do the next refresh from this time point
             self._timestamp = datetime.utcnow()
-            q = (
-                session.query(Article)
-                .join(Root)
-                .filter(Root.visible)
-                .with_entities(Article.id, Article.topic_vector)
+            q = session.query(Article).join(Root).filter(Root.visible)
+            if store is None:
+                self._atopics = TopicMatrix(self._corpus.dimensions)
+            else:
+                # Leave out articles that have been deleted or hidden,
+                # or have lost their topic vectors, since the store
+                # was last updated
+                live = (
+                    session.query(Article.id)
+                    .join(Root)
+                    .filter(Root.visible)
+                    .filter(Article.has_topic_vector)
+                )
+                keep = set(a.id for a in live.yield_per(10000))
+                # The mapping remains valid after the store is closed
+                with store:
+                    self._atopics = TopicMatrix.from_store(store, keep=keep)
+                    if store.timestamp is not None:
+                        q = q.filter(Article.indexed >= store.timestamp)
+                print(
+                    "Mapped {0} topic vectors from the vector store".format(
+                        len(self._atopics)
+                    )
+                )
+            q = q.with_entities(
+                Article.id, Article.topic_vector_bin, Article.topic_vector
             )
-
-            for a in q.yield_per(2000):
-                if a.topic_vector:
-                    # Load topic vector in to a numpy array
-                    vec = json.loads(a.topic_vector)
-                    if isinstance(vec, list) and len(vec) == self._corpus.dimensions:
-                        self._atopics[a.id] = np.array(vec)
-                    else:
-                        print(
-                            "Warning: faulty topic vector for article {0}".format(a.id)
-                        )
+            self._atopics.update(*self._topic_vectors(q, 2000))
 
             t1 = time.time()
             print(
@@ -136,20 +223,24 @@ class SimilarityServer:
                     len(self._atopics), t1 - t0
                 )
             )
+        self._build_index(retrain)
 
     def article_topic(self, article_id):
         """ Return the topic vector of the article having the given uuid,
-            or None if no such article exists """
-        return self._atopics.get(article_id)
+            or None if no such article exists. The vector is normalized
+            to unit length, as stored in the matrix. """
+        if self._atopics is None:
+            return None
+        return self._atopics.vector(article_id)
 
     def reload_topics(self):
         """ Reload all article topic vectors from the database """
         with self._lock:
             # Can't serve queries while we're doing this
-            self._load_topics()
+            self._load_topics(retrain=True, use_store=False)
 
     def refresh_topics(self):
-        """ Load any new article topics into the _atopics dict """
+        """ Load any new article topics into the _atopics matrix """
         with self._lock:
             with SessionContext(commit=True, read_only=True) as session:
                 # Do the next refresh from this time point
@@ -159,68 +250,49 @@ class SimilarityServer:
                     .join(Root)
                     .filter(Root.visible)
                     .filter(Article.indexed >= self._timestamp)
-                    .with_entities(Article.id, Article.topic_vector)
+                    .with_entities(
+                        Article.id, Article.topic_vector_bin, Article.topic_vector
+                    )
                 )
                 self._timestamp = ts
-                count = 0
-                for a in q.yield_per(100):
-                    if a.topic_vector:
-                        # Load topic vector in to a numpy array
-                        vec = json.loads(a.topic_vector)
-                        if (
-                            isinstance(vec, list)
-                            and len(vec) == self._corpus.dimensions
-                        ):
-                            self._atopics[a.id] = np.array(vec)
-                            count += 1
-                        else:
-                            print(
-                                "Warning: faulty topic vector for article {0}".format(
-                                    a.id
-                                )
-                            )
-                print(
-                    "Completed refresh_topics, {0} article vectors added".format(count)
-                )
-
-    def _iter_similarities(self, vector):
-        """ Generator of (id, similarity) tuples for all articles to the given vector """
-        base = np.array(vector)
-        norm_base = np.dot(base, base)  # This is faster than linalg.norm()
-        if norm_base < 1.0e-6:
-            # No data to search by
-            return
-
-        def cosine_similarity(v):
-            """ Compute cosine similarity of v1 to v2: (v1 dot v2)/(|v1|*|v2|) """
-            norm_v = np.dot(v, v)  # This is faster than linalg.norm()
-            dot_product = np.dot(v, base)
-            return float(dot_product / math.sqrt(norm_v * norm_base))
-
-        for article_id, topic_vector in self._atopics.items():
-            try:
-                cs = cosine_similarity(topic_vector)
-                yield article_id, cs
-            except Exception as ex:
-                # If there is an error in the calculations, probably
-                # due to a faulty topic vector, simply don't include
-                # the article
+                ids, vectors = self._topic_vectors(q, 100)
+                rows = self._atopics.update(ids, vectors)
+                if self._ann is not None:
+                    if len(self._atopics) > 2 * self._ann.trained_size:
+                        # The collection has outgrown the clusters
+                        self._train_index()
+                    else:
+                        self._ann.update(rows)
                 print(
-                    "Error in cosine similarity for article {0}: {1}".format(
-                        article_id, ex
+                    "Completed refresh_topics, {0} article vectors added".format(
+                        len(ids)
                     )
                 )
-                pass
 
     def find_similar(self, n, vector):
         """ Return the N articles with the highest similarity score to the given vector,
             as a list of tuples (article_uuid, similarity) """
-        if vector is None or len(vector) == 0 or all(e == 0.0 for e in vector):
-            return []
-        with self._lock:
-            return heapq.nlargest(
-                n, self._iter_similarities(vector), key=operator.itemgetter(1)
-            )
+        return self.find_similar_batch(n, [vector])[0]
+
+    def find_similar_batch(self, n, vectors):
+        """ Return, for each of the given vectors, the N articles with the
+            highest similarity score to it, as a list of lists of tuples
+            (article_uuid, similarity) """
+        result = [[] for _ in vectors]
+        # Only query by nonzero vectors of the right dimensions
+        dimensions = self._corpus.dimensions
+        valid = [
+            ix
+            for ix, v in enumerate(vectors)
+            if v is not None and len(v) == dimensions and any(e != 0.0 for e in v)
+        ]
+        if valid and self._atopics is not None:
+            with self._lock:
+                index = self._atopics if self._ann is None else self._ann
+                top = index.top_n(n, [vectors[ix] for ix in valid])
+            for ix, articles in zip(valid, top):
+                result[ix] = articles
+        return result
 
     def run(self, host, port):
         """ Run a similarity server serving requests that come in at the given port """
@@ -322,6 +394,17 @@ class SimilarityServer:
                             topic = request["topic"]
                             if not isinstance(topic, list):
                                 raise ClientError(request)
+                        elif "topics" in request:
+                            # Batch query: compare similarity to each of the
+                            # given topic vectors, returning a list of results
+                            topics = request["topics"]
+                            if not isinstance(topics, list) or not all(
+                                isinstance(t, list) for t in topics
+                            ):
+                                raise ClientError(request)
+                            result["articles"] = self.find_similar_batch(n, topics)
+                            conn.send(result)
+                            continue
                         else:
                             raise ClientError(request)
                         # Launch the command and send the reply back to the client
@@ -0,0 +1,642 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Topic vector index
+
+    Copyright (C) 2021 Miðeind ehf.
+
+       This program is free software: you can redistribute it and/or modify
+       it under the terms of the GNU General Public License as published by
+       the Free Software Foundation, either version 3 of the License, or
+       (at your option) any later version.
+       This program is distributed in the hope that it will be useful,
+       but WITHOUT ANY WARRANTY; without even the implied warranty of
+       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+       GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see http://www.gnu.org/licenses/.
+
+
+    This module contains the in-memory store of article topic vectors
+    used by the similarity server (simserver.py), and an optional
+    approximate nearest neighbour index over it.
+
+    Article topic vectors are stored in the database as little-endian
+    float32 arrays in the topic_vector_bin column of the articles table,
+    or, for articles tagged before that column was added, as JSON text
+    in the topic_vector column. pack_vector() and unpack_vector()
+    convert between these representations and numpy arrays.
+
+    TopicMatrix answers similarity queries exactly, by computing the
+    cosine similarity of the query to every article in one matrix product.
+
+    IVFIndex is an inverted file index: the articles are partitioned
+    into clusters by spherical k-means over their topic vectors, and a
+    query is only compared with the articles in the few clusters whose
+    centroids are most similar to it. The search time thus grows with
+    the square root of the number of articles rather than linearly,
+    at the cost of occasionally missing a close match that falls into
+    a cluster that isn't probed. The centroids and the cluster of each
+    article are persisted to disk, so that the index doesn't need to be
+    retrained or the articles reassigned on server restart.
+
+    VectorStore is a memory-mapped file of article topic vectors,
+    maintained by builder.py as it assigns topic vectors to articles.
+    The similarity server maps it instead of loading every vector from
+    the database at startup, and any number of processes can share it
+    through the operating system's page cache. The file layout is:
+
+        header:     magic, version, dimensions, capacity, row count,
+                    and a time stamp: all articles indexed before it
+                    are in the file (64 bytes)
+        id index:   article UUID of each row, as 36 ASCII bytes
+        matrix:     unit-length float32 topic vector of each row
+
+    The id index and matrix have room for capacity rows. When the file
+    is full, it is rewritten with twice the capacity. A row is written
+    before the row count in the header is increased, so readers always
+    see complete rows.
+
+"""
+
+import os
+import json
+import math
+import fcntl
+import struct
+from datetime import datetime, timedelta
+
+import numpy as np
+
+
+# Type of the elements of topic vectors in the topic_vector_bin column
+VECTOR_DTYPE = np.dtype("<f4")
+
+
+def pack_vector(vector):
+    """ Return the binary representation of a topic vector """
+    return np.asarray(vector, dtype=VECTOR_DTYPE).tobytes()
+
+
+def unpack_vector(data, text=None):
+    """ Return a topic vector as a float32 array, from its binary
+        representation or, if that is missing, its JSON representation.
+        Returns None if neither is present, and an empty array if the
+        JSON doesn't represent a vector. """
+    if data:
+        return np.frombuffer(data, dtype=VECTOR_DTYPE)
+    if not text:
+        return None
+    try:
+        vector = np.array(json.loads(text), dtype=np.float32)
+    except (TypeError, ValueError):
+        return np.empty(0, dtype=np.float32)
+    return vector if vector.ndim == 1 else np.empty(0, dtype=np.float32)
+
+
+def _top_n(n, ids, sims, rows=None):
+    """ Return the n (id, similarity) tuples with the highest similarities,
+        in descending order. If rows is given, sims[i] is the similarity
+        of the article in row rows[i]. """
+    if n < len(sims):
+        top = np.argpartition(-sims, n - 1)[:n]
+    else:
+        top = np.arange(len(sims))
+    top = top[np.argsort(-sims[top], kind="stable")]
+    if rows is None:
+        return [(ids[i], float(sims[i])) for i in top]
+    return [(ids[rows[i]], float(sims[i])) for i in top]
+
+
+class TopicMatrix:
+
+    """ A contiguous float32 matrix of unit-length article topic vectors,
+        one row per article, with the corresponding article ids. Cosine
+        similarities to a batch of query vectors are computed with a single
+        matrix product. The matrix grows in place (with spare capacity)
+        when articles are added, so refreshes don't rebuild it. """
+
+    # Minimum number of rows to allocate
+    _MIN_CAPACITY = 1024
+
+    def __init__(self, dimensions):
+        self._dimensions = dimensions
+        self._matrix = np.zeros((0, dimensions), dtype=np.float32)
+        self._count = 0
+        # Article id of each row, and row of each article id
+        self._ids = []
+        self._rows = {}
+
+    @classmethod
+    def from_store(cls, store, keep=None):
+        """ Create a matrix backed by a copy-on-write mapping of a
+            VectorStore, so that the vectors are shared with other
+            processes until they are modified. If keep is given, only
+            the articles whose ids are in it are included; if that
+            excludes any rows, the remaining ones are copied. """
+        m = cls(store.dimensions)
+        ids = store.ids()
+        matrix = store.matrix(copy_on_write=True)
+        if keep is not None:
+            rows = [row for row, article_id in enumerate(ids) if article_id in keep]
+            if len(rows) < len(ids):
+                ids = [ids[row] for row in rows]
+                matrix = np.array(matrix[rows], dtype=np.float32)
+        m._matrix = matrix
+        m._ids = ids
+        m._rows = {article_id: row for row, article_id in enumerate(ids)}
+        m._count = len(ids)
+        return m
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def dimensions(self):
+        return self._dimensions
+
+    @staticmethod
+    def normalize(vectors):
+        """ Return a float32 copy of a 2D array of vectors, scaled to unit
+            length. Zero vectors are left as they are. """
+        m = np.array(vectors, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms < 1.0e-6] = 1.0
+        m /= norms
+        return m
+
+    def _reserve(self, count):
+        """ Make room for at least count rows, doubling the capacity
+            as needed so that repeated additions are amortized """
+        capacity = self._matrix.shape[0]
+        if count <= capacity:
+            return
+        capacity = max(count, 2 * capacity, self._MIN_CAPACITY)
+        m = np.zeros((capacity, self._dimensions), dtype=np.float32)
+        m[: self._count] = self._matrix[: self._count]
+        self._matrix = m
+
+    def update(self, ids, vectors):
+        """ Add or replace the topic vectors of the given articles,
+            returning an array of the rows that were modified """
+        rows = np.empty(len(ids), dtype=np.int64)
+        if not ids:
+            return rows
+        normalized = self.normalize(vectors)
+        for ix, article_id in enumerate(ids):
+            row = self._rows.get(article_id)
+            if row is None:
+                row = self._rows[article_id] = len(self._ids)
+                self._ids.append(article_id)
+            rows[ix] = row
+        self._reserve(len(self._ids))
+        self._matrix[rows] = normalized
+        self._count = len(self._ids)
+        return rows
+
+    def vector(self, article_id):
+        """ Return the (unit length) topic vector of an article, or None """
+        row = self._rows.get(article_id)
+        return None if row is None else self._matrix[row].copy()
+
+    @property
+    def vectors(self):
+        """ The populated part of the matrix, as a view """
+        return self._matrix[: self._count]
+
+    @property
+    def ids(self):
+        """ The article ids of the rows of the matrix """
+        return self._ids
+
+    def top_n(self, n, queries):
+        """ Return, for each row in the 2D array of queries, a list of the
+            n (article_id, similarity) tuples with the highest cosine
+            similarity to it, in descending order of similarity """
+        q = self.normalize(queries)
+        if n <= 0 or self._count == 0:
+            return [[] for _ in range(len(q))]
+        # Similarities of all articles to all queries: count x len(q)
+        sims = self.vectors @ q.T
+        return [_top_n(n, self._ids, sims[:, col]) for col in range(len(q))]
+
+
+class IVFIndex:
+
+    """ An inverted file index over the rows of a TopicMatrix, for
+        approximate nearest neighbour queries. The index is kept up to
+        date by calling update() with the rows modified in the matrix. """
+
+    # Number of rows for which similarities to the centroids
+    # are computed at a time, to limit memory use
+    _CHUNK = 8192
+
+    def __init__(self, matrix, n_probes=16, min_size=20000):
+        self._matrix = matrix
+        # Number of clusters to search for each query
+        self._n_probes = n_probes
+        # Below this number of articles, queries are answered exactly
+        self._min_size = min_size
+        # Cluster centroids, one unit-length row per cluster
+        self._centroids = None
+        # Number of articles in the matrix when the index was trained
+        self._trained_size = 0
+        # Cluster of each matrix row
+        self._assign = np.zeros(0, dtype=np.int32)
+        # Matrix rows grouped by cluster, and the start of each cluster in it.
+        # These are computed lazily after updates.
+        self._order = None
+        self._bounds = None
+
+    @property
+    def trained(self):
+        return self._centroids is not None
+
+    @property
+    def trained_size(self):
+        return self._trained_size
+
+    @property
+    def num_lists(self):
+        return 0 if self._centroids is None else len(self._centroids)
+
+    def _nearest(self, vectors):
+        """ Return the nearest centroid of each of the given vectors """
+        result = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), self._CHUNK):
+            chunk = vectors[start : start + self._CHUNK] @ self._centroids.T
+            result[start : start + self._CHUNK] = np.argmax(chunk, axis=1)
+        return result
+
+    def train(self, n_lists=0, iterations=10, sample_size=100000, seed=0):
+        """ Compute the cluster centroids with spherical k-means on a sample
+            of the articles, and assign all articles to clusters. If n_lists
+            is 0, the number of clusters is the square root of the number
+            of articles. """
+        vectors = self._matrix.vectors
+        count = len(vectors)
+        if not count:
+            return
+        if not n_lists:
+            n_lists = int(math.sqrt(count))
+        n_lists = max(1, min(n_lists, count))
+        rng = np.random.default_rng(seed)
+        if count > sample_size:
+            sample = vectors[rng.choice(count, sample_size, replace=False)]
+        else:
+            sample = vectors
+        self._centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = self._nearest(sample)
+            centroids = np.zeros_like(self._centroids)
+            np.add.at(centroids, assign, sample)
+            # Re-seed empty clusters with random sample vectors
+            empty = np.flatnonzero(np.bincount(assign, minlength=n_lists) == 0)
+            centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+            self._centroids = TopicMatrix.normalize(centroids)
+        self._trained_size = count
+        self._assign = self._nearest(vectors)
+        self._order = None
+
+    def update(self, rows):
+        """ Assign modified or added matrix rows to clusters """
+        if self._centroids is None or not len(rows):
+            return
+        count = len(self._matrix)
+        if count > len(self._assign):
+            assign = np.zeros(count, dtype=np.int32)
+            assign[: len(self._assign)] = self._assign
+            self._assign = assign
+        self._assign[rows] = self._nearest(self._matrix.vectors[rows])
+        self._order = None
+
+    def _lists(self):
+        """ Return the matrix rows grouped by cluster,
+            and the start of each cluster within them """
+        if self._order is None:
+            self._order = np.argsort(self._assign, kind="stable")
+            self._bounds = np.searchsorted(
+                self._assign[self._order], np.arange(len(self._centroids) + 1)
+            )
+        return self._order, self._bounds
+
+    def top_n(self, n, queries, n_probes=None):
+        """ Return, for each row in the 2D array of queries, a list of the
+            n (article_id, similarity) tuples with the highest cosine
+            similarity to it among the articles in the nearest clusters,
+            in descending order of similarity. Falls back to an exact
+            search if the index is not trained or the matrix is small. """
+        matrix = self._matrix
+        if (
+            self._centroids is None
+            or len(matrix) < self._min_size
+            or len(self._assign) != len(matrix)
+        ):
+            return matrix.top_n(n, queries)
+        q = TopicMatrix.normalize(queries)
+        if n <= 0:
+            return [[] for _ in range(len(q))]
+        n_probes = min(n_probes or self._n_probes, len(self._centroids))
+        order, bounds = self._lists()
+        vectors = matrix.vectors
+        csims = q @ self._centroids.T
+        result = []
+        for ix in range(len(q)):
+            probes = np.argpartition(-csims[ix], n_probes - 1)[:n_probes]
+            rows = np.concatenate([order[bounds[c] : bounds[c + 1]] for c in probes])
+            if len(rows) < n:
+                # Too few candidates: search exhaustively
+                result.extend(matrix.top_n(n, q[ix : ix + 1]))
+                continue
+            sims = vectors[rows] @ q[ix]
+            result.append(_top_n(n, matrix.ids, sims, rows))
+        return result
+
+    def save(self, path):
+        """ Save the centroids and the cluster assignments of the articles,
+            by article id, to a file """
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                centroids=self._centroids,
+                trained_size=self._trained_size,
+                ids=np.array(self._matrix.ids[: len(self._assign)]),
+                assign=self._assign,
+            )
+        os.replace(tmp, path)
+
+    def load(self, path):
+        """ Load centroids and cluster assignments from a file. Articles in
+            the matrix that are not in the file are assigned to clusters.
+            Returns False if the file is missing or doesn't match the
+            dimensions of the matrix. """
+        try:
+            with np.load(path) as f:
+                centroids = f["centroids"]
+                trained_size = int(f["trained_size"])
+                ids = f["ids"]
+                assign = f["assign"]
+        except (OSError, KeyError, ValueError):
+            return False
+        if (
+            centroids.ndim != 2
+            or centroids.shape[1] != self._matrix.dimensions
+            or len(ids) != len(assign)
+            or (len(assign) and assign.max() >= len(centroids))
+        ):
+            return False
+        self._centroids = centroids.astype(np.float32)
+        self._trained_size = trained_size
+        matrix_ids = self._matrix.ids
+        if len(ids) <= len(matrix_ids) and np.array_equal(
+            ids, matrix_ids[: len(ids)]
+        ):
+            # The usual case: the matrix rows are in the same order as when
+            # the index was saved, possibly with new articles at the end
+            self._assign = np.full(len(matrix_ids), -1, dtype=np.int32)
+            self._assign[: len(ids)] = assign
+        else:
+            # Map the saved assignments to the matrix rows by article id
+            saved = dict(zip(ids.tolist(), assign.tolist()))
+            self._assign = np.array(
+                [saved.get(article_id, -1) for article_id in matrix_ids],
+                dtype=np.int32,
+            )
+        # Assign articles that weren't in the index when it was saved
+        unknown = np.flatnonzero(self._assign < 0)
+        if len(unknown):
+            self._assign[unknown] = self._nearest(self._matrix.vectors[unknown])
+        self._order = None
+        return True
+
+
+class VectorStore:
+
+    """ A memory-mapped file of article ids and topic vectors """
+
+    MAGIC = b"GnVS"
+    VERSION = 1
+    # Magic, version, dimensions, capacity, count, time stamp
+    _HEADER = struct.Struct("<4sIIQQd")
+    _HEADER_SIZE = 64
+    # Offset of the row count within the header
+    _COUNT_OFFSET = 20
+    ID_SIZE = 36
+    _EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, path, writable=False):
+        """ Open an existing store. A writable store holds an exclusive
+            lock on the file, and raises BlockingIOError if another
+            process is writing to it. """
+        self._path = path
+        self._writable = writable
+        self._file = open(path, "r+b" if writable else "rb")
+        if writable:
+            try:
+                fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._file.close()
+                raise BlockingIOError("Vector store {0} is locked".format(path))
+        try:
+            self._map()
+        except Exception:
+            self._file.close()
+            raise
+
+    def _map(self):
+        """ Read the header and map the id index and the matrix """
+        self._file.seek(0)
+        header = self._file.read(self._HEADER.size)
+        if len(header) < self._HEADER.size:
+            raise ValueError("Not a vector store: {0}".format(self._path))
+        magic, version, dims, capacity, count, ts = self._HEADER.unpack(header)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("Not a vector store: {0}".format(self._path))
+        self._dimensions = dims
+        self._capacity = capacity
+        self._count = count
+        self._timestamp = self._EPOCH + timedelta(seconds=ts) if ts else None
+        mode = "r+" if self._writable else "r"
+        self._header = np.memmap(self._file, mode=mode, shape=(self._HEADER_SIZE,))
+        self._ids = np.memmap(
+            self._file,
+            dtype="S{0}".format(self.ID_SIZE),
+            mode=mode,
+            offset=self._HEADER_SIZE,
+            shape=(capacity,),
+        )
+        self._matrix = np.memmap(
+            self._file,
+            dtype=np.float32,
+            mode=mode,
+            offset=self._matrix_offset(capacity),
+            shape=(capacity, dims),
+        )
+        self._rows = None
+
+    @classmethod
+    def _matrix_offset(cls, capacity):
+        return cls._HEADER_SIZE + capacity * cls.ID_SIZE
+
+    @classmethod
+    def create(cls, path, dimensions, capacity=1024):
+        """ Create an empty store, replacing any existing file at path,
+            and return it opened for writing """
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                cls._HEADER.pack(cls.MAGIC, cls.VERSION, dimensions, capacity, 0, 0.0)
+            )
+            f.truncate(cls._matrix_offset(capacity) + capacity * dimensions * 4)
+        os.replace(tmp, path)
+        return cls(path, writable=True)
+
+    @property
+    def dimensions(self):
+        return self._dimensions
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def timestamp(self):
+        """ All articles indexed before this time are in the store """
+        return self._timestamp
+
+    def __len__(self):
+        """ The number of rows in the store, as seen by this process """
+        return self._count
+
+    def ids(self):
+        """ Return a list of the article ids of the rows """
+        return [b.decode("ascii") for b in self._ids[: self._count]]
+
+    def matrix(self, copy_on_write=False):
+        """ Return the matrix of the store, having capacity rows,
+            as a memory-mapped array. A copy-on-write array can be
+            modified without affecting the file or other processes. """
+        if not copy_on_write:
+            return self._matrix
+        return np.memmap(
+            self._file,
+            dtype=np.float32,
+            mode="c",
+            offset=self._matrix_offset(self._capacity),
+            shape=(self._capacity, self._dimensions),
+        )
+
+    def _rewrite(self, capacity, rows=None):
+        """ Rewrite the file with the given capacity, keeping only the
+            given rows if specified. The new file replaces the old one,
+            which remains valid for readers that have mapped it. """
+        if rows is None:
+            ids = self._ids[: self._count]
+            matrix = self._matrix[: self._count]
+        else:
+            ids = self._ids[rows]
+            matrix = self._matrix[rows]
+        count = len(ids)
+        tmp = self._path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                self._HEADER.pack(
+                    self.MAGIC,
+                    self.VERSION,
+                    self._dimensions,
+                    capacity,
+                    count,
+                    self._timestamp_value(),
+                )
+            )
+            f.seek(self._HEADER_SIZE)
+            f.write(ids.tobytes())
+            f.seek(self._matrix_offset(capacity))
+            f.write(np.ascontiguousarray(matrix).tobytes())
+            f.truncate(self._matrix_offset(capacity) + capacity * self._dimensions * 4)
+        lock = open(tmp, "r+b")
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(tmp, self._path)
+        self._close_maps()
+        self._file.close()
+        self._file = lock
+        self._map()
+
+    def _grow(self, capacity):
+        """ Rewrite the file with a larger capacity """
+        rows = self._rows
+        self._rewrite(capacity)
+        self._rows = rows
+
+    def compact(self, keep):
+        """ Remove the rows of the articles whose ids are not in keep,
+            returning the number of rows removed """
+        assert self._writable
+        ids = self.ids()
+        rows = [row for row, article_id in enumerate(ids) if article_id in keep]
+        removed = len(ids) - len(rows)
+        if removed:
+            self._rewrite(self._capacity, np.array(rows, dtype=np.int64))
+        return removed
+
+    def _timestamp_value(self):
+        if self._timestamp is None:
+            return 0.0
+        return (self._timestamp - self._EPOCH).total_seconds()
+
+    def put(self, ids, vectors):
+        """ Add or replace the topic vectors of the given articles """
+        assert self._writable
+        if not ids:
+            return
+        if self._rows is None:
+            self._rows = {article_id: row for row, article_id in enumerate(self.ids())}
+        normalized = TopicMatrix.normalize(vectors)
+        for article_id, vector in zip(ids, normalized):
+            row = self._rows.get(article_id)
+            if row is not None:
+                self._matrix[row] = vector
+                continue
+            if self._count >= self._capacity:
+                self._grow(2 * self._capacity)
+            row = self._rows[article_id] = self._count
+            self._ids[row] = article_id.encode("ascii")
+            self._matrix[row] = vector
+            self._count += 1
+            # Publish the new row to readers
+            self._header[self._COUNT_OFFSET : self._COUNT_OFFSET + 8] = np.frombuffer(
+                struct.pack("<Q", self._count), dtype=np.uint8
+            )
+
+    def set_timestamp(self, ts):
+        """ Record that all articles indexed before ts are in the store """
+        assert self._writable
+        self._timestamp = ts
+        self._header[self._HEADER.size - 8 : self._HEADER.size] = np.frombuffer(
+            struct.pack("<d", self._timestamp_value()), dtype=np.uint8
+        )
+        self.flush()
+
+    def flush(self):
+        """ Flush changes to the file """
+        for m in (self._header, self._ids, self._matrix):
+            m.flush()
+
+    def _close_maps(self):
+        self._header = self._ids = self._matrix = None
+
+    def close(self):
+        if self._file is not None:
+            if self._writable:
+                self.flush()
+            self._close_maps()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()